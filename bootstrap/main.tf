@@ -360,6 +360,7 @@ resource "google_cloudfunctions2_function" "zone-watcher" {
       SOURCE_OF_TRUTH_PATH                     = var.source_of_truth_path
       PROJECT_ID_SECRETS                       = var.project_id_secrets
       GIT_SECRET_ID                            = var.git_secret_id
+      STATE_STORE                              = "gs://${google_storage_bucket.gdce-cluster-provisioner-bucket.name}/watcher-state"
       MAX_RETRIES                              = var.cluster_creation_max_retries
     }
     service_account_email = google_service_account.zone-watcher-agent.email
@@ -429,6 +430,7 @@ resource "google_cloudfunctions2_function" "cluster-watcher" {
       SOURCE_OF_TRUTH_PATH                     = var.source_of_truth_path
       PROJECT_ID_SECRETS                       = var.project_id_secrets
       GIT_SECRET_ID                            = var.git_secret_id
+      STATE_STORE                              = "gs://${google_storage_bucket.gdce-cluster-provisioner-bucket.name}/watcher-state"
     }
     service_account_email = google_service_account.zone-watcher-agent.email
   }
@@ -497,6 +499,7 @@ resource "google_cloudfunctions2_function" "zone-active-metric" {
       SOURCE_OF_TRUTH_PATH                     = var.source_of_truth_path
       PROJECT_ID_SECRETS                       = var.project_id_secrets
       GIT_SECRET_ID                            = var.git_secret_id
+      STATE_STORE                              = "gs://${google_storage_bucket.gdce-cluster-provisioner-bucket.name}/watcher-state"
     }
     service_account_email = google_service_account.zone-watcher-agent.email
   }
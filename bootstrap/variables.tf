@@ -111,7 +111,7 @@ variable "source_of_truth_branch" {
 }
 
 variable "source_of_truth_path" {
-  description = "Path to cluster intent registry file"
+  description = "Path to cluster intent registry file, or a glob (sot/*.csv) or directory (sot/) of CSV shards"
   default     = "source_of_truth.csv"
 }
 
@@ -29,9 +29,9 @@ from src.main import WatcherParameters
 class TestWatcherIntegration(unittest.TestCase):
 
     @unittest.skipUnless(os.environ.get('RUN_PERF_TEST'), "Skipping perf test")
-    @mock.patch("src.main.get_zone")
+    @mock.patch("google.cloud.gdchardwaremanagement_v1alpha.GDCHardwareManagementAsyncClient")
     @mock.patch("google.cloud.devtools.cloudbuild.CloudBuildClient")
-    @mock.patch("google.cloud.edgecontainer.EdgeContainerClient")
+    @mock.patch("google.cloud.edgecontainer.EdgeContainerAsyncClient")
     @mock.patch("src.main.read_intent_data")
     @mock.patch("src.main.get_parameters_from_environment")
     def test_zone_watcher_integration_multiple_stores(
@@ -40,7 +40,7 @@ class TestWatcherIntegration(unittest.TestCase):
         mock_read_intent_data,
         mock_ec_client,
         mock_cb_client,
-        mock_get_zone
+        mock_hw_client
     ):
         """
         Tests the zone_watcher function with variable number of projects, regions, and zones.
@@ -51,7 +51,7 @@ class TestWatcherIntegration(unittest.TestCase):
         number_of_projects = 10
         number_of_regions_within_project = 5
         number_of_stores_within_region = 20
-        get_zone_latency = 0.5
+        list_zones_latency = 0.5
         list_machines_per_machine_latency = 0.05
 
         print("Total clusters = ", number_of_projects * number_of_regions_within_project * number_of_stores_within_region)
@@ -63,10 +63,12 @@ class TestWatcherIntegration(unittest.TestCase):
             secrets_project_id="test-project",
             region="us-central1",
             cloud_build_trigger="projects/test-project/locations/us-central1/triggers/test-trigger",
+            cloud_build_trigger_name="test-trigger",
             git_secret_id="secret-id",
             source_of_truth_repo="test-repo",
             source_of_truth_branch="main",
             source_of_truth_path="main/",
+            max_retries=0,
         )
 
         mock_get_parameters.return_value = params 
@@ -74,7 +76,7 @@ class TestWatcherIntegration(unittest.TestCase):
         intent_data = generate_cluster_intent(number_of_projects, number_of_regions_within_project, number_of_stores_within_region)
         mock_read_intent_data.return_value = intent_data
 
-        mock_get_zone.side_effect = generate_get_zone_function(get_zone_latency)
+        mock_hw_client.return_value.list_zones.side_effect = generate_list_zones_function(list_zones_latency, intent_data)
 
         mock_ec_client.return_value.list_machines.side_effect = generate_list_machines_function(list_machines_per_machine_latency, number_of_projects, number_of_regions_within_project, number_of_stores_within_region)
 
@@ -90,6 +92,13 @@ class TestWatcherIntegration(unittest.TestCase):
             mock_run_build_trigger
         )
 
+        # Build history used to decide on retries, no previous builds
+        mock_trigger = MagicMock()
+        mock_trigger.name = "test-trigger"
+        mock_trigger.id = "test-trigger-id"
+        mock_cb_client.return_value.list_build_triggers.return_value = [mock_trigger]
+        mock_cb_client.return_value.list_builds.return_value = []
+
         # --- Invoke the Function ---
         req = MagicMock(spec=flask.Request)
         main.zone_watcher(req)
@@ -98,15 +107,15 @@ class TestWatcherIntegration(unittest.TestCase):
         # Verify that the intent data was read
         mock_read_intent_data.assert_called_once()
 
-        # Assert that get zones are being called for generated zones
-        mock_get_zone.assert_any_call('projects/project-0/locations/region-0/zones/store1')
-        mock_get_zone.assert_any_call('projects/project-9/locations/region-4/zones/store50')
+        # Assert that zones are listed once per location instead of retrieved per store
+        self.assertEqual(mock_hw_client.return_value.list_zones.call_count, number_of_projects * number_of_regions_within_project)
+        mock_hw_client.return_value.get_zone.assert_not_called()
 
     @unittest.skipUnless(os.environ.get('RUN_PERF_TEST'), "Skipping perf test")
-    @mock.patch("src.main.get_zone")
+    @mock.patch("google.cloud.gdchardwaremanagement_v1alpha.GDCHardwareManagementAsyncClient")
     @mock.patch("google.cloud.devtools.cloudbuild.CloudBuildClient")
     @mock.patch("google.cloud.edgenetwork.EdgeNetworkClient")
-    @mock.patch("google.cloud.edgecontainer.EdgeContainerClient")
+    @mock.patch("google.cloud.edgecontainer.EdgeContainerAsyncClient")
     @mock.patch("src.main.read_intent_data")
     @mock.patch("src.main.get_parameters_from_environment")
     def test_cluster_watcher_integration_multiple_stores(
@@ -116,7 +125,7 @@ class TestWatcherIntegration(unittest.TestCase):
         mock_ec_client,
         mock_en_client,
         mock_cb_client,
-        mock_get_zone
+        mock_hw_client
     ):
         """
         Tests the cluster_watcher function with variable number of projects, regions, and zones.
@@ -127,7 +136,7 @@ class TestWatcherIntegration(unittest.TestCase):
         number_of_projects = 10
         number_of_regions_within_project = 5
         number_of_stores_within_region = 20
-        get_zone_latency = 0.5
+        list_zones_latency = 0.5
         list_subnets_latency = 0.5
         list_machines_per_machine_latency = 0.05
         list_clusters_per_cluster_latency = 0.1
@@ -141,10 +150,12 @@ class TestWatcherIntegration(unittest.TestCase):
             secrets_project_id="test-project",
             region="us-central1",
             cloud_build_trigger="projects/test-project/locations/us-central1/triggers/test-trigger",
+            cloud_build_trigger_name="test-trigger",
             git_secret_id="secret-id",
             source_of_truth_repo="test-repo",
             source_of_truth_branch="main",
             source_of_truth_path="main/",
+            max_retries=0,
         )
 
         mock_get_parameters.return_value = params 
@@ -152,7 +163,7 @@ class TestWatcherIntegration(unittest.TestCase):
         intent_data = generate_cluster_intent(number_of_projects, number_of_regions_within_project, number_of_stores_within_region)
         mock_read_intent_data.return_value = intent_data
 
-        mock_get_zone.side_effect = generate_get_zone_function(get_zone_latency)
+        mock_hw_client.return_value.list_zones.side_effect = generate_list_zones_function(list_zones_latency, intent_data)
 
         mock_ec_client.return_value.list_machines.side_effect = generate_list_machines_function(list_machines_per_machine_latency, number_of_projects, number_of_regions_within_project, number_of_stores_within_region)
         mock_ec_client.return_value.list_clusters.side_effect = generate_list_clusters_function(list_clusters_per_cluster_latency, number_of_projects, number_of_regions_within_project, number_of_stores_within_region)
@@ -184,9 +195,9 @@ class TestWatcherIntegration(unittest.TestCase):
         # Verify that the intent data was read
         mock_read_intent_data.assert_called_once()
 
-        # Assert that get zones are being called for generated zones
-        mock_get_zone.assert_any_call('projects/project-0/locations/region-0/zones/store1')
-        mock_get_zone.assert_any_call('projects/project-1/locations/region-1/zones/store10')
+        # Assert that zones are listed once per location instead of retrieved per store
+        self.assertEqual(mock_hw_client.return_value.list_zones.call_count, number_of_projects * number_of_regions_within_project)
+        mock_hw_client.return_value.get_zone.assert_not_called()
 
 
 def generate_cluster_intent(number_of_projects, number_of_regions_within_project, number_of_stores_within_region):
@@ -290,18 +301,28 @@ def generate_list_clusters_function(delay_seconds_per_cluster, number_of_project
 
     return list_machines
 
-def generate_get_zone_function(delay_seconds):
-    def get_zone(zone_id):
+def generate_list_zones_function(delay_seconds, intent_data):
+    def list_zones(request):
         time.sleep(delay_seconds)
 
-        # zone_id = projects/project-0/locations/region-0/zones/store1
-        store_number = zone_id.split("/")[-1][5:]
+        # request.parent = projects/project-0/locations/region-0
+        zones = []
+
+        for (project, region), stores in intent_data.items():
+            if request.parent != f"projects/{project}/locations/{region}":
+                continue
+
+            for store_id in stores:
+                store_number = store_id[5:]
+
+                zone = Zone()
+
+                zone.name = f"{request.parent}/zones/{store_id}"
+                zone.state = "ACTIVE"
+                zone.globally_unique_id = f"zone{store_number}"
 
-        zone = Zone()
+                zones.append(zone)
 
-        zone.state = "ACTIVE"
-        zone.globally_unique_id = f"zone{store_number}"
+        return iter(zones)
 
-        return zone
-    
-    return get_zone
\ No newline at end of file
+    return list_zones
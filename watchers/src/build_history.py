@@ -1,5 +1,6 @@
 import logging
 import os
+from datetime import datetime, timezone
 from google.cloud.devtools import cloudbuild
 from google.cloud.devtools.cloudbuild import Build
 from typing import Dict
@@ -12,10 +13,21 @@ class BuildSummary:
     numberOfBuilds: int = 0
     numberOfFailures: int = 0
     retriable: bool = False
+    inFlight: bool = False
+    lastBuildStatus: Build.Status = None
+    lastBuildFinishTime: datetime = None
 
     def add_build(self, build: cloudbuild.Build):
         self.numberOfBuilds += 1
 
+        if build.status in (cloudbuild.Build.Status.QUEUED, cloudbuild.Build.Status.PENDING, cloudbuild.Build.Status.WORKING):
+            self.inFlight = True
+
+        # Builds are listed from the most recent one
+        if self.numberOfBuilds == 1:
+            self.lastBuildStatus = build.status
+            self.lastBuildFinishTime = build.finish_time
+
         if build.status not in (
             cloudbuild.Build.Status.QUEUED,
             cloudbuild.Build.Status.PENDING,
@@ -49,6 +61,22 @@ class BuildSummary:
         
         return self.retriable
 
+    def is_active(self, cooldown: float, now: datetime) -> bool:
+        """
+        Args:
+            cooldown: seconds after a successful build during which its zone is still considered active
+            now: current time
+        Returns:
+            True if a build is in progress, or if the most recent build succeeded less than `cooldown`
+            seconds ago
+        """
+        if self.inFlight:
+            return True
+
+        return (self.lastBuildStatus == cloudbuild.Build.Status.SUCCESS and
+                self.lastBuildFinishTime is not None and
+                (now - self.lastBuildFinishTime).total_seconds() < cooldown)
+
 
 class BuildHistory:
     def __init__(self, project_id: str, region: str, max_retries: int, trigger_name: str):
@@ -150,5 +178,23 @@ class BuildHistory:
             build = self.builds[zone_name]
             return build.is_retriable(self.max_retries)
 
-        
-        
\ No newline at end of file
+    def is_zone_build_active(self, zone_name: str, cooldown: float, now: datetime = None) -> bool:
+        """
+        Determines if a zone has a build in progress or a build that just succeeded, so another build
+        should not be triggered yet. `False` is returned in the event of no build history for a zone.
+
+        Args:
+            zone_name: The name of the zone
+            cooldown: seconds after a successful build during which no other build should be triggered
+            now: current time, defaults to the current UTC time
+        """
+        if not zone_name:
+            raise Exception('missing zone_name')
+
+        if self.builds is None:
+            self.builds = self._get_build_history()
+
+        if zone_name not in self.builds:
+            return False
+
+        return self.builds[zone_name].is_active(cooldown, now or datetime.now(timezone.utc))
@@ -0,0 +1,83 @@
+import logging
+import os
+from typing import Dict, FrozenSet
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+class ZoneCapacity:
+    """Machine capacity of a GDCE zone: free and total node count and the clusters hosted on its machines."""
+    __slots__ = ('free_nodes', 'total_nodes', 'hosted_clusters')
+
+    def __init__(self, free_nodes: int = 0, total_nodes: int = 0, hosted_clusters: FrozenSet[str] = frozenset()):
+        self.free_nodes = free_nodes
+        self.total_nodes = total_nodes
+        self.hosted_clusters = hosted_clusters
+
+    def __eq__(self, other):
+        return (isinstance(other, ZoneCapacity) and
+                (self.free_nodes, self.total_nodes, self.hosted_clusters) ==
+                (other.free_nodes, other.total_nodes, other.hosted_clusters))
+
+    def __repr__(self):
+        return (f'ZoneCapacity(free_nodes={self.free_nodes}, total_nodes={self.total_nodes}, '
+                f'hosted_clusters={set(self.hosted_clusters)})')
+
+
+class ZoneCapacityIndex:
+    """
+    Per-zone machine capacity, built in a single pass over ListMachines results.
+
+    The index only exposes `append`, so it can be passed as the `out` of `AsyncEngine.list` and fold
+    each machine in as pages arrive; the Machine protos are not retained. Zones are kept in the order
+    they were first seen.
+    """
+
+    def __init__(self):
+        self.zones: Dict[str, ZoneCapacity] = {}
+
+    def append(self, machine):
+        """
+        Args:
+            machine: edgecontainer Machine
+        """
+        capacity = self.zones.get(machine.zone)
+        if capacity is None:
+            capacity = self.zones[machine.zone] = ZoneCapacity()
+
+        capacity.total_nodes += 1
+        if len(machine.hosted_node.strip()) > 0:  # if there is any value, consider there is a cluster
+            logger.debug(f'ZONE {machine.zone}: {machine.name} already used by {machine.hosted_node}')
+            cluster_name = machine.hosted_node.split('/')[5]
+            if cluster_name not in capacity.hosted_clusters:
+                capacity.hosted_clusters = capacity.hosted_clusters | {cluster_name}
+        else:
+            logger.debug(f'ZONE {machine.zone}: {machine.name} is a free node')
+            capacity.free_nodes += 1
+
+    def merge(self, other: 'ZoneCapacityIndex'):
+        """Adds the capacity of every zone of `other` to this index."""
+        for zone, other_capacity in other.zones.items():
+            capacity = self.zones.get(zone)
+            if capacity is None:
+                self.zones[zone] = ZoneCapacity(other_capacity.free_nodes, other_capacity.total_nodes,
+                                                other_capacity.hosted_clusters)
+            else:
+                capacity.free_nodes += other_capacity.free_nodes
+                capacity.total_nodes += other_capacity.total_nodes
+                capacity.hosted_clusters = capacity.hosted_clusters | other_capacity.hosted_clusters
+
+    def get(self, zone: str) -> ZoneCapacity:
+        """
+        Args:
+            zone: GDCE zone name
+        Returns:
+            The capacity of the zone, or None if no machine was found in it
+        """
+        return self.zones.get(zone)
+
+    def __contains__(self, zone: str) -> bool:
+        return zone in self.zones
+
+    def __len__(self) -> int:
+        return len(self.zones)
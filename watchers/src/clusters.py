@@ -0,0 +1,51 @@
+import logging
+import os
+from typing import Dict, List, Set
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+class ClusterIndex:
+    """
+    Index of the edgecontainer clusters of a location by GDCE zone, the node_location of their local
+    control plane.
+
+    The index only exposes `append` for construction, so it can be passed as the `out` of
+    `AsyncEngine.list` and index clusters as pages arrive. Zones with more than one cluster are
+    flagged in `multi_cluster_zones` while the index is built.
+    """
+
+    def __init__(self, clusters=()):
+        self.zones: Dict[str, List] = {}
+        self.multi_cluster_zones: Set[str] = set()
+        self.count = 0
+
+        for cluster in clusters:
+            self.append(cluster)
+
+    def append(self, cluster):
+        """
+        Args:
+            cluster: edgecontainer Cluster
+        """
+        zone = cluster.control_plane.local.node_location
+        self.count += 1
+
+        zone_clusters = self.zones.setdefault(zone, [])
+        zone_clusters.append(cluster)
+
+        if len(zone_clusters) == 2:
+            self.multi_cluster_zones.add(zone)
+            logger.debug(f'More than 1 lcp clusters found in {zone}')
+
+    def get(self, zone: str) -> List:
+        """
+        Args:
+            zone: GDCE zone name
+        Returns:
+            The clusters in the zone, in listing order, empty if there are none
+        """
+        return self.zones.get(zone, [])
+
+    def __len__(self) -> int:
+        return self.count
@@ -0,0 +1,186 @@
+import logging
+import os
+from datetime import datetime
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Mapping, Optional
+from dateutil.parser import parse
+from .maintenance_windows import MaintenanceExclusionWindow
+from .reconcile import get_row_hash
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+class DesiredClusterState:
+    """
+    Desired state of the cluster of a store, compiled once from its source of truth row.
+
+    The string columns the watchers compare are parsed into typed values: maintenance window times into
+    datetimes, `subnet_vlans` into a frozenset of VLAN ids, `labels` into a read-only mapping and the
+    maintenance exclusion columns into a frozenset of MaintenanceExclusionWindow, None if they could not be
+    parsed. Instances are immutable and shared between invocations, see `get_desired_state`.
+    """
+    __slots__ = ('row_hash', 'store_id', 'cluster_name', 'machine_project_id', 'zone_name', 'sync_branch',
+                 'recreate_on_delete', 'node_count', 'maintenance_window_recurrence', 'maintenance_window_start',
+                 'maintenance_window_end', 'subnet_vlans', 'labels', 'exclusion_windows')
+
+    def __init__(self, row_hash: str = None, store_id: str = None, cluster_name: str = None,
+                 machine_project_id: str = None, zone_name: str = None, sync_branch: str = None,
+                 recreate_on_delete: str = None, node_count: Optional[int] = None,
+                 maintenance_window_recurrence: str = None, maintenance_window_start: Optional[datetime] = None,
+                 maintenance_window_end: Optional[datetime] = None, subnet_vlans: FrozenSet[int] = frozenset(),
+                 labels: Mapping[str, str] = None,
+                 exclusion_windows: Optional[FrozenSet[MaintenanceExclusionWindow]] = frozenset()):
+        set_slot = super().__setattr__
+        set_slot('row_hash', row_hash)
+        set_slot('store_id', store_id)
+        set_slot('cluster_name', cluster_name)
+        set_slot('machine_project_id', machine_project_id)
+        set_slot('zone_name', zone_name)
+        set_slot('sync_branch', sync_branch)
+        set_slot('recreate_on_delete', recreate_on_delete)
+        set_slot('node_count', node_count)
+        set_slot('maintenance_window_recurrence', maintenance_window_recurrence)
+        set_slot('maintenance_window_start', maintenance_window_start)
+        set_slot('maintenance_window_end', maintenance_window_end)
+        set_slot('subnet_vlans', frozenset(subnet_vlans))
+        set_slot('labels', MappingProxyType(dict(labels or {})))
+        set_slot('exclusion_windows', None if exclusion_windows is None else frozenset(exclusion_windows))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'DesiredClusterState is immutable, cannot set {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'DesiredClusterState is immutable, cannot delete {name}')
+
+    def __repr__(self):
+        return f'DesiredClusterState(store_id={self.store_id}, cluster_name={self.cluster_name}, row_hash={self.row_hash})'
+
+    @property
+    def has_maintenance_window(self) -> bool:
+        """True if the recurrence, start and end of the maintenance window are all defined."""
+        return bool(self.maintenance_window_recurrence and self.maintenance_window_start and self.maintenance_window_end)
+
+    @staticmethod
+    def from_row(store_info: dict, row_hash: str = None) -> 'DesiredClusterState':
+        """
+        Compiles a source of truth row. Values that cannot be parsed are logged and left unset, so an invalid
+        column only affects the checks using it.
+
+        Args:
+            store_info: source of truth row
+            row_hash: content hash of the row, computed if not given
+        Returns:
+            DesiredClusterState
+        """
+        store_id = store_info.get('store_id')
+
+        def parse_time(column) -> Optional[datetime]:
+            value = store_info.get(column)
+            if not value:
+                return None
+            try:
+                return parse(value)
+            except Exception as err:
+                logger.error(f'Unable to parse {column} of store {store_id}: {value}')
+                logger.error(err)
+                return None
+
+        node_count = None
+        if store_info.get('node_count'):
+            try:
+                node_count = int(store_info['node_count'])
+            except ValueError as err:
+                logger.error(f'Unable to parse node_count of store {store_id}: {store_info["node_count"]}')
+                logger.error(err)
+
+        subnet_vlans = set()
+        for vlan in (store_info.get('subnet_vlans') or '').split(','):
+            if not vlan.strip():
+                continue
+            try:
+                subnet_vlans.add(int(vlan))
+            except ValueError:
+                logger.error(f'unable to convert vlan to an int: {vlan}, store: {store_id}')
+
+        ## labels are specified in SoT in the following way: "key1=value1,key2=value2,key3=value3"
+        labels = {}
+        for label in (store_info.get('labels') or '').strip().split(','):
+            if not label:
+                continue
+            kv_pair = label.split('=')
+            if len(kv_pair) < 2:
+                logger.error(f'Unable to parse label of store {store_id}: {label}')
+                continue
+            labels[kv_pair[0]] = kv_pair[1]
+
+        try:
+            exclusion_windows = MaintenanceExclusionWindow.get_exclusion_windows_from_sot(store_info)
+        except Exception as err:
+            logger.error(f'Unable to parse maintenance exclusions of store {store_id}')
+            logger.error(err)
+            exclusion_windows = None
+
+        return DesiredClusterState(
+            row_hash=row_hash or get_row_hash(store_info),
+            store_id=store_id,
+            cluster_name=store_info.get('cluster_name'),
+            machine_project_id=store_info.get('machine_project_id'),
+            zone_name=store_info.get('zone_name'),
+            sync_branch=store_info.get('sync_branch'),
+            recreate_on_delete=store_info.get('recreate_on_delete'),
+            node_count=node_count,
+            maintenance_window_recurrence=store_info.get('maintenance_window_recurrence'),
+            maintenance_window_start=parse_time('maintenance_window_start'),
+            maintenance_window_end=parse_time('maintenance_window_end'),
+            subnet_vlans=subnet_vlans,
+            labels=labels,
+            exclusion_windows=exclusion_windows
+        )
+
+
+# compiled states by row hash, kept across invocations of a warm instance
+compiled_states: Dict[str, DesiredClusterState] = {}
+
+def get_desired_state(store_info: dict) -> DesiredClusterState:
+    """
+    Args:
+        store_info: source of truth row
+    Returns:
+        The compiled state of the row, only compiled when no row with the same content was compiled before
+    """
+    row_hash = get_row_hash(store_info)
+
+    state = compiled_states.get(row_hash)
+    if state is None:
+        state = DesiredClusterState.from_row(store_info, row_hash)
+        compiled_states[row_hash] = state
+
+    return state
+
+
+def get_desired_states(config_zone_info) -> Dict[str, DesiredClusterState]:
+    """
+    Compiles every row of the intent data, reusing the states of the rows compiled by previous invocations.
+    The intent data can be a part of the source of truth (a shard or an incremental selection), the compiled
+    states are added to the cache without evicting the other rows, see `evict_desired_states`.
+
+    Args:
+        config_zone_info: intent data as returned by read_intent_data
+    Returns:
+        The compiled states by store_id
+    """
+    return {store_id: get_desired_state(store_info)
+            for stores in config_zone_info.values() for store_id, store_info in stores.items()}
+
+
+def evict_desired_states(config_zone_info):
+    """
+    Drops the compiled states of the rows no longer in the source of truth from the cache.
+
+    Args:
+        config_zone_info: intent data of the whole source of truth, as returned by read_intent_data
+    """
+    global compiled_states
+
+    row_hashes = {get_row_hash(store_info) for stores in config_zone_info.values() for store_info in stores.values()}
+    compiled_states = {row_hash: state for row_hash, state in compiled_states.items() if row_hash in row_hashes}
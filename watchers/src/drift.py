@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from google.api_core import exceptions
+from google.cloud import edgenetwork
+from google.cloud import gkehub_v1
+from .desired_state import DesiredClusterState, get_desired_state
+from .engine import AsyncEngine, EDGE_NETWORK, GKE_HUB, REST
+from .maintenance_windows import MaintenanceExclusionWindow
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Error policies of detectors, applied when fetching their remote data fails
+RAISE = 'raise'            # the error propagates and fails the watcher run
+SKIP_STORE = 'skip_store'  # the store is not evaluated in this run
+REPORT = 'report'          # the error is logged and the detector finds no drift
+
+@dataclass
+class DriftContext:
+    """Everything the drift detectors of one store can use."""
+    engine: AsyncEngine
+    project_id: str
+    location: str
+    zone: str
+    cluster: Any
+    store_info: dict
+    en_client: Any = None
+    gkehub_client: Any = None
+    # labels of every membership of the fleet project by membership id, None if not prefetched
+    memberships: Optional[Dict[str, dict]] = None
+    # maintenance policies of the clusters of the location by cluster name, None if not prefetched
+    maintenance_policies: Optional[Dict[str, dict]] = None
+    # returns the maintenance policy of a cluster from the REST API
+    get_maintenance_policy: Callable[[str], dict] = None
+    # compiled source of truth row, compiled from store_info if not given
+    desired: DesiredClusterState = None
+
+    def __post_init__(self):
+        if self.desired is None:
+            self.desired = get_desired_state(self.store_info)
+
+
+@dataclass
+class DriftResult:
+    """Outcome of the drift detection of one store. `reasons` lists the drift found by every detector that ran."""
+    reasons: List[str] = field(default_factory=list)
+    error: bool = False
+
+    @property
+    def has_update(self) -> bool:
+        return len(self.reasons) > 0
+
+
+class DriftDetector(ABC):
+    """
+    Compares one aspect of a cluster with the source of truth.
+
+    `cost` orders the detectors: 0 is a local comparison, higher values need more expensive remote data.
+    `requires` names the remote data the detector fetches, if any. `on_error` is the policy applied when
+    fetching fails (RAISE, SKIP_STORE or REPORT).
+    """
+    name: str = None
+    cost: int = 0
+    requires: str = None
+    on_error: str = RAISE
+
+    def applies(self, ctx: DriftContext) -> bool:
+        """Returns False when the source of truth does not define what the detector compares."""
+        return True
+
+    async def fetch(self, ctx: DriftContext):
+        """Retrieves the remote data of the detector, passed to `compare`."""
+        return None
+
+    @abstractmethod
+    def compare(self, ctx: DriftContext, data) -> List[str]:
+        """
+        Returns:
+            The reasons the cluster needs an update, empty if it is in sync
+        """
+
+
+def is_maintenance_window_changed(ctx: DriftContext) -> bool:
+    rw = ctx.cluster.maintenance_policy.window.recurring_window  # cluster in this GDCE zone
+    return (rw.recurrence != ctx.desired.maintenance_window_recurrence or
+            rw.window.start_time != ctx.desired.maintenance_window_start or
+            rw.window.end_time != ctx.desired.maintenance_window_end)
+
+
+class MaintenanceWindowDetector(DriftDetector):
+    name = 'maintenance_window'
+    cost = 0
+
+    def applies(self, ctx: DriftContext) -> bool:
+        # One of the MW properties is not set, so assume no update needs to be made
+        return ctx.desired.has_maintenance_window
+
+    def compare(self, ctx: DriftContext, data) -> List[str]:
+        # Validate the start_time, end_time and rrule string of the maintenance window
+        if not is_maintenance_window_changed(ctx):
+            return []
+
+        rw = ctx.cluster.maintenance_policy.window.recurring_window
+        logger.info("Maintenance window requires update")
+        logger.info(f"Actual values (recurrence={rw.recurrence}, start_time={rw.window.start_time}, end_time={rw.window.end_time})")
+        logger.info(f"Desired values (recurrence={ctx.desired.maintenance_window_recurrence}, start_time={ctx.desired.maintenance_window_start}, end_time={ctx.desired.maintenance_window_end})")
+        return ['maintenance window changed']
+
+
+class MaintenanceExclusionDetector(DriftDetector):
+    name = 'maintenance_exclusions'
+    cost = 1
+    requires = 'edgecontainer REST maintenancePolicy'
+    on_error = SKIP_STORE
+
+    def applies(self, ctx: DriftContext) -> bool:
+        # exclusion windows are only compared when the MW properties haven't changed
+        if not ctx.desired.has_maintenance_window or is_maintenance_window_changed(ctx):
+            return False
+
+        # an invalid exclusion would otherwise be reported as drift on every run
+        if ctx.desired.exclusion_windows is None:
+            logger.warning(f'Skipping maintenance exclusions of store {ctx.desired.store_id}, they could not be parsed')
+            return False
+
+        return True
+
+    async def fetch(self, ctx: DriftContext):
+        if ctx.maintenance_policies is not None and ctx.cluster.name in ctx.maintenance_policies:
+            return ctx.maintenance_policies[ctx.cluster.name]
+
+        # Retrieving maintenance window from API until property exists in client library response
+        return await ctx.engine.call(REST, ctx.get_maintenance_policy, ctx.cluster.name)
+
+    def compare(self, ctx: DriftContext, data) -> List[str]:
+        actual_exclusion_windows = MaintenanceExclusionWindow.get_exclusion_windows_from_api_response(data)
+
+        if ctx.desired.exclusion_windows != actual_exclusion_windows:
+            return ['maintenance exclusions changed']
+        return []
+
+
+class FleetLabelsDetector(DriftDetector):
+    name = 'fleet_labels'
+    cost = 1
+    requires = 'gkehub membership labels'
+    on_error = REPORT
+
+    def applies(self, ctx: DriftContext) -> bool:
+        # if labels is not defined in SoT, then don't trigger an update
+        return len(ctx.desired.labels) > 0
+
+    async def fetch(self, ctx: DriftContext):
+        cluster_name = ctx.store_info['cluster_name']
+
+        if ctx.memberships is not None:
+            return ctx.memberships.get(cluster_name)
+
+        req = gkehub_v1.GetMembershipRequest(name=f"projects/{ctx.project_id}/locations/global/memberships/{cluster_name}")
+        try:
+            res = await ctx.engine.call(GKE_HUB, ctx.gkehub_client.get_membership, request=req)
+        except exceptions.NotFound:
+            return None
+        return res.labels
+
+    def compare(self, ctx: DriftContext, data) -> List[str]:
+        if data is None:
+            logger.error(f"Membership not found for project: {ctx.project_id}, cluster: {ctx.store_info['cluster_name']}, "
+                         f"fleet labels cannot be compared")
+            return []
+
+        if dict(ctx.desired.labels) != data:
+            return ['fleet labels changed']
+        return []
+
+
+class SubnetDetector(DriftDetector):
+    name = 'subnets'
+    cost = 2
+    requires = 'edgenetwork subnets'
+    on_error = SKIP_STORE
+
+    async def fetch(self, ctx: DriftContext):
+        # get subnet vlan ids and ip addresses of this GDCE Zone
+        req_n = edgenetwork.ListSubnetsRequest(
+            parent=f'{ctx.en_client.common_location_path(ctx.store_info["machine_project_id"], ctx.location)}/zones/{ctx.zone}'
+        )
+        res_pager_n = await ctx.engine.list(EDGE_NETWORK, ctx.en_client.list_subnets, req_n)
+        return [{'vlan_id': net.vlan_id, 'ipv4_cidr': sorted(net.ipv4_cidr)} for net in res_pager_n]
+
+    def compare(self, ctx: DriftContext, data) -> List[str]:
+        logger.debug(sorted(data, key=lambda x: x['vlan_id']))
+        actual_vlan_ids = {n['vlan_id'] for n in data}
+
+        # Only consider vlan ids for updates (L2), L3 not handled
+        reasons = []
+        for vlan_id in sorted(ctx.desired.subnet_vlans - actual_vlan_ids):
+            logger.info(f"No vlan created for vlan: {vlan_id}")
+            reasons.append(f'vlan {vlan_id} missing')
+
+        for actual_vlan_id in sorted(actual_vlan_ids - ctx.desired.subnet_vlans):
+            logger.error(f"VLAN {actual_vlan_id} is defined in the environment, but not in the source of truth. The subnet will need to be manually deleted from the environment.")
+
+        return reasons
+
+
+class DriftDetectorRegistry:
+    """Drift detectors of the cluster watcher, run by increasing cost."""
+
+    def __init__(self, detectors: List[DriftDetector] = ()):
+        self.detectors: List[DriftDetector] = []
+        for detector in detectors:
+            self.register(detector)
+
+    def register(self, detector: DriftDetector):
+        self.detectors.append(detector)
+        # stable sort, detectors of the same cost keep their registration order
+        self.detectors.sort(key=lambda d: d.cost)
+
+    async def detect(self, ctx: DriftContext, full_diff: bool = False) -> DriftResult:
+        """
+        Runs the detectors that apply to the store by increasing cost. Detectors of the same cost fetch
+        their remote data in parallel. Once drift is found, detectors of a higher cost are not run,
+        unless `full_diff` is set to gather every reason.
+
+        Args:
+            ctx: DriftContext of the store
+            full_diff: run every detector even when drift was already found
+        Returns:
+            DriftResult
+        Raises:
+            the fetch error of a detector with the RAISE policy
+        """
+        result = DriftResult()
+        detectors = [detector for detector in self.detectors if detector.applies(ctx)]
+
+        for cost in sorted({detector.cost for detector in detectors}):
+            if result.has_update and not full_diff:
+                break
+
+            level = [detector for detector in detectors if detector.cost == cost]
+            data = await asyncio.gather(*[detector.fetch(ctx) for detector in level], return_exceptions=True)
+
+            for detector, detector_data in zip(level, data):
+                if isinstance(detector_data, Exception):
+                    if detector.on_error == RAISE:
+                        raise detector_data
+
+                    logger.error(f"Error retrieving {detector.requires} for project: {ctx.project_id}, "
+                                 f"location: {ctx.location}, zone: {ctx.zone}")
+                    logger.error(detector_data)
+
+                    if detector.on_error == SKIP_STORE:
+                        result.error = True
+                        return result
+                    continue
+
+                result.reasons.extend(detector.compare(ctx, detector_data))
+
+        return result
+
+
+def get_default_registry() -> DriftDetectorRegistry:
+    """Returns a registry with the built-in detectors."""
+    return DriftDetectorRegistry([
+        MaintenanceWindowDetector(),
+        MaintenanceExclusionDetector(),
+        FleetLabelsDetector(),
+        SubnetDetector(),
+    ])
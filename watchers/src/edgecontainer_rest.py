@@ -0,0 +1,85 @@
+import logging
+import os
+import threading
+from typing import Dict, List
+import requests
+from requests.adapters import HTTPAdapter
+import google.auth.transport.requests
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+DEFAULT_ENDPOINT = "https://edgecontainer.googleapis.com/"
+
+# credentials are shared by every client of the process, refresh them once
+credentials_lock = threading.Lock()
+
+class EdgeContainerRestClient:
+    """
+    Minimal EdgeContainer REST client for the cluster properties the client libraries do not return yet
+    (maintenance exclusions).
+
+    Requests go through one keep-alive session with a connection pool sized for the concurrency of the
+    watcher, and the bearer token of `credentials` is reused until it expires. Every request times out
+    after `timeout` seconds, so a hung call cannot use up the time budget of the watcher.
+    """
+
+    def __init__(self, credentials, pool_size: int = 16, endpoint: str = None, timeout: float = 10):
+        self.credentials = credentials
+        self.timeout = timeout
+        self.endpoint = (endpoint or os.environ.get("EDGE_CONTAINER_API_ENDPOINT_OVERRIDE") or DEFAULT_ENDPOINT).rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _headers(self) -> Dict[str, str]:
+        with credentials_lock:
+            if not self.credentials.valid:
+                self.credentials.refresh(google.auth.transport.requests.Request())
+            token = self.credentials.token
+
+        return {"Authorization": f"Bearer {token}"}
+
+    def get_cluster(self, cluster_name: str) -> dict:
+        """
+        Args:
+            cluster_name: full cluster name in the form of projects/<project-id>/locations/<location>/clusters/<cluster-name>
+        Returns:
+            The cluster resource
+        """
+        response = self.session.get(f"{self.endpoint}/v1/{cluster_name}", headers=self._headers(),
+                                    timeout=self.timeout)
+
+        if response.status_code != 200:
+            raise Exception(f"Unable to query for cluster with status code ({response.status_code})")
+
+        return response.json()
+
+    def list_clusters(self, project_id: str, location: str) -> List[dict]:
+        """
+        Args:
+            project_id: project of the clusters
+            location: location of the clusters
+        Returns:
+            Every cluster resource of the location, across all pages
+        """
+        clusters = []
+        params = {}
+
+        while True:
+            response = self.session.get(f"{self.endpoint}/v1/projects/{project_id}/locations/{location}/clusters",
+                                        headers=self._headers(), params=params, timeout=self.timeout)
+
+            if response.status_code != 200:
+                raise Exception(f"Unable to list clusters with status code ({response.status_code})")
+
+            page = response.json()
+            clusters.extend(page.get("clusters", []))
+
+            if not page.get("nextPageToken"):
+                return clusters
+            params = {"pageToken": page["nextPageToken"]}
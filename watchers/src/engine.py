@@ -0,0 +1,189 @@
+import asyncio
+import inspect
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# API names used to group calls for concurrency limits
+EDGE_CONTAINER = 'edgecontainer'
+EDGE_NETWORK = 'edgenetwork'
+GKE_HUB = 'gkehub'
+HARDWARE_MANAGEMENT = 'hardwaremanagement'
+CLOUD_BUILD = 'cloudbuild'
+MONITORING = 'monitoring'
+REST = 'rest'
+
+class AsyncEngine:
+    """
+    Runs the I/O phases of a watcher invocation on an asyncio event loop.
+
+    The loop runs on a background thread for the lifetime of the engine, so the watchers keep their
+    synchronous decision logic and hand whole phases (e.g. listing every location) to the loop with
+    `run`. Async GAPIC clients must be created on the loop with `create` and are awaited directly;
+    blocking callables (sync clients, requests) run on the engine's thread pool.
+
+    Every call is made under a per-API semaphore, so one slow or throttled API cannot take all of the
+    concurrency. APIs without an explicit limit use `default_limit`.
+
+    Usage:
+        with AsyncEngine({'edgecontainer': 8}) as engine:
+            client = engine.create(edgecontainer.EdgeContainerAsyncClient)
+            machines = engine.run(engine.list('edgecontainer', client.list_machines, req))
+    """
+
+    def __init__(self, limits: Dict[str, int] = None, default_limit: int = 16):
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.loop: asyncio.AbstractEventLoop = None
+        self.thread: threading.Thread = None
+        self.executor: ThreadPoolExecutor = None
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        if self.loop is not None:
+            return
+
+        # blocking calls are bounded by the semaphores, size the pool so it is never the bottleneck
+        self.executor = ThreadPoolExecutor(max_workers=max([self.default_limit, *self.limits.values()]))
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='watcher-engine', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.loop is None:
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.semaphores = {}
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the engine loop and blocks until it completes.
+
+        Args:
+            coro: coroutine to run
+        Returns:
+            The result of the coroutine
+        """
+        self.start()
+
+        if threading.current_thread() is self.thread:
+            raise Exception('AsyncEngine.run cannot be called from the engine loop, await the coroutine instead')
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def run_all(self, *coros):
+        """
+        Runs coroutines concurrently on the engine loop and blocks until all complete.
+
+        Returns:
+            A list with the result of every coroutine, in order
+        """
+        async def gather():
+            return await asyncio.gather(*coros)
+
+        return self.run(gather())
+
+    def create(self, factory, *args, **kwargs):
+        """
+        Calls `factory` on the engine loop. Async GAPIC clients bind to the loop they are created on,
+        so they must be created through this method.
+        """
+        async def create():
+            return factory(*args, **kwargs)
+
+        return self.run(create())
+
+    def _semaphore(self, api: str) -> asyncio.Semaphore:
+        if api not in self.semaphores:
+            self.semaphores[api] = asyncio.Semaphore(self.limits.get(api, self.default_limit))
+
+        return self.semaphores[api]
+
+    async def call(self, api: str, fn, *args, **kwargs):
+        """
+        Calls `fn` under the concurrency limit of `api`. Coroutine functions are awaited, any other
+        callable runs on the engine's thread pool.
+
+        Args:
+            api: API name used for the concurrency limit
+            fn: function to call
+        Returns:
+            The result of the call
+        """
+        async with self._semaphore(api):
+            if inspect.iscoroutinefunction(fn):
+                return await fn(*args, **kwargs)
+
+            return await asyncio.get_running_loop().run_in_executor(None, lambda: fn(*args, **kwargs))
+
+    async def list(self, api: str, fn, *args, out=None, **kwargs):
+        """
+        Calls a paginated list method under the concurrency limit of `api` and collects every item.
+        Both async pagers (async GAPIC clients) and sync pagers are supported.
+
+        Args:
+            api: API name used for the concurrency limit
+            fn: list method to call
+            out: optional list, or any object with an `append` method, the items are appended to as they
+                arrive, so items retrieved before a failure are kept by the caller
+        Returns:
+            `out`, or a new list of the items
+        """
+        items = out if out is not None else []
+
+        async with self._semaphore(api):
+            if inspect.iscoroutinefunction(fn):
+                pager = await fn(*args, **kwargs)
+                async for item in pager:
+                    items.append(item)
+            else:
+                def drain():
+                    for item in fn(*args, **kwargs):
+                        items.append(item)
+
+                await asyncio.get_running_loop().run_in_executor(None, drain)
+
+        return items
+
+
+def parse_api_limits(value: str) -> Dict[str, int]:
+    """
+    Parses per-API concurrency limits in the form of "edgecontainer=8,cloudbuild=4".
+
+    Args:
+        value: limits string, may be empty
+    Returns:
+        A dictionary with the API name as the key and the limit as the value
+    """
+    limits = {}
+
+    if not value:
+        return limits
+
+    for limit in value.split(','):
+        kv_pair = limit.split('=')
+        if len(kv_pair) != 2 or int(kv_pair[1]) < 1:
+            raise Exception(f'invalid api concurrency limit: {limit}')
+        limits[kv_pair[0].strip()] = int(kv_pair[1])
+
+    return limits
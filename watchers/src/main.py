@@ -12,17 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import fnmatch
 import functions_framework
 import os
 import io
 import flask
-import csv
 import logging
 import requests
 import google_crc32c
+import asyncio
+import json
+import posixpath
 from requests.structures import CaseInsensitiveDict
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 from google.api_core import client_options, exceptions
 import google.auth
 import google.auth.transport.requests
@@ -35,15 +40,49 @@ from google.cloud.gdchardwaremanagement_v1alpha import Zone
 from google.cloud.devtools import cloudbuild
 from google.cloud import monitoring_v3
 from google.protobuf.timestamp_pb2 import Timestamp
-from dateutil.parser import parse
-from .maintenance_windows import MaintenanceExclusionWindow
 from .build_history import BuildHistory
+from .capacity import ZoneCapacityIndex
+from .clusters import ClusterIndex
+from .desired_state import DesiredClusterState, evict_desired_states, get_desired_states
+from .drift import DriftContext, get_default_registry
+from .edgecontainer_rest import EdgeContainerRestClient
+from .source_of_truth import (CachedSourceOfTruth, SourceOfTruthCache, SourceOfTruthSnapshot,
+                              SourceOfTruthSnapshotCache, SourceOfTruthStream, get_shards_hash, iter_lines,
+                              merge_shards)
+from .metrics import MetricEmissionState, TimeSeriesWriter, get_zone_active_count_series
+from .engine import AsyncEngine, EDGE_CONTAINER, GKE_HUB, REST, parse_api_limits
+from . import reconcile
+from .reconcile import ReconcileState
+from .schedule import Deadline, StoreSchedule, order_stores
+from .sharding import (HASH_STRATEGY, LOCATION_STRATEGY, SHARD_RESPONSE_MARGIN, HttpShardDispatcher, Shard,
+                       WatcherResult, aggregate_shard_results, get_shard_count, plan_shards, select_shard)
+from .state_store import get_state_store
+from .triggers import BuildTriggerDispatcher, TriggerRequest
+from .zones import ZoneIndex, ZoneNameCache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
 
 creds, auth_project = google.auth.default()
 
+# source of truth columns used by each function
+ZONE_WATCHER_COLUMNS = ('store_id', 'zone_name', 'machine_project_id', 'location', 'cluster_name', 'node_count',
+                        'recreate_on_delete', 'sync_branch')
+CLUSTER_WATCHER_COLUMNS = ('store_id', 'zone_name', 'machine_project_id', 'fleet_project_id', 'location',
+                           'cluster_name', 'sync_branch', 'maintenance_window_start', 'maintenance_window_end',
+                           'maintenance_window_recurrence', 'maintenance_exclusion_*', 'subnet_vlans', 'labels')
+ZONE_ACTIVE_METRIC_COLUMNS = ('store_id', 'fleet_project_id', 'machine_project_id', 'location', 'cluster_name',
+                              'cluster_version')
+# size of the chunks read from the source of truth response
+SOURCE_OF_TRUTH_CHUNK_SIZE = 64 * 1024
+
+# columns of the snapshot shared by the functions
+SOURCE_OF_TRUTH_COLUMNS = tuple(dict.fromkeys(ZONE_WATCHER_COLUMNS + CLUSTER_WATCHER_COLUMNS +
+                                              ZONE_ACTIVE_METRIC_COLUMNS))
+
+# drift detectors of cluster_watcher, additional detectors can be registered at import time
+drift_detectors = get_default_registry()
+
 @dataclass
 class WatcherParameters:
     project_id: str
@@ -56,6 +95,29 @@ class WatcherParameters:
     cloud_build_trigger: str
     cloud_build_trigger_name: str
     max_retries: int
+    max_workers: int = 16
+    state_store: str = None
+    zone_name_cache_ttl: int = 86400
+    api_concurrency: Dict[str, int] = field(default_factory=dict)
+    max_shards: int = 0
+    stores_per_shard: int = 250
+    shard_strategy: str = LOCATION_STRATEGY
+    shard_dispatcher: str = 'inprocess'
+    shard_worker_url: str = None
+    incremental: bool = False
+    drift_slices: int = 6
+    trigger_rate: float = 5.0
+    trigger_burst: int = 10
+    trigger_max_attempts: int = 5
+    time_budget: float = 45
+    trigger_reserve: float = 10
+    drift_full_diff: bool = False
+    build_cooldown: float = 600
+    metric_change_only: bool = False
+    metric_heartbeat: float = 3600
+    zone_active_store_metrics: bool = True
+    zone_active_fleet_metrics: bool = True
+    sot_max_stale: float = 86400
 
 def get_parameters_from_environment():
     proj_id = os.environ.get("GOOGLE_CLOUD_PROJECT")
@@ -66,6 +128,31 @@ def get_parameters_from_environment():
     source_of_truth_branch = os.environ.get("SOURCE_OF_TRUTH_BRANCH")
     source_of_truth_path = os.environ.get("SOURCE_OF_TRUTH_PATH")
     max_retries = int(os.environ.get("MAX_RETRIES", "0"))
+    max_workers = int(os.environ.get("MAX_WORKERS", "16"))
+    state_store = os.environ.get("STATE_STORE")
+    zone_name_cache_ttl = int(os.environ.get("ZONE_NAME_CACHE_TTL_SECONDS", "86400"))
+    api_concurrency = parse_api_limits(os.environ.get("API_CONCURRENCY"))
+    max_shards = int(os.environ.get("MAX_SHARDS", "0"))
+    stores_per_shard = int(os.environ.get("STORES_PER_SHARD", "250"))
+    shard_strategy = os.environ.get("SHARD_STRATEGY", LOCATION_STRATEGY)
+    # shards only fan out with http, which requires the deployment to allow the function to invoke itself,
+    # see HttpShardDispatcher. inprocess runs every store in this invocation, MAX_SHARDS is ignored
+    shard_dispatcher = os.environ.get("SHARD_DISPATCHER", "inprocess")
+    shard_worker_url = os.environ.get("SHARD_WORKER_URL")
+    incremental = os.environ.get("INCREMENTAL_RECONCILE", "false").lower() == "true"
+    drift_slices = int(os.environ.get("DRIFT_SLICES", "6"))
+    trigger_rate = float(os.environ.get("TRIGGER_RATE", "5"))
+    trigger_burst = int(os.environ.get("TRIGGER_BURST", "10"))
+    trigger_max_attempts = int(os.environ.get("TRIGGER_MAX_ATTEMPTS", "5"))
+    time_budget = float(os.environ.get("TIME_BUDGET_SECONDS", "45"))
+    trigger_reserve = float(os.environ.get("TRIGGER_RESERVE_SECONDS", "10"))
+    drift_full_diff = os.environ.get("DRIFT_FULL_DIFF", "false").lower() == "true"
+    build_cooldown = float(os.environ.get("BUILD_COOLDOWN_SECONDS", "600"))
+    metric_change_only = os.environ.get("METRIC_CHANGE_ONLY", "false").lower() == "true"
+    metric_heartbeat = float(os.environ.get("METRIC_HEARTBEAT_SECONDS", "3600"))
+    zone_active_store_metrics = os.environ.get("ZONE_ACTIVE_STORE_METRICS", "true").lower() == "true"
+    zone_active_fleet_metrics = os.environ.get("ZONE_ACTIVE_FLEET_METRICS", "true").lower() == "true"
+    sot_max_stale = float(os.environ.get("SOT_MAX_STALE_SECONDS", "86400"))
 
     cb_trigger = f'projects/{proj_id}/locations/{region}/triggers/{os.environ.get("CB_TRIGGER_NAME")}'
     cb_trigger_name = os.environ.get("CB_TRIGGER_NAME")
@@ -93,6 +180,38 @@ def get_parameters_from_environment():
         raise Exception('provide repo in the form of (github.com/org_name/repo_name) or (gitlab.com/org_name/repo_name)')
     if max_retries < 0 or max_retries > 5:
         raise Exception('max retries must be a value between 0 and 5')
+    if max_workers < 1:
+        raise Exception('max workers must be a value greater than 0')
+    if zone_name_cache_ttl < 0:
+        raise Exception('zone name cache ttl must not be negative')
+    if max_shards < 0:
+        raise Exception('max shards must not be negative')
+    if stores_per_shard < 1:
+        raise Exception('stores per shard must be a value greater than 0')
+    if shard_strategy not in (LOCATION_STRATEGY, HASH_STRATEGY):
+        raise Exception(f'shard strategy must be one of ({LOCATION_STRATEGY}, {HASH_STRATEGY})')
+    if shard_dispatcher not in ('http', 'inprocess'):
+        raise Exception('shard dispatcher must be one of (http, inprocess)')
+    if drift_slices < 1:
+        raise Exception('drift slices must be a value greater than 0')
+    if trigger_rate <= 0:
+        raise Exception('trigger rate must be a value greater than 0')
+    if trigger_burst < 1:
+        raise Exception('trigger burst must be a value greater than 0')
+    if trigger_max_attempts < 1:
+        raise Exception('trigger max attempts must be a value greater than 0')
+    if time_budget <= 0:
+        raise Exception('time budget must be a value greater than 0')
+    if trigger_reserve < 0 or trigger_reserve >= time_budget:
+        raise Exception('trigger reserve must be a value between 0 and the time budget')
+    if build_cooldown < 0:
+        raise Exception('build cool-down must not be negative')
+    if metric_heartbeat <= 0:
+        raise Exception('metric heartbeat must be a value greater than 0')
+    if not zone_active_store_metrics and not zone_active_fleet_metrics:
+        raise Exception('at least one of the per-store or fleet zone active metrics must be enabled')
+    if sot_max_stale < 0:
+        raise Exception('source of truth max stale must not be negative')
 
     return WatcherParameters(
         project_id=proj_id,
@@ -104,349 +223,400 @@ def get_parameters_from_environment():
         source_of_truth_repo=source_of_truth_repo,
         source_of_truth_branch=source_of_truth_branch,
         source_of_truth_path=source_of_truth_path,
-        max_retries=max_retries
+        max_retries=max_retries,
+        max_workers=max_workers,
+        state_store=state_store,
+        zone_name_cache_ttl=zone_name_cache_ttl,
+        api_concurrency=api_concurrency,
+        max_shards=max_shards,
+        stores_per_shard=stores_per_shard,
+        shard_strategy=shard_strategy,
+        shard_dispatcher=shard_dispatcher,
+        shard_worker_url=shard_worker_url,
+        incremental=incremental,
+        drift_slices=drift_slices,
+        trigger_rate=trigger_rate,
+        trigger_burst=trigger_burst,
+        trigger_max_attempts=trigger_max_attempts,
+        time_budget=time_budget,
+        trigger_reserve=trigger_reserve,
+        drift_full_diff=drift_full_diff,
+        build_cooldown=build_cooldown,
+        metric_change_only=metric_change_only,
+        metric_heartbeat=metric_heartbeat,
+        zone_active_store_metrics=zone_active_store_metrics,
+        zone_active_fleet_metrics=zone_active_fleet_metrics,
+        sot_max_stale=sot_max_stale
     )
 
 
 @functions_framework.http
 def zone_watcher(req: flask.Request):
     params = get_parameters_from_environment()
+    deadline = Deadline(params.time_budget)
 
     logger.info(f'Running zone watcher for: proj_id={params.project_id},sot={params.source_of_truth_repo}/{params.source_of_truth_branch}/{params.source_of_truth_path}, cb_trigger={params.cloud_build_trigger}')
     
     config_zone_info = read_intent_data(params, 'machine_project_id')
+    evict_desired_states(config_zone_info)
+
+    with get_engine(params) as engine:
+        return run_watcher(req, params, engine, config_zone_info,
+                           lambda zone_info, schedule: run_zone_watcher(params, engine, zone_info, schedule),
+                           'zone_watcher', deadline)
 
-    edgecontainer_api_endpoint_override = os.environ.get("EDGE_CONTAINER_API_ENDPOINT_OVERRIDE")
-    if edgecontainer_api_endpoint_override:
-        op = client_options.ClientOptions(api_endpoint=urlparse(edgecontainer_api_endpoint_override).netloc)
-        ec_client = edgecontainer.EdgeContainerClient(client_options=op)
-    else:  # use the default prod endpoint
-        ec_client = edgecontainer.EdgeContainerClient()
-    cb_client = cloudbuild.CloudBuildClient()
+
+def run_zone_watcher(params: WatcherParameters, engine: AsyncEngine, config_zone_info,
+                     schedule: StoreSchedule = None) -> WatcherResult:
+    if schedule is None:
+        schedule = StoreSchedule.from_zone_info(config_zone_info)
+
+    ec_client = engine.create(get_client, edgecontainer.EdgeContainerAsyncClient, "EDGE_CONTAINER_API_ENDPOINT_OVERRIDE")
+    dispatcher = get_trigger_dispatcher(params, engine)
 
     builds = BuildHistory(params.project_id, params.region, params.max_retries, params.cloud_build_trigger_name)
 
-    # get machines list per machine_project per location, and group by GDCE zone
-    machine_lists = {}
-    unprocessed_zones = {} # used to track zones outside of SoT.
-    for (machine_project, location) in config_zone_info:
-        req = edgecontainer.ListMachinesRequest(
-            parent=ec_client.common_location_path(machine_project, location)
-        )
-        
-        try:
-            res_pager = ec_client.list_machines(req)
-            for m in res_pager:
-                if m.zone not in machine_lists:
-                    machine_lists[m.zone] = [m]
-                    unprocessed_zones[m.zone] = (machine_project, location)
-                else:
-                    machine_lists[m.zone].append(m)
-        except Exception as err:
-            logger.error(f"Error listing machines for project: {machine_project}, location: {location}")
-            logger.error(err)
+    zone_index = get_zone_index(params, engine)
+    desired_states = get_desired_states(config_zone_info)
+
+    # get machines list per machine_project per location, and group by GDCE zone. The zones of every
+    # location with stores that need their zone name resolved are indexed at the same time.
+    (zone_capacity, unprocessed_zones), _ = engine.run_all(
+        list_machines_by_zone(engine, ec_client, config_zone_info),
+        zone_index.fetch(get_zone_locations(config_zone_info, zone_index)))
 
     # if cluster already present in the zone, skip this zone unless the zone build should be retried
     # method: check all the machines in the zone, and check if "hosted_node" has any value in it
     count = 0
-    for proj_loc_key in config_zone_info:
+    outcomes = {}
+    store_locations = {}
+    for proj_loc_key, store_id in schedule:
         (machine_project, location) = proj_loc_key
+        desired = desired_states[store_id]
 
-        for store_id in config_zone_info[proj_loc_key]:
-            store_info = config_zone_info[proj_loc_key][store_id]
+        zone_store_id = f'projects/{machine_project}/locations/{location}/zones/{store_id}'
+        try:
+            if desired.zone_name:
+                zone = desired.zone_name
+                zone_name_retrieved_from_api = False
+            else:
+                zone = get_zone_name(zone_store_id, zone_index)
+                zone_name_retrieved_from_api = True
+        except:
+            logger.error(f'Zone for store {store_id} cannot be found, skipping.', exc_info=True)
+            outcomes[store_id] = (reconcile.ERROR, None)
+            continue
+        
+        capacity = zone_capacity.get(zone)
+        if capacity is None:
+            logger.warning(f'No machine found in zone {zone}')
+            outcomes[store_id] = (reconcile.NO_MACHINES, zone)
+            continue
 
-            zone_store_id = f'projects/{machine_project}/locations/{location}/zones/{store_id}'
-            try:
-                if store_info['zone_name']:
-                    zone = store_info['zone_name']
-                    zone_name_retrieved_from_api = False
-                else:
-                    zone = get_zone_name(zone_store_id)
-                    zone_name_retrieved_from_api = True
-            except:
-                logger.error(f'Zone for store {store_id} cannot be found, skipping.', exc_info=True)
-                continue
-            
-            if zone not in machine_lists:
-                logger.warning(f'No machine found in zone {zone}')
-                continue
+        unprocessed_zones.pop(zone)
+        count_of_free_machines = capacity.free_nodes
+        # check if target cluster already exists
+        cluster_exists = desired.cluster_name in capacity.hosted_clusters
+        logger.info(f'ZONE {zone}: {capacity.free_nodes} of {capacity.total_nodes} nodes are free, '
+                    f'hosted clusters: {sorted(capacity.hosted_clusters)}')
 
-            count_of_free_machines = 0
-            cluster_exists = False
-            unprocessed_zones.pop(zone)
-            for m in machine_lists[zone]:
-                if len(m.hosted_node.strip()) > 0:  # if there is any value, consider there is a cluster
-                    # check if target cluster already exists
-                    if (m.hosted_node.split('/')[5] == store_info['cluster_name']):
-                        cluster_exists = True
-                        break
-
-                    logger.info(f'ZONE {zone}: {m.name} already used by {m.hosted_node}')
-                else:
-                    logger.info(f'ZONE {zone}: {m.name} is a free node')
-                    count_of_free_machines = count_of_free_machines+1
-
-            if cluster_exists and not builds.should_retry_zone_build(zone):
-                logger.info(f'Cluster already exists for {zone}. Skipping..')
-                continue
+        if cluster_exists and not builds.should_retry_zone_build(zone):
+            logger.info(f'Cluster already exists for {zone}. Skipping..')
+            outcomes[store_id] = (reconcile.IN_SYNC, zone)
+            continue
 
-            if count_of_free_machines >= int(store_info["node_count"]):
-                logger.info(f'ZONE {zone}: There are enough free  nodes to create cluster')
-            else:
-                logger.info(f'ZONE {zone}: Not enough free  nodes to create cluster. Need {str(store_info["node_count"])} but have {str(count_of_free_machines)} free nodes')
-                if not builds.should_retry_zone_build(zone):
-                    continue
+        if desired.node_count is None:
+            logger.error(f'ZONE {zone}: node_count of store {store_id} is not a valid number, skipping.')
+            outcomes[store_id] = (reconcile.ERROR, zone)
+            continue
 
-            if zone_name_retrieved_from_api and not verify_zone_state(zone_store_id, store_info['recreate_on_delete']):
-                logger.info(f'Zone: {zone}, Store: {store_id} is not in expected state! skipping..')
+        if count_of_free_machines >= desired.node_count:
+            logger.info(f'ZONE {zone}: There are enough free  nodes to create cluster')
+        else:
+            logger.info(f'ZONE {zone}: Not enough free  nodes to create cluster. Need {str(desired.node_count)} but have {str(count_of_free_machines)} free nodes')
+            if not builds.should_retry_zone_build(zone):
+                outcomes[store_id] = (reconcile.NOT_ENOUGH_NODES, zone)
                 continue
 
-            # trigger cloudbuild to initiate the cluster building
-            repo_source = cloudbuild.RepoSource()
-            repo_source.branch_name = store_info['sync_branch']
-            repo_source.substitutions = {
-                "_STORE_ID": store_id,
-                "_ZONE": zone
-            }
-            req = cloudbuild.RunBuildTriggerRequest(
-                name=params.cloud_build_trigger,
-                source=repo_source
-            )
-            logger.debug(req)
-            try:
-                logger.info(f'triggering cloud build for {zone}')
-                logger.info(f'trigger: {params.cloud_build_trigger}')
-                opr = cb_client.run_build_trigger(request=req)
-                # response = opr.result()
-            except Exception as err:
-                logger.error(err)
+        if zone_name_retrieved_from_api and not verify_zone_state(zone_store_id, desired.recreate_on_delete, zone_index):
+            logger.info(f'Zone: {zone}, Store: {store_id} is not in expected state! skipping..')
+            outcomes[store_id] = (reconcile.ZONE_NOT_READY, zone)
+            continue
+
+        # queue cloudbuild to initiate the cluster building
+        dispatcher.submit(TriggerRequest(store_id, zone, desired.sync_branch))
+        store_locations[store_id] = proj_loc_key
+
+        count += len(config_zone_info[proj_loc_key])
+
+    deferred = list(schedule.deferred)
+    for result in dispatcher.dispatch(schedule.deadline):
+        if result.deferred:
+            deferred.append(result.request.store_id)
+            count -= len(config_zone_info[store_locations[result.request.store_id]])
+            continue
 
-            count += len(config_zone_info[proj_loc_key])
+        outcomes[result.request.store_id] = (reconcile.TRIGGERED if result.success else reconcile.ERROR,
+                                             result.request.zone)
 
     logger.info(f'total zones triggered = {count}')
 
-    for zone, (machine_project, location) in unprocessed_zones.items():
-        logger.info(f'Zone found in environment but not in cluster source of truth. "projects/{machine_project}/locations/{location}/zones/{zone}"')
+    save_zone_index(zone_index)
 
-    return f'total zones triggered = {count}'
+    return WatcherResult(count, unprocessed_zones, outcomes, deferred)
 
 
 @functions_framework.http
 def cluster_watcher(req: flask.Request):
     params = get_parameters_from_environment()
+    deadline = Deadline(params.time_budget)
 
     logger.info(f'proj_id = {params.project_id}')
     logger.info(f'cb_trigger = {params.cloud_build_trigger}')
 
     config_zone_info = read_intent_data(params, 'fleet_project_id')
+    evict_desired_states(config_zone_info)
 
-    edgecontainer_api_endpoint_override = os.environ.get("EDGE_CONTAINER_API_ENDPOINT_OVERRIDE")
-    edgenetwork_api_endpoint_override = os.environ.get("EDGE_NETWORK_API_ENDPOINT_OVERRIDE")
-    gkehub_api_endpoint_override = os.environ.get("GKEHUB_API_ENDPOINT_OVERRIDE")
+    with get_engine(params) as engine:
+        return run_watcher(req, params, engine, config_zone_info,
+                           lambda zone_info, schedule: run_cluster_watcher(params, engine, zone_info, schedule),
+                           'cluster_watcher', deadline)
 
-    if edgecontainer_api_endpoint_override:
-        op = client_options.ClientOptions(api_endpoint=urlparse(edgecontainer_api_endpoint_override).netloc)
-        ec_client = edgecontainer.EdgeContainerClient(client_options=op)
-    else:  # use the default prod endpoint
-        ec_client = edgecontainer.EdgeContainerClient()
 
-    if edgenetwork_api_endpoint_override:
-        op = client_options.ClientOptions(api_endpoint=urlparse(edgenetwork_api_endpoint_override).netloc)
-        en_client = edgenetwork.EdgeNetworkClient(client_options=op)
-    else:  # use the default prod endpoint
-        en_client = edgenetwork.EdgeNetworkClient()
+def run_cluster_watcher(params: WatcherParameters, engine: AsyncEngine, config_zone_info,
+                        schedule: StoreSchedule = None) -> WatcherResult:
+    if schedule is None:
+        schedule = StoreSchedule.from_zone_info(config_zone_info)
 
-    if gkehub_api_endpoint_override:
-        op = client_options.ClientOptions(api_endpoint=urlparse(gkehub_api_endpoint_override).netloc)
-        gkehub_client = gkehub_v1.GkeHubClient(client_options=op)
-    else:  # use the default prod endpoint
-        gkehub_client = gkehub_v1.GkeHubClient()
+    ec_client = engine.create(get_client, edgecontainer.EdgeContainerAsyncClient, "EDGE_CONTAINER_API_ENDPOINT_OVERRIDE")
+    en_client = get_client(edgenetwork.EdgeNetworkClient, "EDGE_NETWORK_API_ENDPOINT_OVERRIDE")
+    gkehub_client = get_client(gkehub_v1.GkeHubClient, "GKEHUB_API_ENDPOINT_OVERRIDE")
+    rest_client = EdgeContainerRestClient(creds, params.max_workers)
+    dispatcher = get_trigger_dispatcher(params, engine)
 
-    cb_client = cloudbuild.CloudBuildClient()
+    builds = BuildHistory(params.project_id, params.region, params.max_retries, params.cloud_build_trigger_name)
+
+    zone_index = get_zone_index(params, engine)
+    desired_states = get_desired_states(config_zone_info)
+
+    # Get all the clusters in every location, the GDCE Zone info is in "control_plane"
+    # maintain window info is in "maintenance_policy.window". The maintenance policies of every location
+    # with maintenance windows in the source of truth come from the same listing. The zones of every location
+    # with stores that need their zone name resolved are indexed, and the fleet memberships of every project
+    # with labels in the source of truth are listed, at the same time.
+    (location_clusters, location_policies), _, project_memberships = engine.run_all(
+        list_clusters_by_location(engine, ec_client, config_zone_info, rest_client,
+                                  get_maintenance_window_locations(config_zone_info)),
+        zone_index.fetch(get_zone_locations(config_zone_info, zone_index)),
+        list_memberships_by_project(engine, gkehub_client, get_label_projects(config_zone_info)))
 
     count = 0
-    for proj_loc_key in config_zone_info:
+    outcomes = {}
+    store_locations = {}  # location of the stores with a queued trigger
+    pending = []  # stores with a cluster, waiting for their drift check
+    for proj_loc_key, store_id in schedule:
         (project_id, location) = proj_loc_key
+        desired = desired_states[store_id]
 
-        # Get all the clusters in the location,
-        # the GDCE Zone info is in "control_plane"
-        # maintain window info is in "maintenance_policy.window"
-        req_c = edgecontainer.ListClustersRequest(
-            parent=ec_client.common_location_path(project_id, location)
-        )
-        
+        clusters = location_clusters[proj_loc_key]  # all the clusters in the location, by zone
+        if clusters is None:
+            continue
+
+        zone_store_id = f'projects/{desired.machine_project_id}/locations/{location}/zones/{store_id}'
         try:
-            res_pager_c = ec_client.list_clusters(req_c)
-            clusters = [c for c in res_pager_c]  # all the clusters in the location
-        except Exception as err:
-            logger.error(f"Error listing clusters for project: {project_id}, location: {location}")
-            logger.error(err)
+            if desired.zone_name:
+                zone = desired.zone_name
+            else:
+                zone = get_zone_name(zone_store_id, zone_index)
+        except:
+            logger.error(f'Zone for store {store_id} cannot be found, skipping.', exc_info=True)
+            outcomes[store_id] = (reconcile.ERROR, None)
             continue
 
-        for store_id in config_zone_info[proj_loc_key]:
-            store_info = config_zone_info[proj_loc_key][store_id]
+        # the clusters in the GDCE zone, should be at most 1
+        zone_cluster_list = clusters.get(zone)
+        if len(zone_cluster_list) == 0:
+            logger.warning(f'No lcp cluster found in {zone}')
+            outcomes[store_id] = (reconcile.NO_CLUSTER, zone)
+            continue
+        elif zone in clusters.multi_cluster_zones:
+            logger.warning(f'More than 1 lcp clusters found in {zone}')
+        logger.debug(zone_cluster_list)
+        pending.append((proj_loc_key, store_id, zone, zone_cluster_list[0]))
+
+    # run the drift checks of the stores concurrently, stores that cannot start before the deadline are deferred
+    deferred = set()
+
+    async def check_stores():
+        window = asyncio.Semaphore(params.max_workers)
+
+        async def check_store(proj_loc_key, store_id, zone, cluster):
+            async with window:
+                if schedule.expired():
+                    deferred.add(store_id)
+                    return None
+
+                (project_id, location) = proj_loc_key
+                try:
+                    return await check_cluster_drift(engine, en_client, gkehub_client, project_id, location, zone,
+                                                      cluster, config_zone_info[proj_loc_key][store_id],
+                                                      project_memberships.get(project_id),
+                                                      rest_client, location_policies.get(proj_loc_key),
+                                                      params.drift_full_diff, desired_states[store_id])
+                except Exception:
+                    # an error of one store must not prevent the triggers of the others
+                    logger.error(f'Unable to check the cluster of store {store_id} for drift, skipping.', exc_info=True)
+                    return None
+
+        return await asyncio.gather(*[check_store(*store) for store in pending])
+
+    try:
+        store_updates = engine.run(check_stores())
+    finally:
+        rest_client.close()
+
+    # the drift may be what a queued or just finished build is fixing, don't queue duplicate builds
+    drift_zones = {zone for (_, _, zone, _), has_update in zip(pending, store_updates) if has_update}
+    active_zones = get_active_build_zones(builds, drift_zones, params.build_cooldown)
+
+    for (proj_loc_key, store_id, zone, _), has_update in zip(pending, store_updates):
+        if store_id in deferred:
+            continue
 
-            machine_project_id = store_info['machine_project_id']
-            zone_store_id = f'projects/{machine_project_id}/locations/{location}/zones/{store_id}'
-            try:
-                if store_info['zone_name']:
-                    zone = store_info['zone_name']
-                else:
-                    zone = get_zone_name(zone_store_id)
-            except:
-                logger.error(f'Zone for store {store_id} cannot be found, skipping.', exc_info=True)
-                continue
+        if has_update is None:
+            outcomes[store_id] = (reconcile.ERROR, zone)
+            continue
 
-            # filter the cluster in the GDCE zone, should be at most 1
-            zone_cluster_list = [c for c in clusters if c.control_plane.local.node_location
-                                 == zone]
-            if len(zone_cluster_list) == 0:
-                logger.warning(f'No lcp cluster found in {zone}')
-                continue
-            elif len(zone_cluster_list) > 1:
-                logger.warning(f'More than 1 lcp clusters found in {zone}')
-            logger.debug(zone_cluster_list)
-            rw = zone_cluster_list[0].maintenance_policy.window.recurring_window  # cluster in this GDCE zone
-            # Validate the start_time, end_time and rrule string of the maintenance window
-            has_update = False
-
-            if (not store_info['maintenance_window_recurrence'] or
-                not store_info['maintenance_window_start'] or
-                not store_info['maintenance_window_end']
-                ):
-                # One of the MW properties is not set, so assume no update needs to be made
-                has_update = False
-            elif (rw.recurrence != store_info['maintenance_window_recurrence'] or
-                    rw.window.start_time != parse(store_info['maintenance_window_start']) or
-                    rw.window.end_time != parse(store_info['maintenance_window_end'])):
-                logger.info("Maintenance window requires update")
-                logger.info(f"Actual values (recurrence={rw.recurrence}, start_time={rw.window.start_time}, end_time={rw.window.end_time})")
-                logger.info(f"Desired values (recurrence={store_info['maintenance_window_recurrence']}, start_time={store_info['maintenance_window_start']}, end_time={store_info['maintenance_window_end']})")
-                has_update = True
-            else:
-                # MW properties haven't changed, check exclusion windows
-                defined_exclusion_windows = MaintenanceExclusionWindow.get_exclusion_windows_from_sot(store_info)
+        if not has_update:
+            outcomes[store_id] = (reconcile.IN_SYNC, zone)
+            continue
 
-                # Retrieving maintenance window from API until property exists in client library response
-                mw = get_maintenance_window_property(zone_cluster_list[0].name)
-                actual_exclusion_windows = MaintenanceExclusionWindow.get_exclusion_windows_from_api_response(mw)
+        if zone in active_zones:
+            logger.info(f'Cluster in {zone} has a build in progress or within its cool-down period. Skipping..')
+            outcomes[store_id] = (reconcile.BUILD_IN_PROGRESS, zone)
+            continue
 
-                if defined_exclusion_windows != actual_exclusion_windows:
-                    has_update = True
+        # queue cloudbuild to initiate the cluster updating
+        dispatcher.submit(TriggerRequest(store_id, zone, desired_states[store_id].sync_branch))
+        store_locations[store_id] = proj_loc_key
 
-            # get subnet vlan ids and ip addresses of this GDCE Zone
-            req_n = edgenetwork.ListSubnetsRequest(
-                parent=f'{en_client.common_location_path(store_info["machine_project_id"], location)}/zones/{zone}'
-            )
+    for result in dispatcher.dispatch(schedule.deadline):
+        store_id = result.request.store_id
+        if result.deferred:
+            deferred.add(store_id)
+            continue
 
-            try:
-                res_pager_n = en_client.list_subnets(req_n)
-                subnet_list = [{'vlan_id': net.vlan_id, 'ipv4_cidr': sorted(net.ipv4_cidr)} for net in res_pager_n]
-            except Exception as err:
-                logger.error(f"Error listing subnets for project: {project_id}, location: {location}, zone: {zone}")
-                logger.error(err)
-                continue
-                
-            subnet_list.sort(key=lambda x: x['vlan_id'])
-            logger.debug(subnet_list)
-            try:
-                # Only consider vlan ids for updates (L2), L3 not handled
-                for desired_subnet in store_info['subnet_vlans'].split(','):
-                    try:
-                        vlan_id = int(desired_subnet)
-                    except Exception as err:
-                        logger.error("unable to convert vlan to an int", err)
-
-                    if vlan_id not in [n['vlan_id'] for n in subnet_list]:
-                        logger.info(f"No vlan created for vlan: {vlan_id}")
-                        has_update = True
-
-                for actual_vlan_id in [n['vlan_id'] for n in subnet_list]:
-                    if actual_vlan_id not in [int(v) for v in store_info['subnet_vlans'].split(',')]:
-                        logger.error(f"VLAN {actual_vlan_id} is defined in the environment, but not in the source of truth. The subnet will need to be manually deleted from the environment.")
-            except Exception as err:
-                logger.error(err)
+        if not result.success:
+            outcomes[store_id] = (reconcile.ERROR, result.request.zone)
+            continue
 
-            # Check for fleet labels
-            cluster_name = store_info['cluster_name']
+        outcomes[store_id] = (reconcile.TRIGGERED, result.request.zone)
+        count += len(config_zone_info[store_locations[store_id]])
 
-            ## labels are specified in SoT in the following way: "key1=value1,key2=value2,key3=value3"
-            if "labels" in store_info:
-                labels = store_info['labels'].strip()
-            else:
-                labels = ""
+    save_zone_index(zone_index)
 
-            # if labels is not defined in SoT, then don't trigger an update
-            if labels:
-                desired_labels = {}
+    deferred_stores = schedule.deferred + [store_id for _, store_id, _, _ in pending if store_id in deferred]
 
-                for label in labels.split(","):
-                    kv_pair = label.split("=")
-                    desired_labels[kv_pair[0]] = kv_pair[1]
+    return WatcherResult(count, outcomes=outcomes, deferred=deferred_stores)
 
-                req = gkehub_v1.GetMembershipRequest(name=f"projects/{project_id}/locations/global/memberships/{cluster_name}")
-                res = gkehub_client.get_membership(request=req)
 
-                membership_labels = res.labels
+async def check_cluster_drift(engine: AsyncEngine, en_client, gkehub_client, project_id: str, location: str, zone: str,
+                              cluster, store_info, memberships: Dict[str, dict] = None,
+                              rest_client: EdgeContainerRestClient = None,
+                              maintenance_policies: Dict[str, dict] = None,
+                              full_diff: bool = False, desired: DesiredClusterState = None) -> Optional[bool]:
+    """Compares the cluster of a store with its source of truth row with the registered drift detectors.
 
-                if (desired_labels != membership_labels):
-                    has_update = True
+    Local comparisons run first and remote data is only retrieved until drift is found, unless
+    `full_diff` is set. Fleet membership labels and maintenance policies come from the prefetched
+    `memberships` and `maintenance_policies` when available.
 
-            if not has_update:
-                continue
-            # trigger cloudbuild to initiate the cluster updating
-            repo_source = cloudbuild.RepoSource()
-            repo_source.branch_name = store_info['sync_branch']
-            repo_source.substitutions = {
-                "_STORE_ID": store_id,
-                "_ZONE": zone
-            }
-            req = cloudbuild.RunBuildTriggerRequest(
-                name=params.cloud_build_trigger,
-                source=repo_source
-            )
-            logger.debug(req)
-            try:
-                logger.info(f'triggering cloud build for {zone}')
-                logger.info(f'trigger: {params.cloud_build_trigger}')
-                opr = cb_client.run_build_trigger(request=req)
-            except Exception as err:
-                logger.error(f'failed to trigger cloud build for {zone}')
-                logger.error(err)
-                continue
+    Args:
+      engine: AsyncEngine running the calls
+      en_client: EdgeNetwork client
+      gkehub_client: GkeHub client, only used when the memberships of the project could not be listed
+      project_id: fleet project of the store
+      location: location of the store
+      zone: GDCE zone of the store
+      cluster: edgecontainer Cluster of the store
+      store_info: source of truth row of the store
+      memberships: labels of every membership of the fleet project by membership id, as returned by
+        list_memberships_by_project, None to get the membership of the store instead
+      rest_client: EdgeContainerRestClient used to get the maintenance policy of clusters missing from
+        `maintenance_policies`
+      maintenance_policies: maintenance policies of the clusters of the location by cluster name, as
+        returned by list_clusters_by_location
+      full_diff: run every detector to report every reason of the update
+      desired: compiled source of truth row of the store, compiled from `store_info` if None
+    Returns:
+      True if the cluster needs an update, False if not, None if the store could not be evaluated
+    """
+    ctx = DriftContext(
+        engine=engine,
+        project_id=project_id,
+        location=location,
+        zone=zone,
+        cluster=cluster,
+        store_info=store_info,
+        en_client=en_client,
+        gkehub_client=gkehub_client,
+        memberships=memberships,
+        maintenance_policies=maintenance_policies,
+        get_maintenance_policy=lambda cluster_name: get_maintenance_window_property(cluster_name, rest_client),
+        desired=desired
+    )
+
+    result = await drift_detectors.detect(ctx, full_diff)
+
+    if result.error:
+        return None
 
-            count += len(config_zone_info[proj_loc_key])
+    if result.has_update:
+        logger.info(f'Cluster in {zone} requires update: {", ".join(result.reasons)}')
 
-    return f'total zones triggered = {count}'
+    return result.has_update
 
 
 @functions_framework.http
 def zone_active_metric(req: flask.Request):
     params = get_parameters_from_environment()
 
+    with get_engine(params) as engine:
+        return run_zone_active_metric(params, engine)
+
+
+def run_zone_active_metric(params: WatcherParameters, engine: AsyncEngine):
     logger.info(
         f'Running zone active watcher in: proj_id={params.project_id}, sot={params.source_of_truth_repo}/{params.source_of_truth_branch}/{params.source_of_truth_path}')
 
-    token = get_git_token_from_secrets_manager(params.secrets_project_id, params.git_secret_id)
-    intent_reader = ClusterIntentReader(
-        params.source_of_truth_repo, params.source_of_truth_branch,
-        params.source_of_truth_path, token)
-    zone_config_fio = intent_reader.retrieve_source_of_truth()
-    rdr = csv.DictReader(io.StringIO(zone_config_fio))  # will raise exception if csv parsing fails
-
-    time_series_data = []
-    for row in rdr:
+    stores = []
+    for row in get_source_of_truth_snapshot(params).rows:
         f_proj_id = row['fleet_project_id']
         m_proj_id = f_proj_id if row['machine_project_id'] is None or len(row['machine_project_id']) == 0 else row['machine_project_id']
         loc = params.region if row['location'] is None or len(row['location']) == 0 else row['location']
+        stores.append((row, f_proj_id, m_proj_id, loc))
+
+    # list the zones of every location concurrently, a single paginated ListZones per location
+    zone_index = get_zone_index(params, engine)
+    zone_index.load((m_proj_id, loc) for (_, _, m_proj_id, loc) in stores)
+
+    time_series_data = []
+    zone_states = []  # (fleet_project_id, location, cluster_version, active) of every zone with a metric
+    for (row, f_proj_id, m_proj_id, loc) in stores:
         store_id = row['store_id']
         cl_name = row['cluster_name']
         full_zone_name = f'projects/{m_proj_id}/locations/{loc}/zones/{store_id}'
         b_generate_metric = False
         b_zone_found = False
         active_metric = 0  # 0 - inactive, 1 - active
+        gdce_zone_name = ''
         try:
-            zone = get_zone(full_zone_name)
+            # the zones of a location that could not be listed are evaluated with its listing error
+            # instead of a GetZone per store
+            location_error = zone_index.location_errors.get((m_proj_id, loc))
+            if location_error is not None:
+                raise location_error
+            zone = get_zone(full_zone_name, zone_index)
             logger.debug(f'{store_id} state = {Zone.State(zone.state).name}')
             b_zone_found = True
         except Exception as e:
@@ -457,6 +627,8 @@ def zone_active_metric(req: flask.Request):
                 # treat as non-existing zone (don't generate metric)
                 b_generate_metric = True
                 active_metric = 1
+                if zone_index.has_cached_zone_name(full_zone_name):
+                    gdce_zone_name = zone_index.get_zone_name(full_zone_name)
 
         if b_zone_found and zone.globally_unique_id is not None and len(zone.globally_unique_id.strip()) > 0:
             # only zones with globally_unique_id is considering as existing zones(generate metric)
@@ -468,6 +640,10 @@ def zone_active_metric(req: flask.Request):
         if not b_generate_metric:
             continue
 
+        zone_states.append((f_proj_id, loc, row.get('cluster_version') or '', active_metric))
+        if not params.zone_active_store_metrics:
+            continue
+
         # Construct time series datapoints for each store
         timestamp = Timestamp()
         timestamp.GetCurrentTime()
@@ -498,19 +674,148 @@ def zone_active_metric(req: flask.Request):
         }
         time_series_data.append(time_series_point)
 
+    # fleet rollups, computed from the zone states instead of aggregating the per-store series
+    if params.zone_active_fleet_metrics:
+        timestamp = Timestamp()
+        timestamp.GetCurrentTime()
+        time_series_data.extend(get_zone_active_count_series(zone_states, timestamp))
+
+    save_zone_index(zone_index)
+
+    # only write the series whose value changed or that are due for a heartbeat
+    emission_state = get_metric_emission_state(params, 'zone_active_metric')
+    changed_series = time_series_data if emission_state is None else emission_state.select(time_series_data)
+    logger.info(f'writing {len(changed_series)} of {len(time_series_data)} zone active time series')
+
     # send batch requests to metric
-    m_client = monitoring_v3.MetricServiceClient()
-    batch_size = 200
-    for i in range(0, len(time_series_data), batch_size):
-        request = monitoring_v3.CreateTimeSeriesRequest({
-            'name': f'projects/{params.project_id}',
-            'time_series': time_series_data[i:i + batch_size]
-        })
-        m_client.create_time_series(request)
-
-    logger.debug(f'update datapoint for {[x["metric"]["labels"]["store_id"] for x in time_series_data]}')
-    logger.debug(f'total zone active flag updated = {len(time_series_data)}')
-    return f'total zone active flag updated = {len(time_series_data)}'
+    writer = TimeSeriesWriter(monitoring_v3.MetricServiceClient(), engine, params.project_id)
+    failed_series = writer.write(changed_series)
+    failed_ids = {id(series) for series in failed_series}
+    written_series = [series for series in changed_series if id(series) not in failed_ids]
+
+    if emission_state is not None:
+        emission_state.record(written_series)
+        emission_state.save(time_series_data)
+
+    if failed_series:
+        raise Exception(f'{len(failed_series)} of {len(changed_series)} zone active time series could not be written')
+
+    logger.debug(f'update datapoint for {[x["metric"]["labels"].get("store_id") for x in written_series]}')
+    logger.debug(f'total zone active flag updated = {len(written_series)}')
+    return f'total zone active flag updated = {len(written_series)}'
+
+def run_watcher(req: flask.Request, params: WatcherParameters, engine: AsyncEngine, config_zone_info, run_stores,
+                name: str, deadline: Deadline = None):
+    """Runs a watcher over the intent data in one of three modes:
+
+    - worker: the request carries a shard, only the stores of that shard are processed and the result
+      is returned as JSON to the coordinator.
+    - coordinator: SHARD_DISPATCHER=http and the source of truth is large enough to be sharded (see
+      MAX_SHARDS and STORES_PER_SHARD), every shard is dispatched to a worker invocation and the results
+      are aggregated. Workers get the remaining time budget of the coordinator as their budget.
+    - unsharded: all the stores are processed by this invocation.
+
+    Stores are evaluated by priority until the time budget (see TIME_BUDGET_SECONDS) is spent, the
+    remaining stores are deferred and the next run resumes from them. The last TRIGGER_RESERVE_SECONDS
+    of the budget are kept to dispatch the triggers queued while evaluating the stores. With a STATE_STORE, the outcome
+    of every store is recorded in the watcher's ReconcileState, and in incremental mode (see
+    INCREMENTAL_RECONCILE) only the stores it selects are evaluated.
+
+    Args:
+        req: incoming request
+        params: WatcherParameters
+        engine: AsyncEngine of this invocation
+        config_zone_info: intent data as returned by read_intent_data
+        run_stores: function processing intent data following a StoreSchedule and returning a WatcherResult
+        name: name of the watcher, used as the key of its reconcile state
+        deadline: time budget of the invocation, None for no limit
+    Returns:
+        The HTTP response of the watcher
+    """
+    def run_worker(payload):
+        shard = Shard.from_dict(payload['shard'])
+        logger.info(f'Running shard {shard.index} of {shard.count} ({shard.strategy} strategy)')
+
+        # the worker must return before the coordinator runs out of time
+        worker_deadline = deadline
+        if shard.budget is not None:
+            worker_deadline = Deadline(shard.budget if deadline is None else min(shard.budget, deadline.remaining()))
+
+        shard_zone_info = select_shard(config_zone_info, shard)
+        if shard.stores is not None:
+            store_locations = {store_id: key for key, stores in shard_zone_info.items() for store_id in stores}
+            schedule = StoreSchedule([(store_locations[store_id], store_id) for store_id in shard.stores
+                                      if store_id in store_locations], worker_deadline, params.trigger_reserve)
+        else:
+            schedule = StoreSchedule.from_zone_info(shard_zone_info, worker_deadline, params.trigger_reserve)
+
+        return run_stores(shard_zone_info, schedule).to_dict()
+
+    payload = req.get_json(silent=True)
+    if isinstance(payload, dict) and 'shard' in payload:
+        return run_worker(payload)
+
+    state = get_reconcile_state(params, name)
+    if state is not None and params.incremental:
+        selected_zone_info = state.select(config_zone_info)
+        logger.info(f'Incremental run: evaluating {sum(len(stores) for stores in selected_zone_info.values())} '
+                    f'of {sum(len(stores) for stores in config_zone_info.values())} stores')
+    else:
+        selected_zone_info = config_zone_info
+
+    # never reconciled stores first, then stores with retriable outcomes, then steady state, each
+    # resuming from the store the previous run stopped at
+    if state is not None:
+        schedule = StoreSchedule(order_stores(selected_zone_info, state.get_priority, state.cursor), deadline,
+                                 params.trigger_reserve)
+    else:
+        schedule = StoreSchedule.from_zone_info(selected_zone_info, deadline, params.trigger_reserve)
+
+    store_count = sum(len(stores) for stores in selected_zone_info.values())
+    shard_count = get_shard_count(store_count, params.max_shards, params.stores_per_shard)
+    if shard_count > 1 and params.shard_dispatcher != 'http':
+        # in process, the shards would run one after another in this invocation, slower than unsharded
+        logger.warning(f'MAX_SHARDS is ignored with SHARD_DISPATCHER={params.shard_dispatcher}, running unsharded')
+        shard_count = 1
+
+    if shard_count > 1:
+        shards = plan_shards(selected_zone_info, shard_count, params.shard_strategy)
+        for shard in shards:
+            shard_stores = {store_id for stores in select_shard(selected_zone_info, shard).values()
+                            for store_id in stores}
+            shard.stores = [store_id for _, store_id in schedule.stores if store_id in shard_stores]
+            if deadline is not None:
+                shard.budget = max(0.0, deadline.remaining() - SHARD_RESPONSE_MARGIN)
+        logger.info(f'Dispatching {store_count} stores to {len(shards)} shards')
+
+        dispatcher = HttpShardDispatcher(params.shard_worker_url or f'https://{req.host}/', engine)
+        results = dispatcher.dispatch(shards)
+        failed_shards = [shard.index for shard, result in zip(shards, results) if result is None]
+        if failed_shards:
+            logger.error(f'Shards failed: {failed_shards}')
+
+        result = aggregate_shard_results(shards, results)
+    else:
+        result = run_stores(selected_zone_info, schedule)
+
+    if state is not None:
+        # zones of the stores skipped or deferred in this run are not outside of the source of truth
+        selected_stores = {store_id for stores in selected_zone_info.values() for store_id in stores}
+        skipped_stores = [store_id for stores in config_zone_info.values() for store_id in stores
+                          if store_id not in selected_stores]
+        skipped_zones = state.get_zones(skipped_stores + result.deferred)
+        result.unprocessed_zones = {zone: key for zone, key in result.unprocessed_zones.items()
+                                    if zone not in skipped_zones}
+
+        deferred = set(result.deferred)
+        state.cursor = next((store_id for _, store_id in schedule.stores if store_id in deferred), None)
+        state.record(selected_zone_info, result.outcomes, deferred)
+        state.save(config_zone_info)
+
+    for zone, (machine_project, location) in result.unprocessed_zones.items():
+        logger.info(f'Zone found in environment but not in cluster source of truth. "projects/{machine_project}/locations/{location}/zones/{zone}"')
+
+    return f'total zones triggered = {result.count}'
 
 def read_intent_data(params, named_key):
     """Returns a data structure containing project, location, and store information  
@@ -524,78 +829,399 @@ def read_intent_data(params, named_key):
     store_information matches the cluster intent's source of truth. Please reference the example-source-of-truth.csv
     file for more information. 
 
+    Only the SOURCE_OF_TRUTH_COLUMNS used by the functions are kept for every store, see
+    get_source_of_truth_snapshot.
+
     Args:
         params: WatcherParams
         named_key: either 'fleet_project_id' or 'machine_project_id'
     Returns:
-        A dictionary with the structure described above.
+        IntentData, a dictionary with the structure described above whose rows are compact StoreRow mappings
     """
-
-    config_zone_info = {}
-    token = get_git_token_from_secrets_manager(params.secrets_project_id, params.git_secret_id)
-    intent_reader = ClusterIntentReader(params.source_of_truth_repo, params.source_of_truth_branch, params.source_of_truth_path, token)
-    zone_config_fio = intent_reader.retrieve_source_of_truth()
-    rdr = csv.DictReader(io.StringIO(zone_config_fio))  # will raise exception if csv parsing fails
-    
-    for row in rdr:
-        proj_loc_key = (row[named_key], row['location'])
-
-        if proj_loc_key not in config_zone_info.keys():
-            config_zone_info[proj_loc_key] = {}
-        config_zone_info[proj_loc_key][row['store_id']] = row
+    config_zone_info = get_source_of_truth_snapshot(params).grouped_by(named_key)
     for key in config_zone_info:
-        logger.debug(f'Stores to check in {key[0]}, {key[1]} => {len(config_zone_info[proj_loc_key])}')
+        logger.debug(f'Stores to check in {key[0]}, {key[1]} => {len(config_zone_info[key])}')
     if len(config_zone_info) == 0:
         raise Exception('no valid zone listed in config file')
-    
+
     return config_zone_info
 
-def get_zone(store_id: str) -> Zone:
+def get_source_of_truth_snapshot(params: WatcherParameters) -> SourceOfTruthSnapshot:
+    """Return the parsed source of truth, shared by the functions.
+
+    A revision is parsed once: a warm instance reuses its last snapshot and, when a state store is configured,
+    the snapshot is persisted under the content hash of the file so the other functions and cold starts load
+    it instead of parsing the file again. The file itself is still revalidated with the git provider on every
+    call, see ClusterIntentReader.
+    Args:
+      params: WatcherParameters
+    Returns:
+      SourceOfTruthSnapshot
+    """
+    token = get_git_token_from_secrets_manager(params.secrets_project_id, params.git_secret_id)
+    intent_reader = get_intent_reader(params, token)
+    stream = intent_reader.open_source_of_truth()
+
+    cache = SourceOfTruthSnapshotCache(get_state_store(params.state_store))
+
+    # the content hash of a cached file is known before reading it, an unchanged file is not parsed again
+    if stream.body_hash is not None:
+        snapshot = cache.get(stream.body_hash, SOURCE_OF_TRUTH_COLUMNS)
+        if snapshot is not None:
+            logger.info('Source of truth unchanged, reusing the parsed snapshot')
+            return snapshot
+
+    snapshot = SourceOfTruthSnapshot.parse(stream, SOURCE_OF_TRUTH_COLUMNS)
+    cache.put(snapshot, SOURCE_OF_TRUTH_COLUMNS)
+
+    return snapshot
+
+async def list_machines_by_zone(engine: AsyncEngine, ec_client, locations):
+    """Lists the machines of every (machine_project, location) pair concurrently and indexes their capacity
+    by GDCE zone.
+
+    Each location is listed as its own task on the engine, so the total time is bounded by the slowest
+    location rather than the sum of all of them. Machines are folded into a ZoneCapacityIndex as pages
+    arrive and are not retained. Errors are isolated per location: a failing location is logged and only
+    the machines retrieved before the failure are counted.
+
+    Args:
+        engine: AsyncEngine running the calls
+        ec_client: EdgeContainer client used to list machines
+        locations: iterable of (machine_project, location) tuples
+    Returns:
+        A tuple of (zone_capacity, unprocessed_zones). zone_capacity is the ZoneCapacityIndex of every
+        zone and unprocessed_zones maps a zone to the (machine_project, location) it was first found in.
+    """
+    locations = list(locations)
+
+    async def list_location(proj_loc_key):
+        (machine_project, location) = proj_loc_key
+        req = edgecontainer.ListMachinesRequest(
+            parent=ec_client.common_location_path(machine_project, location)
+        )
+
+        location_capacity = ZoneCapacityIndex()
+        try:
+            await engine.list(EDGE_CONTAINER, ec_client.list_machines, req, out=location_capacity)
+        except Exception as err:
+            logger.error(f"Error listing machines for project: {machine_project}, location: {location}")
+            logger.error(err)
+        return location_capacity
+
+    location_capacities = await asyncio.gather(*[list_location(key) for key in locations])
+
+    # merge in source of truth order so the result matches a serial listing
+    zone_capacity = ZoneCapacityIndex()
+    unprocessed_zones = {} # used to track zones outside of SoT.
+    for proj_loc_key, location_capacity in zip(locations, location_capacities):
+        for zone in location_capacity.zones:
+            if zone not in zone_capacity:
+                unprocessed_zones[zone] = proj_loc_key
+        zone_capacity.merge(location_capacity)
+
+    return zone_capacity, unprocessed_zones
+
+async def list_clusters_by_location(engine: AsyncEngine, ec_client, locations,
+                                    rest_client: EdgeContainerRestClient = None, policy_locations=()):
+    """Lists the clusters of every (project, location) pair concurrently and indexes them by GDCE zone.
+
+    The locations in `policy_locations` are listed once with the REST client instead, which also returns the
+    maintenance policies of the clusters including maintenance exclusions, and both the index and the
+    maintenance policies of the location are built from that listing. If the REST listing fails, the location
+    is listed with ListClusters and its maintenance policies are None.
+
+    Args:
+        engine: AsyncEngine running the calls
+        ec_client: EdgeContainer client used to list clusters
+        locations: iterable of (project, location) tuples
+        rest_client: EdgeContainerRestClient used to list the clusters of `policy_locations`
+        policy_locations: iterable of (project, location) tuples whose maintenance policies are needed
+    Returns:
+        A tuple of two dictionaries with the (project, location) as the key:
+        - the ClusterIndex of the location, None for locations that could not be listed
+        - the maintenance policies of the clusters of the location by cluster name, for `policy_locations`
+          only, None for locations whose REST listing failed
+    """
+    locations = list(locations)
+    policy_locations = set(policy_locations) if rest_client is not None else set()
+    location_policies = {}
+
+    async def list_location(proj_loc_key):
+        (project_id, location) = proj_loc_key
+
+        if proj_loc_key in policy_locations:
+            try:
+                clusters = await engine.call(REST, rest_client.list_clusters, project_id, location)
+                location_policies[proj_loc_key] = {cluster["name"]: cluster.get("maintenancePolicy", {})
+                                                   for cluster in clusters}
+                return ClusterIndex(edgecontainer.Cluster.from_json(json.dumps(cluster), ignore_unknown_fields=True)
+                                    for cluster in clusters)
+            except Exception as err:
+                logger.error(f"Error listing maintenance policies for project: {project_id}, location: {location}")
+                logger.error(err)
+                location_policies[proj_loc_key] = None
+
+        req_c = edgecontainer.ListClustersRequest(
+            parent=ec_client.common_location_path(project_id, location)
+        )
+
+        try:
+            return await engine.list(EDGE_CONTAINER, ec_client.list_clusters, req_c, out=ClusterIndex())
+        except Exception as err:
+            logger.error(f"Error listing clusters for project: {project_id}, location: {location}")
+            logger.error(err)
+            return None
+
+    location_clusters = await asyncio.gather(*[list_location(key) for key in locations])
+
+    return dict(zip(locations, location_clusters)), location_policies
+
+async def list_memberships_by_project(engine: AsyncEngine, gkehub_client, projects):
+    """Lists the fleet memberships of every project concurrently.
+
+    Args:
+        engine: AsyncEngine running the calls
+        gkehub_client: GkeHub client used to list memberships
+        projects: iterable of fleet project ids
+    Returns:
+        A dictionary with the project as the key and a dictionary of membership id to labels as the value,
+        or None if the memberships of the project could not be listed
+    """
+    projects = list(dict.fromkeys(projects))
+
+    async def list_project(project_id):
+        req = gkehub_v1.ListMembershipsRequest(parent=f"projects/{project_id}/locations/global")
+
+        try:
+            memberships = await engine.list(GKE_HUB, gkehub_client.list_memberships, request=req)
+        except Exception as err:
+            logger.error(f"Error listing memberships for project: {project_id}")
+            logger.error(err)
+            return None
+
+        return {m.name.split('/')[-1]: dict(m.labels) for m in memberships}
+
+    project_memberships = await asyncio.gather(*[list_project(project_id) for project_id in projects])
+
+    return dict(zip(projects, project_memberships))
+
+def get_maintenance_window_locations(config_zone_info):
+    """Return the locations with at least one store with a complete maintenance window in the source of truth,
+    the only stores whose maintenance exclusions are compared.
+    Args:
+      config_zone_info: intent data as returned by read_intent_data
+    Returns:
+      list of (project, location) tuples
+    """
+    return [proj_loc_key for proj_loc_key, stores in config_zone_info.items()
+            if any(store_info.get('maintenance_window_recurrence') and
+                   store_info.get('maintenance_window_start') and
+                   store_info.get('maintenance_window_end') for store_info in stores.values())]
+
+def get_label_projects(config_zone_info):
+    """Return the fleet projects with at least one store with fleet labels in the source of truth.
+    Args:
+      config_zone_info: intent data as returned by read_intent_data
+    Returns:
+      list of fleet project ids
+    """
+    projects = {}
+    for (project_id, _), stores in config_zone_info.items():
+        if any(store_info.get('labels', '').strip() for store_info in stores.values()):
+            projects[project_id] = True
+
+    return list(projects)
+
+def get_zone_locations(config_zone_info, zone_index: ZoneIndex = None):
+    """Returns the (machine_project_id, location) pairs which contain stores without a zone_name in the
+    source of truth or in the zone name cache. Only these locations need to be indexed to resolve zone names.
+
+    Args:
+        config_zone_info: intent data as returned by read_intent_data
+        zone_index: optional index whose name cache is consulted
+    Returns:
+        A list of (machine_project_id, location) tuples in source of truth order
+    """
+    locations = {}
+    for (_, location), stores in config_zone_info.items():
+        for store_id, store_info in stores.items():
+            if store_info['zone_name']:
+                continue
+
+            machine_project_id = store_info['machine_project_id']
+            zone_store_id = f'projects/{machine_project_id}/locations/{location}/zones/{store_id}'
+            if zone_index is not None and zone_index.has_cached_zone_name(zone_store_id):
+                continue
+
+            locations[(machine_project_id, location)] = None
+
+    return list(locations)
+
+def get_zone_index(params: WatcherParameters, engine: AsyncEngine) -> ZoneIndex:
+    """Return an empty zone index for this invocation, backed by the persistent zone name cache when a
+    state store is configured.
+    Args:
+      params: WatcherParameters
+      engine: AsyncEngine of this invocation
+    Returns:
+      ZoneIndex
+    """
+    store = get_state_store(params.state_store)
+    name_cache = ZoneNameCache(store, params.zone_name_cache_ttl) if store is not None else None
+    client = engine.create(get_client, gdchardwaremanagement_v1alpha.GDCHardwareManagementAsyncClient,
+                           'HARDWARE_MANAGMENT_API_ENDPOINT_OVERRIDE')
+
+    return ZoneIndex(client, engine, name_cache)
+
+def save_zone_index(zone_index: ZoneIndex):
+    """Log the zone lookup statistics and persist the zone names resolved during this invocation.
+    Args:
+      zone_index: ZoneIndex returned by get_zone_index
+    """
+    logger.info(f'zone lookups: hits={zone_index.hits}, misses={zone_index.misses}')
+
+    if zone_index.name_cache is not None:
+        zone_index.name_cache.save()
+
+def get_reconcile_state(params: WatcherParameters, name: str) -> ReconcileState:
+    """Return the reconcile state of a watcher, recording store outcomes and the resume cursor.
+    Args:
+      params: WatcherParameters
+      name: name of the watcher
+    Returns:
+      ReconcileState, or None when no state store is configured
+    """
+    store = get_state_store(params.state_store)
+    if store is None:
+        if params.incremental:
+            logger.warning('Incremental reconciliation requires STATE_STORE, evaluating all stores')
+        return None
+
+    return ReconcileState(store, f'reconcile_{name}', params.drift_slices)
+
+def get_intent_reader(params: WatcherParameters, token: str) -> 'ClusterIntentReader':
+    """Return the source of truth reader, caching the file in the state store when one is configured.
+    Args:
+      params: WatcherParameters
+      token: git provider token
+    Returns:
+      ClusterIntentReader
+    """
+    cache = SourceOfTruthCache(get_state_store(params.state_store))
+
+    return ClusterIntentReader(params.source_of_truth_repo, params.source_of_truth_branch,
+                               params.source_of_truth_path, token, cache, params.sot_max_stale)
+
+def get_metric_emission_state(params: WatcherParameters, name: str) -> MetricEmissionState:
+    """Return the last emitted time series values of a metric function, when change-only emission is enabled.
+    Args:
+      params: WatcherParameters
+      name: name of the metric function
+    Returns:
+      MetricEmissionState, or None to write every time series
+    """
+    if not params.metric_change_only:
+        return None
+
+    store = get_state_store(params.state_store)
+    if store is None:
+        logger.warning('Change-only metric emission requires STATE_STORE, writing all time series')
+        return None
+
+    return MetricEmissionState(store, f'metrics_{name}', params.metric_heartbeat)
+
+def get_trigger_dispatcher(params: WatcherParameters, engine: AsyncEngine) -> BuildTriggerDispatcher:
+    """Return the dispatcher submitting the Cloud Build trigger runs of one invocation.
+    Args:
+      params: WatcherParameters
+      engine: AsyncEngine of this invocation
+    Returns:
+      BuildTriggerDispatcher
+    """
+    return BuildTriggerDispatcher(cloudbuild.CloudBuildClient(), engine, params.cloud_build_trigger,
+                                  params.trigger_rate, params.trigger_burst, params.trigger_max_attempts)
+
+def get_engine(params: WatcherParameters) -> AsyncEngine:
+    """Return the engine running the API calls of one invocation.
+    Args:
+      params: WatcherParameters
+    Returns:
+      AsyncEngine, to be used as a context manager
+    """
+    return AsyncEngine(params.api_concurrency, params.max_workers)
+
+def get_client(client_class, endpoint_override_variable: str):
+    """Return a GAPIC client, honoring the endpoint override environment variable.
+    Args:
+      client_class: sync or async GAPIC client class
+      endpoint_override_variable: name of the environment variable holding the endpoint override
+    Returns:
+      client_class instance
+    """
+    api_endpoint_override = os.environ.get(endpoint_override_variable)
+    if api_endpoint_override:
+        op = client_options.ClientOptions(api_endpoint=urlparse(api_endpoint_override).netloc)
+        return client_class(client_options=op)
+    else:  # use the default prod endpoint
+        return client_class()
+
+def get_hardware_management_client():
+    """Return a hardware management client, honoring the endpoint override.
+    Returns:
+      GDCHardwareManagementClient
+    """
+    return get_client(gdchardwaremanagement_v1alpha.GDCHardwareManagementClient, 'HARDWARE_MANAGMENT_API_ENDPOINT_OVERRIDE')
+
+def get_zone(store_id: str, zone_index: ZoneIndex = None) -> Zone:
     """Return Zone info.
     Args:
       store_id: name of zone which is store id usually
+      zone_index: optional index of listed zones, avoids a GetZone call per store
     Returns:
       Zone object
     """
-    hardware_management_api_endpoint_override = os.environ.get('HARDWARE_MANAGMENT_API_ENDPOINT_OVERRIDE')
-    if hardware_management_api_endpoint_override:
-        op = client_options.ClientOptions(api_endpoint=urlparse(hardware_management_api_endpoint_override).netloc)
-        client = gdchardwaremanagement_v1alpha.GDCHardwareManagementClient(client_options=op)
-    else:
-        client = gdchardwaremanagement_v1alpha.GDCHardwareManagementClient()
+    if zone_index is not None:
+        return zone_index.get_zone(store_id)
 
-    return client.get_zone(name=store_id)
+    return get_hardware_management_client().get_zone(name=store_id)
 
 
-def get_zone_name(store_id: str) -> str:
+def get_zone_name(store_id: str, zone_index: ZoneIndex = None) -> str:
     """Return Zone info.
     Args:
       store_id: name of zone which is store id usually
+      zone_index: optional index of listed zones
     Returns:
       rack zone name
     """
+    if zone_index is not None:
+        return zone_index.get_zone_name(store_id)
+
     return get_zone(store_id).globally_unique_id
 
 
-def get_zone_state(store_id: str) -> Zone.State:
+def get_zone_state(store_id: str, zone_index: ZoneIndex = None) -> Zone.State:
     """Return Zone info.
     Args:
       store_id: name of zone which is store id usually
+      zone_index: optional index of listed zones
     Returns:
       zone state
     """
-    return get_zone(store_id).state
+    return get_zone(store_id, zone_index).state
 
 
-def verify_zone_state(store_id: str, recreate_on_delete: bool) -> bool:
+def verify_zone_state(store_id: str, recreate_on_delete: bool, zone_index: ZoneIndex = None) -> bool:
     """Checks if zone is in right state to create.
     Args:
         store_id: name of zone which is store id usually
         recreate_on_delete: true if cluster needs to be recreated on delete.
+        zone_index: optional index of listed zones
     Returns:
         if cluster can be created or not
     """
-    state = get_zone_state(store_id)
+    state = get_zone_state(store_id, zone_index)
     if state == Zone.State.READY_FOR_CUSTOMER_FACTORY_TURNUP_CHECKS:
         logger.info(f'Store is ready for provisioning: "{store_id}"')
         return True
@@ -606,69 +1232,224 @@ def verify_zone_state(store_id: str, recreate_on_delete: bool) -> bool:
     
     return False
 
-def get_maintenance_window_property(cluster_name):
+def get_active_build_zones(builds: BuildHistory, zones, cooldown: float):
+    """Returns the zones with a build in progress or within its cool-down period.
+
+    If the build history cannot be retrieved, no zone is considered active so the builds are still triggered.
+    Args:
+        builds: BuildHistory of the trigger
+        zones: GDCE zone names to check
+        cooldown: seconds after a successful build during which no other build is triggered
+    Returns:
+        A set of zone names
+    """
+    try:
+        return {zone for zone in zones if builds.is_zone_build_active(zone, cooldown)}
+    except Exception as err:
+        logger.error('Unable to retrieve the build history, triggering the builds of every zone with drift')
+        logger.error(err)
+        return set()
+
+def get_maintenance_window_property(cluster_name, rest_client: EdgeContainerRestClient = None):
     """Return maintenance window info directly from API. This method will be replaced once client libraries support
           maintenance exclusion properties in their responses.
     Args:
       cluster_name: full cluster name in the form of projects/<project-id>/locations/<location>/clusters/<cluster-name>
+      rest_client: EdgeContainerRestClient of the invocation, a new client is used if None
     Returns:
       maintenance window property from API, which includes maintenance exclusions.
     """
-    if not creds.valid:
-        authRequest = google.auth.transport.requests.Request()
-        creds.refresh(authRequest)
-
-    base_url = "https://edgecontainer.googleapis.com/"
+    if rest_client is None:
+        rest_client = EdgeContainerRestClient(creds, pool_size=1)
 
-    edgecontainer_api_endpoint_override = os.environ.get("EDGE_CONTAINER_API_ENDPOINT_OVERRIDE")
-    if edgecontainer_api_endpoint_override:
-        base_url = edgecontainer_api_endpoint_override
+    return rest_client.get_cluster(cluster_name)["maintenancePolicy"]
 
-    headers = {
-        "Authorization": f"Bearer {creds.token}"
-    }
-
-    url = f"{base_url}/v1/{cluster_name}"
+class ClusterIntentReader:
+    """
+    Retrieves the source of truth file from GitHub or GitLab.
 
-    cluster_response = requests.get(url, headers=headers)
+    With a SourceOfTruthCache, requests are conditional on the ETag of the cached file, so an unchanged file
+    costs a 304 without a download, and the cached file is served when the provider cannot be reached or
+    fails, as long as it was validated less than `max_stale` seconds ago.
 
-    if cluster_response.status_code == 200:
-        return cluster_response.json()["maintenancePolicy"]
-    else:
-        raise Exception(f"Unable to query for cluster with status code ({cluster_response.status_code})")
+    The source of truth can be sharded: when `sourceOfTruth` is a glob (`sot/*.csv`) or a directory
+    (`sot/`, every `.csv` file of the directory), the matching files are listed and retrieved concurrently,
+    each with its own conditional request, and merged into a single file, see `merge_shards`.
+    """
 
-class ClusterIntentReader:
-    def __init__(self, repo, branch, sourceOfTruth, token):
+    def __init__(self, repo, branch, sourceOfTruth, token, cache: SourceOfTruthCache = None,
+                 max_stale: float = 86400, timeout: float = 20, max_workers: int = 8):
         self.repo = repo
         self.branch = branch
         self.sourceOfTruth = sourceOfTruth
         self.token = token
+        self.cache = cache
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.body_hash: str = None  # content hash of the last retrieved file
 
     def retrieve_source_of_truth(self):
-        url = self._get_url()
+        stream = self.open_source_of_truth()
+        body = ''.join(stream)
+        self.body_hash = stream.body_hash
+        return body
+
+    def is_sharded(self) -> bool:
+        return self.sourceOfTruth.endswith('/') or any(c in self.sourceOfTruth for c in '*?[')
+
+    def open_source_of_truth(self) -> SourceOfTruthStream:
+        """
+        Opens the source of truth file without reading it, its lines are read as the response arrives
+        while iterating the returned stream. Shards are read before returning, the merged file is
+        produced while iterating.
+
+        Returns:
+            SourceOfTruthStream
+        """
+        if self.is_sharded():
+            return self._open_shards()
+
+        return self._open_file(self.sourceOfTruth)
+
+    def _open_shards(self) -> SourceOfTruthStream:
+        paths = self._list_shards()
+        if not paths:
+            raise Exception(f"No source of truth file matches {self.sourceOfTruth}")
+
+        def read_shard(path) -> Tuple[str, str, str]:
+            stream = self._open_file(path)
+            body = ''.join(stream)
+            return path, body, stream.body_hash
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(paths))) as executor:
+            shards = list(executor.map(read_shard, paths))
+
+        logger.info(f"Retrieved {len(shards)} source of truth shards")
+        body_hash = get_shards_hash((path, body_hash) for path, _, body_hash in shards)
+        return SourceOfTruthStream(merge_shards((path, body) for path, body, _ in shards), body_hash)
+
+    def _list_shards(self) -> List[str]:
+        """
+        Lists the files of the source of truth directory matching the shard pattern. The listing is cached
+        like a file and served when the provider cannot be reached or fails.
+
+        Returns:
+            The paths of the shards, sorted
+        """
+        (directory, pattern) = posixpath.split(self.sourceOfTruth)
+        pattern = pattern or '*.csv'
+        url = self._get_listing_url(directory)
+        cached = self.cache.get(url) if self.cache is not None else None
+
+        try:
+            paths = self._request_listing(url)
+        except requests.RequestException as err:
+            return ''.join(self._serve_stale(cached, err)).splitlines()
+
+        body = '\n'.join(sorted(path for path in paths if fnmatch.fnmatchcase(posixpath.basename(path), pattern)))
+        if self.cache is not None:
+            if cached is not None and cached.body == body:
+                self.cache.revalidated(url, cached)
+            else:
+                self.cache.put(url, body, None)
+
+        return body.splitlines()
+
+    def _request_listing(self, url) -> List[str]:
+        paths = []
+        while url:
+            resp = requests.get(url, headers=self._get_headers(), timeout=self.timeout)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise requests.HTTPError(f"Unable to list source of truth files with status code ({resp.status_code})")
+            if resp.status_code != 200:
+                raise Exception(f"Unable to list source of truth files with status code ({resp.status_code})")
+
+            # GitHub lists up to 1000 files in a single response, GitLab paginates
+            paths.extend(entry['path'] for entry in resp.json() if entry['type'] in ('file', 'blob'))
+            next_page = resp.headers.get("X-Next-Page")
+            url = f"{url.split('&page=')[0]}&page={next_page}" if next_page else None
+
+        return paths
+
+    def _open_file(self, path) -> SourceOfTruthStream:
+        url = self._get_url(path)
+        cached = self.cache.get(url) if self.cache is not None else None
+
+        headers = self._get_headers()
+        headers["Accept-Encoding"] = "gzip"
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        try:
+            resp = requests.get(url, headers=headers, timeout=self.timeout, stream=True)
+        except requests.RequestException as err:
+            return self._serve_stale(cached, err)
 
-        resp = requests.get(url, headers=self._get_headers())
+        if resp.status_code == 304 and cached is not None:
+            resp.close()
+            logger.info("Source of truth not modified, using the cached file")
+            self.cache.revalidated(url, cached)
+            return self._serve_cached(cached)
 
         if resp.status_code == 200:
-            return resp.text
-        else:
-            raise Exception(f"Unable to retrieve source of truth with status code ({resp.status_code})")
+            # decode gzip and utf-8 as the chunks arrive, keeping the line endings for the csv parser
+            lines = iter_lines(resp.iter_content(chunk_size=SOURCE_OF_TRUTH_CHUNK_SIZE))
+            etag = resp.headers.get("ETag")
+            on_complete = (lambda body: self.cache.put(url, body, etag)) if self.cache is not None else None
+            return SourceOfTruthStream(lines, on_complete=on_complete, close=resp.close)
+
+        resp.close()
+        error = Exception(f"Unable to retrieve source of truth with status code ({resp.status_code})")
+        if resp.status_code == 429 or resp.status_code >= 500:
+            return self._serve_stale(cached, error)
+
+        raise error
+
+    def _serve_cached(self, cached: CachedSourceOfTruth) -> SourceOfTruthStream:
+        return SourceOfTruthStream(io.StringIO(cached.body, newline=""), cached.body_hash)
+
+    def _serve_stale(self, cached: CachedSourceOfTruth, err: Exception) -> SourceOfTruthStream:
+        if cached is None or self.cache.age(cached) > self.max_stale:
+            raise err
 
-    def _get_url(self):
+        logger.warning(f"Unable to retrieve source of truth, using the cached file validated "
+                       f"{self.cache.age(cached):.0f}s ago")
+        logger.warning(err)
+        return self._serve_cached(cached)
+
+    def _get_url(self, file_path=None):
         parse_result = urlparse(f"https://{self.repo}")
+        file_path = file_path or self.sourceOfTruth
 
         if parse_result.netloc == "github.com":
             # Remove .git suffix used in git web url
             path = parse_result.path.split('.')[0]
 
-            return f"https://raw.githubusercontent.com{path}/{self.branch}/{self.sourceOfTruth}"
+            return f"https://raw.githubusercontent.com{path}/{self.branch}/{file_path}"
         elif parse_result.netloc == "gitlab.com":
             path = parse_result.path.split('.')[0]
 
             # projectid is url encoded: org%2Fproject%2Frepo_name
             project_id = path[1:].replace('/', '%2F')
 
-            return f"https://gitlab.com/api/v4/projects/{project_id}/repository/files/{self.sourceOfTruth}/raw?ref={self.branch}&private_token={self.token}"
+            # the file path is url encoded as well: dir%2Ffile.csv
+            return f"https://gitlab.com/api/v4/projects/{project_id}/repository/files/{quote(file_path, safe='')}/raw?ref={self.branch}&private_token={self.token}"
+        else:
+            raise Exception("Unsupported git provider")
+
+    def _get_listing_url(self, directory):
+        parse_result = urlparse(f"https://{self.repo}")
+
+        if parse_result.netloc == "github.com":
+            path = parse_result.path.split('.')[0]
+
+            return f"https://api.github.com/repos{path}/contents/{directory}?ref={self.branch}"
+        elif parse_result.netloc == "gitlab.com":
+            path = parse_result.path.split('.')[0]
+            project_id = path[1:].replace('/', '%2F')
+
+            return f"https://gitlab.com/api/v4/projects/{project_id}/repository/tree?path={quote(directory, safe='')}&ref={self.branch}&per_page=100&private_token={self.token}"
         else:
             raise Exception("Unsupported git provider")
 
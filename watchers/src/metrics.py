@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from google.api_core import exceptions
+from google.cloud import monitoring_v3
+from google.protobuf import any_pb2
+from .engine import AsyncEngine, MONITORING
+from .state_store import StateStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# CreateTimeSeries accepts at most 200 time series per request
+MAX_BATCH_SIZE = 200
+
+ZONE_ACTIVE_COUNT_METRIC = 'custom.googleapis.com/gdc_zone_active_count'
+
+# errors of a CreateTimeSeries call worth retrying, any other error fails the batch immediately
+RETRIABLE_ERRORS = (
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+)
+
+# errors of a CreateTimeSeries call that writing the same series again will not fix
+PERMANENT_ERRORS = (
+    exceptions.InvalidArgument,
+)
+
+# the message of a partially failed CreateTimeSeries call names the rejected series, e.g. "timeSeries[3]: ..."
+REJECTED_SERIES_PATTERN = re.compile(r'timeSeries\[(\d+)\]')
+
+def get_rejected_series(err: exceptions.GoogleAPICallError, batch_size: int) -> Set[int]:
+    """
+    Args:
+        err: error of a CreateTimeSeries call
+        batch_size: number of time series of the request
+    Returns:
+        The indexes of the time series the error names in the request, empty if it names none
+    """
+    indexes = {int(index) for index in REJECTED_SERIES_PATTERN.findall(str(err.message))}
+    return {index for index in indexes if index < batch_size}
+
+
+def get_write_summary(err: exceptions.GoogleAPICallError) -> Optional[monitoring_v3.CreateTimeSeriesSummary]:
+    """
+    Args:
+        err: error of a CreateTimeSeries call
+    Returns:
+        The summary of the points written and rejected attached to the error, None if there is none
+    """
+    summary_type = monitoring_v3.CreateTimeSeriesSummary.pb()
+    for detail in err.details or []:
+        if isinstance(detail, any_pb2.Any) and detail.Is(summary_type.DESCRIPTOR):
+            summary = summary_type()
+            detail.Unpack(summary)
+            return monitoring_v3.CreateTimeSeriesSummary.wrap(summary)
+    return None
+
+
+def get_series_key(time_series: dict) -> str:
+    """
+    Args:
+        time_series: time series as passed to CreateTimeSeriesRequest
+    Returns:
+        Identity of the series, its metric type and labels
+    """
+    return f"{time_series['metric']['type']}:{json.dumps(time_series['metric']['labels'], sort_keys=True)}"
+
+
+def get_series_value(time_series: dict) -> str:
+    """
+    Args:
+        time_series: time series with a single point
+    Returns:
+        Comparable form of the value of the point
+    """
+    return json.dumps(time_series['points'][0]['value'], sort_keys=True)
+
+
+def get_zone_active_count_series(zone_states: Iterable[Tuple[str, str, str, int]], timestamp) -> List[dict]:
+    """
+    Rolls up the active state of the zones into the number of active and inactive zones per fleet project,
+    location and cluster version. Both counts are produced for every group, so a group whose zones all
+    become inactive reports 0 active zones.
+
+    Args:
+        zone_states: (fleet_project_id, location, cluster_version, active) of every zone, active being 0 or 1
+        timestamp: end time of the points
+    Returns:
+        The time series of the rollup, in the format of CreateTimeSeriesRequest
+    """
+    counts = Counter()
+    groups = {}
+    for (fleet_project_id, location, cluster_version, active) in zone_states:
+        group = (fleet_project_id, location, cluster_version)
+        groups[group] = None
+        counts[(group, 'active' if active else 'inactive')] += 1
+
+    time_series = []
+    for (fleet_project_id, location, cluster_version) in groups:
+        for state in ('active', 'inactive'):
+            time_series.append({
+                'metric': {
+                    'type': ZONE_ACTIVE_COUNT_METRIC,
+                    'labels': {
+                        'fleet_project_id': fleet_project_id,
+                        'location': location,
+                        'cluster_version': cluster_version,
+                        'state': state
+                    }
+                },
+                'resource': {
+                    'type': 'global',
+                    'labels': {
+                        'project_id': fleet_project_id
+                    }
+                },
+                'points': [{
+                    'interval': {'end_time': timestamp},
+                    'value': {'int64_value': counts[((fleet_project_id, location, cluster_version), state)]}
+                }]
+            })
+
+    return time_series
+
+
+class MetricEmissionState:
+    """
+    Persistent last emitted value of every time series, used to only write the series whose value changed.
+
+    A series is written when it was never emitted, when its value differs from the last emitted one, or when
+    it was last emitted more than `heartbeat_seconds` ago, so alerts on missing data keep working on a stable
+    fleet. Series that are no longer produced are dropped on save.
+    """
+
+    def __init__(self, store: StateStore, key: str, heartbeat_seconds: float, clock=time.time):
+        self.store = store
+        self.key = key
+        self.heartbeat_seconds = heartbeat_seconds
+        self.clock = clock
+        self.entries: Dict[str, Tuple[str, float]] = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        try:
+            document = self.store.read(self.key)
+        except Exception as err:
+            logger.error("Unable to read metric emission state, writing all time series")
+            logger.error(err)
+            document = None
+
+        if document:
+            for series_key, (value, emitted_at) in document.get('entries', {}).items():
+                self.entries[series_key] = (value, emitted_at)
+
+    def select(self, time_series: List[dict]) -> List[dict]:
+        """
+        Args:
+            time_series: every time series of this run
+        Returns:
+            The time series to write: new, changed, or due for a heartbeat
+        """
+        self._load()
+
+        now = self.clock()
+        selected = []
+        for series in time_series:
+            entry = self.entries.get(get_series_key(series))
+            if (entry is None
+                    or entry[0] != get_series_value(series)
+                    or now - entry[1] >= self.heartbeat_seconds):
+                selected.append(series)
+
+        return selected
+
+    def record(self, time_series: List[dict]):
+        """
+        Args:
+            time_series: time series that were written successfully
+        """
+        self._load()
+
+        now = self.clock()
+        for series in time_series:
+            self.entries[get_series_key(series)] = (get_series_value(series), now)
+
+    def save(self, time_series: List[dict]):
+        """
+        Persists the state, keeping only the series produced in this run. Failures are logged and do not
+        fail the watcher.
+
+        Args:
+            time_series: every time series of this run
+        """
+        self._load()
+
+        series_keys = {get_series_key(series) for series in time_series}
+        self.entries = {key: entry for key, entry in self.entries.items() if key in series_keys}
+
+        try:
+            self.store.write(self.key, {'entries': self.entries})
+        except Exception as err:
+            logger.error("Unable to persist metric emission state")
+            logger.error(err)
+
+
+class TimeSeriesWriter:
+    """
+    Writes time series with CreateTimeSeries in batches of up to 200 series, submitted concurrently on the
+    engine under the MONITORING concurrency limit.
+
+    Batches failing with a transient error are retried with exponential backoff and jitter, up to
+    `max_attempts` attempts. A batch that still fails does not affect the other batches, its series are
+    returned by `write` so the caller can write them again in a later run.
+
+    Series rejected as invalid are logged and dropped instead of being returned, so one invalid series
+    does not fail every run. CreateTimeSeries writes the valid series of a batch and names the rejected
+    ones in its error, the batch is never written again then, as the accepted points would be rejected as
+    duplicates. Only a batch rejected as a whole is split in halves until the invalid series are isolated.
+    """
+
+    def __init__(self, client: monitoring_v3.MetricServiceClient, engine: AsyncEngine, project_id: str,
+                 batch_size: int = MAX_BATCH_SIZE, max_attempts: int = 5, initial_backoff: float = 1.0,
+                 max_backoff: float = 30.0):
+        self.client = client
+        self.engine = engine
+        self.project_id = project_id
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    async def _write_batch(self, batch: List[dict]) -> List[dict]:
+        request = monitoring_v3.CreateTimeSeriesRequest({
+            'name': f'projects/{self.project_id}',
+            'time_series': batch
+        })
+
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                await self.engine.call(MONITORING, self.client.create_time_series, request)
+                return []
+            except RETRIABLE_ERRORS as err:
+                if attempts >= self.max_attempts:
+                    logger.error(f'Unable to write {len(batch)} time series after {attempts} attempts')
+                    logger.error(err)
+                    return batch
+
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempts - 1))
+                logger.warning(f'Error writing {len(batch)} time series, retrying in {backoff:.1f}s')
+                await asyncio.sleep(backoff * random.uniform(0.5, 1))
+            except PERMANENT_ERRORS as err:
+                rejected = get_rejected_series(err, len(batch))
+                if rejected or len(batch) == 1:
+                    rejected = rejected or {0}
+                    logger.error(f'Dropping {len(rejected)} of {len(batch)} time series rejected by the monitoring API: '
+                                 f'{[batch[index].get("metric") for index in sorted(rejected)]}')
+                    logger.error(err)
+                    return []
+
+                summary = get_write_summary(err)
+                if summary is not None and summary.success_point_count > 0:
+                    # partially written without naming the rejected series, the accepted points can't be written again
+                    logger.error(f'Dropping {summary.total_point_count - summary.success_point_count} of '
+                                 f'{summary.total_point_count} points rejected by the monitoring API')
+                    logger.error(err)
+                    return []
+
+                # nothing was written, split the batch to isolate the invalid series
+                half = len(batch) // 2
+                results = await asyncio.gather(self._write_batch(batch[:half]), self._write_batch(batch[half:]))
+                return [series for failed in results for series in failed]
+            except Exception as err:
+                logger.error(f'Unable to write {len(batch)} time series')
+                logger.error(err)
+                return batch
+
+    def write(self, time_series: List[dict]) -> List[dict]:
+        """
+        Args:
+            time_series: time series to write
+        Returns:
+            The time series of the batches that could not be written, except the dropped invalid series
+        """
+        batches = [time_series[i:i + self.batch_size] for i in range(0, len(time_series), self.batch_size)]
+        if not batches:
+            return []
+
+        results = self.engine.run_all(*[self._write_batch(batch) for batch in batches])
+
+        return [series for failed in results for series in failed]
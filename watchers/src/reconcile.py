@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+from typing import Dict, Iterable, Optional, Set, Tuple
+from .schedule import NEVER_RECONCILED, RETRIABLE, STEADY_STATE
+from .state_store import StateStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Outcomes of evaluating a store. IN_SYNC is the only terminal outcome, a store left in sync is not
+# re-evaluated until its row changes or its drift slice comes up.
+IN_SYNC = 'in_sync'
+TRIGGERED = 'triggered'
+NO_MACHINES = 'no_machines'
+NOT_ENOUGH_NODES = 'not_enough_nodes'
+ZONE_NOT_READY = 'zone_not_ready'
+NO_CLUSTER = 'no_cluster'
+BUILD_IN_PROGRESS = 'build_in_progress'
+ERROR = 'error'
+UNKNOWN = 'unknown'
+
+TERMINAL_OUTCOMES = {IN_SYNC}
+
+def get_row_hash(store_info: dict) -> str:
+    """
+    Args:
+        store_info: source of truth row, a dictionary or StoreRow
+    Returns:
+        Content hash of the row, independent of column order
+    """
+    return hashlib.sha256(json.dumps(dict(store_info), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ReconcileState:
+    """
+    Persistent per-store record of the last reconcile of a watcher, used to only re-evaluate the stores
+    that may need work.
+
+    Each entry holds the content hash of the store's source of truth row, the outcome of its last
+    evaluation and the zone it resolved to. A run selects the stores that are new or whose row changed,
+    the stores whose last outcome was not terminal (build in flight, not enough free nodes, errors...)
+    and a rotating slice of the remaining stores, so drift in the cloud state of an unchanged store is
+    still detected within `drift_slices` runs.
+
+    The state also keeps the resume cursor of the watcher, the store a run stopped at when it ran out
+    of time, and ranks stores for scheduling with `get_priority`.
+    """
+
+    def __init__(self, store: StateStore, key: str, drift_slices: int, clock=time.time):
+        self.store = store
+        self.key = key
+        self.drift_slices = drift_slices
+        self.clock = clock
+        self.entries: Dict[str, dict] = None
+        self.run = 0
+        self.cursor: Optional[str] = None
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        try:
+            document = self.store.read(self.key)
+        except Exception as err:
+            logger.error("Unable to read reconcile state, evaluating all stores")
+            logger.error(err)
+            document = None
+
+        if document:
+            self.entries = document.get('entries', {})
+            self.run = document.get('run', 0)
+            self.cursor = document.get('cursor')
+
+    def _in_drift_slice(self, store_id: str) -> bool:
+        return zlib.crc32(store_id.encode('utf-8')) % self.drift_slices == self.run % self.drift_slices
+
+    def select(self, config_zone_info):
+        """
+        Args:
+            config_zone_info: intent data as returned by read_intent_data
+        Returns:
+            The intent data restricted to the stores to evaluate in this run, in the same structure
+        """
+        self._load()
+
+        selected_zone_info = {}
+        for proj_loc_key, stores in config_zone_info.items():
+            selected = {}
+            for store_id, store_info in stores.items():
+                entry = self.entries.get(store_id)
+                if (entry is None
+                        or entry['hash'] != get_row_hash(store_info)
+                        or entry['outcome'] not in TERMINAL_OUTCOMES
+                        or self._in_drift_slice(store_id)):
+                    selected[store_id] = store_info
+
+            if selected:
+                selected_zone_info[proj_loc_key] = selected
+
+        return selected_zone_info
+
+    def get_priority(self, store_id: str) -> int:
+        """
+        Args:
+            store_id: store to rank
+        Returns:
+            NEVER_RECONCILED, RETRIABLE if the last outcome was not terminal, or STEADY_STATE
+        """
+        self._load()
+
+        entry = self.entries.get(store_id)
+        if entry is None:
+            return NEVER_RECONCILED
+        if entry['outcome'] not in TERMINAL_OUTCOMES:
+            return RETRIABLE
+        return STEADY_STATE
+
+    def get_zones(self, store_ids: Iterable[str]) -> Set[str]:
+        """
+        Args:
+            store_ids: stores to get the zones of
+        Returns:
+            The zones recorded for the stores
+        """
+        self._load()
+
+        zones = set()
+        for store_id in store_ids:
+            entry = self.entries.get(store_id)
+            if entry is not None and entry.get('zone'):
+                zones.add(entry['zone'])
+
+        return zones
+
+    def record(self, selected_zone_info, outcomes: Dict[str, Tuple[str, Optional[str]]],
+               deferred: Iterable[str] = ()):
+        """
+        Records the outcome of every evaluated store. Selected stores without an outcome (e.g. part of
+        a failed shard) are recorded as UNKNOWN so they are evaluated again in the next run. Deferred
+        stores were not evaluated and keep their previous entry.
+
+        Args:
+            selected_zone_info: intent data returned by `select`
+            outcomes: (outcome, zone) of the evaluated stores, by store_id
+            deferred: store_ids that were not evaluated
+        """
+        self._load()
+
+        deferred = set(deferred)
+        now = self.clock()
+        for stores in selected_zone_info.values():
+            for store_id, store_info in stores.items():
+                if store_id in deferred:
+                    continue
+                (outcome, zone) = outcomes.get(store_id, (UNKNOWN, None))
+                previous_zone = self.entries.get(store_id, {}).get('zone')
+                self.entries[store_id] = {
+                    'hash': get_row_hash(store_info),
+                    'outcome': outcome,
+                    'zone': zone or previous_zone,
+                    'evaluated_at': now
+                }
+
+    def save(self, config_zone_info):
+        """
+        Persists the state and advances the drift slice. Stores removed from the source of truth are
+        dropped. Failures are logged and do not fail the watcher.
+
+        Args:
+            config_zone_info: intent data as returned by read_intent_data
+        """
+        self._load()
+
+        store_ids = {store_id for stores in config_zone_info.values() for store_id in stores}
+        self.entries = {store_id: entry for store_id, entry in self.entries.items() if store_id in store_ids}
+        self.run += 1
+
+        try:
+            self.store.write(self.key, {'run': self.run, 'cursor': self.cursor, 'entries': self.entries})
+        except Exception as err:
+            logger.error("Unable to persist reconcile state")
+            logger.error(err)
@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+from typing import Callable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Store priorities, lower is evaluated first
+NEVER_RECONCILED = 0
+RETRIABLE = 1
+STEADY_STATE = 2
+
+class Deadline:
+    """Time budget of a watcher invocation, started when the deadline is created."""
+
+    def __init__(self, seconds: float, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - self.clock()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+def order_stores(config_zone_info, priority: Callable[[str], int] = None,
+                 cursor: str = None) -> List[Tuple[Tuple[str, str], str]]:
+    """
+    Orders the stores of the intent data by priority. Stores of the same priority keep the source of truth
+    order, rotated so that the store at `cursor` and the ones after it come first.
+
+    Args:
+        config_zone_info: intent data as returned by read_intent_data
+        priority: function returning the priority of a store_id, all stores have the same priority if None
+        cursor: store_id the previous run stopped at, if any
+    Returns:
+        A list of (proj_loc_key, store_id) tuples
+    """
+    stores = [(proj_loc_key, store_id) for proj_loc_key, location_stores in config_zone_info.items()
+              for store_id in location_stores]
+
+    start = 0
+    for i, (_, store_id) in enumerate(stores):
+        if store_id == cursor:
+            start = i
+            break
+
+    stores = stores[start:] + stores[:start]
+
+    if priority is not None:
+        stores.sort(key=lambda store: priority(store[1]))
+
+    return stores
+
+
+class StoreSchedule:
+    """
+    Ordered stores a watcher evaluates, stopping once the deadline has passed. The stores that could not be
+    evaluated in time are listed in `deferred` after the iteration. With a `reserve`, the evaluation stops
+    `reserve` seconds before the deadline, leaving that time to the work that follows, such as dispatching
+    the triggers queued while evaluating the stores.
+
+    Usage:
+        for proj_loc_key, store_id in schedule:
+            ...
+    """
+
+    def __init__(self, stores: List[Tuple[Tuple[str, str], str]], deadline: Optional[Deadline] = None,
+                 reserve: float = 0):
+        self.stores = stores
+        self.deadline = deadline
+        self.reserve = reserve
+        self.deferred: List[str] = []
+
+    @staticmethod
+    def from_zone_info(config_zone_info, deadline: Optional[Deadline] = None, reserve: float = 0) -> 'StoreSchedule':
+        """Schedule of every store of the intent data, in source of truth order."""
+        return StoreSchedule(order_stores(config_zone_info), deadline, reserve)
+
+    def expired(self) -> bool:
+        """True once no store should be evaluated anymore."""
+        return self.deadline is not None and self.deadline.remaining() <= self.reserve
+
+    def __iter__(self) -> Iterator[Tuple[Tuple[str, str], str]]:
+        self.deferred = []
+
+        for i, (proj_loc_key, store_id) in enumerate(self.stores):
+            if self.expired():
+                self.deferred = [deferred_store_id for _, deferred_store_id in self.stores[i:]]
+                logger.warning(f'Time budget exhausted, deferring {len(self.deferred)} of {len(self.stores)} '
+                               f'stores to the next run')
+                return
+
+            yield proj_loc_key, store_id
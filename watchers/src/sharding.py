@@ -0,0 +1,269 @@
+import logging
+import math
+import os
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import requests
+import google.auth.transport.requests
+import google.oauth2.id_token
+from .engine import AsyncEngine, REST
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+LOCATION_STRATEGY = 'location'
+HASH_STRATEGY = 'hash'
+
+# seconds of the coordinator's budget kept to receive the result of a worker once its own budget is spent
+SHARD_RESPONSE_MARGIN = 5
+
+@dataclass
+class Shard:
+    """
+    A slice of the intent data processed by one worker invocation.
+
+    With the `location` strategy a shard owns whole (project, location) groups, listed in `locations`.
+    With the `hash` strategy a shard owns the stores whose store_id hashes to `index`, `locations`
+    then lists every group the shard has stores in. When `stores` is set, the shard is further
+    restricted to those store_ids (incremental runs). `budget` is the time in seconds the worker may
+    spend, derived from the remaining time budget of the coordinator.
+    """
+    index: int
+    count: int
+    strategy: str
+    locations: List[Tuple[str, str]] = field(default_factory=list)
+    stores: Optional[List[str]] = None
+    budget: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        value = {
+            'index': self.index,
+            'count': self.count,
+            'strategy': self.strategy,
+            'locations': [list(key) for key in self.locations]
+        }
+        if self.stores is not None:
+            value['stores'] = list(self.stores)
+        if self.budget is not None:
+            value['budget'] = self.budget
+        return value
+
+    @staticmethod
+    def from_dict(value: dict) -> 'Shard':
+        return Shard(
+            index=int(value['index']),
+            count=int(value['count']),
+            strategy=value['strategy'],
+            locations=[tuple(key) for key in value.get('locations', [])],
+            stores=value.get('stores'),
+            budget=float(value['budget']) if value.get('budget') is not None else None
+        )
+
+
+@dataclass
+class WatcherResult:
+    """
+    Outcome of a watcher run over a set of stores, returned by workers to the coordinator. `outcomes`
+    holds the reconcile outcome and zone of every evaluated store, by store_id, and `deferred` the
+    store_ids that could not be evaluated within the time budget.
+    """
+    count: int = 0
+    unprocessed_zones: Dict[str, Tuple[str, str]] = field(default_factory=dict)
+    outcomes: Dict[str, Tuple[str, Optional[str]]] = field(default_factory=dict)
+    deferred: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'unprocessed_zones': {zone: list(key) for zone, key in self.unprocessed_zones.items()},
+            'outcomes': {store_id: list(outcome) for store_id, outcome in self.outcomes.items()},
+            'deferred': list(self.deferred)
+        }
+
+    @staticmethod
+    def from_dict(value: dict) -> 'WatcherResult':
+        return WatcherResult(
+            count=int(value.get('count', 0)),
+            unprocessed_zones={zone: tuple(key) for zone, key in value.get('unprocessed_zones', {}).items()},
+            outcomes={store_id: tuple(outcome) for store_id, outcome in value.get('outcomes', {}).items()},
+            deferred=list(value.get('deferred', []))
+        )
+
+
+def get_store_shard(store_id: str, shard_count: int) -> int:
+    """Stable shard assignment of a store for the `hash` strategy."""
+    return zlib.crc32(store_id.encode('utf-8')) % shard_count
+
+
+def get_shard_count(store_count: int, max_shards: int, stores_per_shard: int) -> int:
+    """
+    Derives the number of shards from the size of the source of truth.
+
+    Args:
+        store_count: number of stores in the source of truth
+        max_shards: upper bound on the number of shards, 0 disables sharding
+        stores_per_shard: target number of stores per shard
+    Returns:
+        The number of shards, 1 means the watcher runs unsharded
+    """
+    if max_shards <= 1 or store_count == 0:
+        return 1
+
+    return max(1, min(max_shards, math.ceil(store_count / stores_per_shard)))
+
+
+def plan_shards(config_zone_info, shard_count: int, strategy: str) -> List[Shard]:
+    """
+    Splits the intent data into shards.
+
+    The `location` strategy assigns whole (project, location) groups, largest first, to the shard with
+    the fewest stores so far. The `hash` strategy assigns each store by a hash of its store_id.
+
+    Args:
+        config_zone_info: intent data as returned by read_intent_data
+        shard_count: number of shards
+        strategy: `location` or `hash`
+    Returns:
+        The list of non-empty shards
+    """
+    if strategy == LOCATION_STRATEGY:
+        shards = [Shard(i, shard_count, strategy) for i in range(shard_count)]
+        shard_sizes = [0] * shard_count
+
+        for key in sorted(config_zone_info, key=lambda k: len(config_zone_info[k]), reverse=True):
+            i = shard_sizes.index(min(shard_sizes))
+            shards[i].locations.append(key)
+            shard_sizes[i] += len(config_zone_info[key])
+    elif strategy == HASH_STRATEGY:
+        shards = [Shard(i, shard_count, strategy) for i in range(shard_count)]
+
+        for key, stores in config_zone_info.items():
+            for i in sorted({get_store_shard(store_id, shard_count) for store_id in stores}):
+                shards[i].locations.append(key)
+    else:
+        raise Exception(f'Unsupported shard strategy: {strategy}')
+
+    return [shard for shard in shards if shard.locations]
+
+
+def select_shard(config_zone_info, shard: Shard):
+    """
+    Args:
+        config_zone_info: intent data as returned by read_intent_data
+        shard: shard to select
+    Returns:
+        The intent data restricted to the stores owned by the shard, in the same structure
+    """
+    shard_zone_info = {}
+    shard_stores = set(shard.stores) if shard.stores is not None else None
+
+    for key in shard.locations:
+        if key not in config_zone_info:
+            continue
+
+        if shard.strategy == HASH_STRATEGY:
+            stores = {store_id: store_info for store_id, store_info in config_zone_info[key].items()
+                      if get_store_shard(store_id, shard.count) == shard.index}
+        else:
+            stores = config_zone_info[key]
+
+        if shard_stores is not None:
+            stores = {store_id: store_info for store_id, store_info in stores.items() if store_id in shard_stores}
+
+        if stores:
+            shard_zone_info[key] = stores
+
+    return shard_zone_info
+
+
+def aggregate_shard_results(shards: List[Shard], results: List[Optional[WatcherResult]]) -> WatcherResult:
+    """
+    Merges the results of every shard. A zone is only reported as unprocessed when every shard that
+    listed its location reported it as unprocessed, since with the `hash` strategy the store matching
+    a zone can belong to a different shard than the one reporting it. Zones in the locations of a failed
+    shard (None result) are never reported.
+
+    Args:
+        shards: shards that were dispatched
+        results: result of each shard, None if the shard failed
+    Returns:
+        The aggregated WatcherResult
+    """
+    aggregate = WatcherResult()
+    listed_locations = Counter()
+    reported_zones = Counter()
+    zone_locations = {}
+
+    for shard, result in zip(shards, results):
+        # count failed shards too, so zones in their locations can never be reported
+        listed_locations.update(shard.locations)
+
+        if result is None:
+            continue
+
+        aggregate.count += result.count
+        aggregate.outcomes.update(result.outcomes)
+        aggregate.deferred.extend(result.deferred)
+        reported_zones.update(result.unprocessed_zones.keys())
+        zone_locations.update(result.unprocessed_zones)
+
+    for zone, key in zone_locations.items():
+        if reported_zones[zone] == listed_locations[key]:
+            aggregate.unprocessed_zones[zone] = key
+
+    return aggregate
+
+
+class ShardDispatcher(ABC):
+    """Sends every shard to a worker invocation and collects the results."""
+
+    @abstractmethod
+    def dispatch(self, shards: List[Shard]) -> List[Optional[WatcherResult]]:
+        """
+        Args:
+            shards: shards to dispatch
+        Returns:
+            The result of each shard in order, None for shards that failed
+        """
+
+
+class HttpShardDispatcher(ShardDispatcher):
+    """
+    Invokes the worker endpoint once per shard over authenticated HTTP, concurrently on the engine,
+    and collects the JSON results from the responses.
+
+    Opt-in with SHARD_DISPATCHER=http: the worker endpoint must be able to scale to one instance per
+    shard besides the coordinator (max instance count) and the runtime service account needs
+    roles/run.invoker on it. Requests time out `SHARD_RESPONSE_MARGIN` seconds after the budget of the
+    shard, `timeout` applies to shards without a budget.
+    """
+
+    def __init__(self, url: str, engine: AsyncEngine, timeout: float = 55):
+        self.url = url
+        self.engine = engine
+        self.timeout = timeout
+
+    def _post(self, shard: Shard) -> WatcherResult:
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), self.url)
+        resp = requests.post(self.url, json={'shard': shard.to_dict()},
+                             headers={'Authorization': f'Bearer {token}'},
+                             timeout=self.timeout if shard.budget is None else shard.budget + SHARD_RESPONSE_MARGIN)
+
+        if resp.status_code != 200:
+            raise Exception(f'Shard {shard.index} failed with status code ({resp.status_code})')
+
+        return WatcherResult.from_dict(resp.json())
+
+    def dispatch(self, shards: List[Shard]) -> List[Optional[WatcherResult]]:
+        async def dispatch_shard(shard):
+            try:
+                return await self.engine.call(REST, self._post, shard)
+            except Exception as err:
+                logger.error(f'Shard {shard.index} failed')
+                logger.error(err)
+                return None
+
+        return self.engine.run_all(*[dispatch_shard(shard) for shard in shards])
@@ -0,0 +1,533 @@
+import codecs
+import csv
+import hashlib
+import io
+import logging
+import os
+import sys
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from .state_store import StateStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+def get_body_hash(body: str) -> str:
+    """
+    Args:
+        body: source of truth file content
+    Returns:
+        Content hash of the file
+    """
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CachedSourceOfTruth:
+    """Last retrieved source of truth file and the validators to revalidate it."""
+    body: str
+    etag: Optional[str] = None
+    # time the body was last retrieved or revalidated
+    validated_at: float = 0
+    body_hash: str = None
+
+    def __post_init__(self):
+        if self.body_hash is None:
+            self.body_hash = get_body_hash(self.body)
+
+
+# cached files by cache key, kept across invocations of a warm instance and shared by the watchers of the process
+cached_files: Dict[str, CachedSourceOfTruth] = {}
+
+class SourceOfTruthCache:
+    """
+    Cache of the source of truth files retrieved from the git provider, used to send conditional requests
+    and to serve the last known file when the provider is unavailable.
+
+    Entries are kept in memory for the lifetime of the instance and, when a state store is configured,
+    persisted so cold starts and the other watchers can revalidate instead of downloading the file again.
+    Entries are keyed by a hash of the file URL, so access tokens in the URL are never stored. Revalidations
+    are persisted in a small document next to the entry, so the file is not written again on every run.
+    """
+
+    def __init__(self, store: StateStore = None, clock=time.time):
+        self.store = store
+        self.clock = clock
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return f"sot_{hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]}"
+
+    @staticmethod
+    def _validated_key(key: str) -> str:
+        return f'{key}_validated'
+
+    def get(self, url: str) -> Optional[CachedSourceOfTruth]:
+        """
+        Args:
+            url: URL of the source of truth file
+        Returns:
+            The cached file, or None if it was never retrieved
+        """
+        key = self._key(url)
+        if key in cached_files:
+            return cached_files[key]
+
+        if self.store is None:
+            return None
+
+        try:
+            document = self.store.read(key)
+        except Exception as err:
+            logger.error("Unable to read cached source of truth")
+            logger.error(err)
+            return None
+
+        if not document:
+            return None
+
+        entry = CachedSourceOfTruth(document['body'], document.get('etag'), document.get('validated_at', 0),
+                                    document.get('body_hash'))
+
+        # the file may have been revalidated since it was retrieved
+        try:
+            validation = self.store.read(self._validated_key(key))
+        except Exception as err:
+            logger.error("Unable to read source of truth revalidation time")
+            logger.error(err)
+            validation = None
+
+        if validation and validation.get('body_hash') == entry.body_hash:
+            entry.validated_at = max(entry.validated_at, validation.get('validated_at', 0))
+
+        cached_files[key] = entry
+        return entry
+
+    def put(self, url: str, body: str, etag: Optional[str]) -> CachedSourceOfTruth:
+        """
+        Caches a retrieved file. Failures to persist it are logged and do not fail the watcher.
+
+        Args:
+            url: URL of the source of truth file
+            body: file content
+            etag: ETag of the response, if any
+        Returns:
+            The cache entry
+        """
+        key = self._key(url)
+        entry = CachedSourceOfTruth(body, etag, self.clock())
+        cached_files[key] = entry
+
+        if self.store is not None:
+            try:
+                self.store.write(key, {'body': entry.body, 'etag': entry.etag, 'validated_at': entry.validated_at,
+                                       'body_hash': entry.body_hash})
+            except Exception as err:
+                logger.error("Unable to persist cached source of truth")
+                logger.error(err)
+
+        return entry
+
+    def revalidated(self, url: str, entry: CachedSourceOfTruth):
+        """
+        Marks a cached file as current after the provider confirmed it did not change. Failures to persist
+        the revalidation are logged and do not fail the watcher.
+
+        Args:
+            url: URL of the source of truth file
+            entry: cache entry of the file
+        """
+        entry.validated_at = self.clock()
+
+        if self.store is not None:
+            try:
+                self.store.write(self._validated_key(self._key(url)),
+                                 {'body_hash': entry.body_hash, 'validated_at': entry.validated_at})
+            except Exception as err:
+                logger.error("Unable to persist source of truth revalidation time")
+                logger.error(err)
+
+    def age(self, entry: CachedSourceOfTruth) -> float:
+        """Seconds since the cached file was last retrieved or revalidated."""
+        return self.clock() - entry.validated_at
+
+
+def iter_lines(chunks: Iterable[bytes], encoding: str = 'utf-8') -> Iterator[str]:
+    """
+    Decodes the chunks of a response as they arrive and splits them into lines, keeping the line endings
+    for the csv parser.
+
+    Args:
+        chunks: content of the response, as returned by `requests.Response.iter_content`
+        encoding: encoding of the content
+    Returns:
+        An iterator of the lines of the content
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+class SourceOfTruthStream:
+    """
+    Lines of a source of truth file, read as they arrive from the git provider or from the cache.
+
+    The content hash of the file is known upfront for cached files and computed while iterating otherwise.
+    `on_complete` is called with the whole file once every line was read, `close` once the iteration ends.
+    """
+
+    def __init__(self, lines: Iterable[str], body_hash: str = None, on_complete: Callable[[str], None] = None,
+                 close: Callable[[], None] = None):
+        self.lines = lines
+        self.body_hash = body_hash
+        self.on_complete = on_complete
+        self.close = close
+
+    def __iter__(self) -> Iterator[str]:
+        hasher = hashlib.sha256() if self.body_hash is None else None
+        chunks = [] if self.on_complete is not None else None
+
+        try:
+            for line in self.lines:
+                if hasher is not None:
+                    hasher.update(line.encode('utf-8'))
+                if chunks is not None:
+                    chunks.append(line)
+                yield line
+        finally:
+            if self.close is not None:
+                self.close()
+
+        if hasher is not None:
+            self.body_hash = hasher.hexdigest()
+        if chunks is not None:
+            self.on_complete(''.join(chunks))
+
+
+def get_shards_hash(shards: Iterable[Tuple[str, str]]) -> str:
+    """
+    Args:
+        shards: (path, content hash) of every shard of the source of truth
+    Returns:
+        Content hash of the source of truth, changing when any shard is added, removed or modified
+    """
+    hasher = hashlib.sha256()
+    for path, body_hash in sorted(shards):
+        hasher.update(f'{path}:{body_hash}\n'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def merge_shards(shards: Iterable[Tuple[str, str]]) -> Iterator[str]:
+    """
+    Merges the shards of the source of truth into the lines of a single file. The header is the union of the
+    columns of the shards, in order of appearance, and the rows keep the order of the shards. Rows of a shard
+    with the same header as the merged file are kept as is, rows of other shards are reordered and the columns
+    they do not have are left empty.
+
+    A store listed more than once in the same shard is handled like in a single file, the last row wins.
+    A store listed in two shards is ambiguous and fails the merge.
+
+    Args:
+        shards: (path, content) of every shard
+    Returns:
+        An iterator of the lines of the merged file
+    Raises:
+        Exception: when a shard has no store_id column or a store is listed in more than one shard
+    """
+    readers = [(path, csv.reader(io.StringIO(body, newline=''))) for path, body in shards]
+    headers = [next(reader, None) or [] for _, reader in readers]
+    columns = list(dict.fromkeys(name for header in headers for name in header))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def flush() -> str:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return line
+
+    if not columns:
+        return
+    writer.writerow(columns)
+    yield flush()
+
+    store_shards: Dict[str, str] = {}
+    for (path, reader), header in zip(readers, headers):
+        if not header:
+            continue
+        if 'store_id' not in header:
+            raise Exception(f'Source of truth shard {path} has no store_id column')
+
+        store_id_position = header.index('store_id')
+        positions = {name: i for i, name in enumerate(header)}
+        reorder = [positions.get(name) for name in columns] if header != columns else None
+
+        for record in reader:
+            if not record:
+                continue
+
+            store_id = record[store_id_position] if store_id_position < len(record) else None
+            if store_id:
+                if store_shards.get(store_id, path) != path:
+                    raise Exception(f'Store {store_id} of source of truth shard {path} is already listed in '
+                                    f'{store_shards[store_id]}')
+                store_shards[store_id] = path
+
+            if reorder is not None:
+                record = ['' if i is None or i >= len(record) else record[i] for i in reorder]
+            writer.writerow(record)
+            yield flush()
+
+
+def is_projected(column: str, columns: Optional[Iterable[str]]) -> bool:
+    """
+    Args:
+        column: column of the source of truth
+        columns: projected columns, names ending with `*` match every column starting with the prefix. None
+            projects every column.
+    Returns:
+        True if the column is part of the projection
+    """
+    if columns is None:
+        return True
+
+    return any(column == name or (name.endswith('*') and column.startswith(name[:-1])) for name in columns)
+
+
+class ColumnIndex:
+    """Column names of a source of truth file and their position, shared by every row of the file."""
+    __slots__ = ('names', 'positions')
+
+    def __init__(self, names: Iterable[str]):
+        self.names: Tuple[str, ...] = tuple(sys.intern(name) for name in names)
+        self.positions: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+
+
+class StoreRow(Mapping):
+    """
+    Read-only row of the source of truth, a drop-in replacement for the csv.DictReader row dictionary.
+
+    A row only holds a tuple of its values, the column names and positions are shared by every row of the
+    file through a ColumnIndex, and repeated values (project ids, sync repo and branch, cluster version...)
+    are interned so every row references the same string.
+    """
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns: ColumnIndex, values: Tuple[Optional[str], ...]):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        return self.values[self.columns.positions[key]]
+
+    def get(self, key: str, default=None):
+        position = self.columns.positions.get(key)
+        return default if position is None else self.values[position]
+
+    def __contains__(self, key) -> bool:
+        return key in self.columns.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.columns.names)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __repr__(self):
+        return f'StoreRow({dict(self)})'
+
+
+class IntentData(dict):
+    """
+    Intent data as returned by read_intent_data: the rows of the source of truth by (project, location),
+    then by store_id. `stores` indexes every row by store_id.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stores: Dict[str, StoreRow] = {}
+
+    def add(self, proj_loc_key: Tuple[str, str], row: StoreRow):
+        if proj_loc_key not in self:
+            self[proj_loc_key] = {}
+        self[proj_loc_key][row['store_id']] = row
+        self.stores[row['store_id']] = row
+
+    def get_store(self, store_id: str) -> Optional[StoreRow]:
+        return self.stores.get(store_id)
+
+
+def iter_rows(lines: Iterable[str], columns: Optional[Iterable[str]] = None) -> Iterator[StoreRow]:
+    """
+    Parses the source of truth CSV line by line, keeping only the projected columns of each row. Like
+    csv.DictReader, blank lines are skipped and missing trailing values are None.
+
+    Args:
+        lines: lines of the file, with their line endings
+        columns: projected columns, see `is_projected`
+    Returns:
+        An iterator of StoreRow
+    """
+    reader = csv.reader(lines)  # will raise exception if csv parsing fails
+
+    header = next(reader, None)
+    if header is None:
+        return
+
+    columns = list(columns) if columns is not None else None
+    positions = [i for i, name in enumerate(header) if is_projected(name, columns)]
+    column_index = ColumnIndex(header[i] for i in positions)
+    intern = sys.intern
+
+    for record in reader:
+        if not record:
+            continue
+        yield StoreRow(column_index, tuple(intern(record[i]) if i < len(record) else None for i in positions))
+
+
+
+class SourceOfTruthSnapshot:
+    """
+    Parsed revision of the source of truth, shared by the watchers of a process.
+
+    The rows are parsed once per revision and every watcher requests the view it needs: the flat `rows`,
+    or the rows grouped by (project, location) with `grouped_by`. Views are built on first use and reference
+    the same rows.
+    """
+
+    def __init__(self, body_hash: str, columns: Tuple[str, ...], rows: List[StoreRow]):
+        self.body_hash = body_hash
+        self.columns = columns
+        self.rows = rows
+        self.views: Dict[str, IntentData] = {}
+
+    @staticmethod
+    def parse(stream: SourceOfTruthStream, columns: Optional[Iterable[str]] = None) -> 'SourceOfTruthSnapshot':
+        """
+        Args:
+            stream: source of truth file, read until the end
+            columns: projected columns, see `is_projected`
+        Returns:
+            SourceOfTruthSnapshot
+        """
+        rows = list(iter_rows(stream, columns))
+        columns = rows[0].columns.names if rows else ()
+        return SourceOfTruthSnapshot(stream.body_hash, columns, rows)
+
+    def grouped_by(self, named_key: str) -> IntentData:
+        """
+        Args:
+            named_key: project column of the grouping, either 'fleet_project_id' or 'machine_project_id'
+        Returns:
+            The rows by (project, location), then by store_id
+        """
+        view = self.views.get(named_key)
+        if view is None:
+            view = IntentData()
+            for row in self.rows:
+                view.add((row[named_key], row['location']), row)
+            self.views[named_key] = view
+
+        return view
+
+    def to_document(self) -> dict:
+        return {'body_hash': self.body_hash, 'columns': list(self.columns),
+                'rows': [list(row.values) for row in self.rows]}
+
+    @staticmethod
+    def from_document(document: dict) -> 'SourceOfTruthSnapshot':
+        column_index = ColumnIndex(document['columns'])
+        intern = sys.intern
+        rows = [StoreRow(column_index, tuple(intern(value) if value is not None else None for value in values))
+                for values in document['rows']]
+        return SourceOfTruthSnapshot(document['body_hash'], column_index.names, rows)
+
+
+# last parsed snapshot by projected columns, kept across invocations of a warm instance
+snapshots: Dict[Tuple[str, ...], SourceOfTruthSnapshot] = {}
+
+class SourceOfTruthSnapshotCache:
+    """
+    Cache of the parsed source of truth snapshots.
+
+    The last snapshot is kept in memory for the lifetime of the instance and, when a state store is
+    configured, persisted under the content hash of the file, so the other watchers and cold starts
+    load the parsed revision instead of parsing the file again. Only the latest revision of each
+    projection is persisted, the previous snapshot is deleted when a new one is saved.
+    """
+
+    def __init__(self, store: StateStore = None):
+        self.store = store
+
+    @staticmethod
+    def _key(body_hash: str, columns: Tuple[str, ...]) -> str:
+        revision = f"{body_hash}:{','.join(columns)}"
+        return f"sot_snapshot_{hashlib.sha256(revision.encode('utf-8')).hexdigest()[:32]}"
+
+    @staticmethod
+    def _latest_key(columns: Tuple[str, ...]) -> str:
+        return f"sot_snapshot_latest_{hashlib.sha256(','.join(columns).encode('utf-8')).hexdigest()[:32]}"
+
+    def get(self, body_hash: str, columns: Tuple[str, ...]) -> Optional[SourceOfTruthSnapshot]:
+        """
+        Args:
+            body_hash: content hash of the source of truth file
+            columns: projected columns of the snapshot
+        Returns:
+            The snapshot of the revision, or None if it was never parsed
+        """
+        snapshot = snapshots.get(columns)
+        if snapshot is not None and snapshot.body_hash == body_hash:
+            return snapshot
+
+        if self.store is None:
+            return None
+
+        try:
+            document = self.store.read(self._key(body_hash, columns))
+        except Exception as err:
+            logger.error("Unable to read source of truth snapshot")
+            logger.error(err)
+            return None
+
+        if not document:
+            return None
+
+        snapshot = SourceOfTruthSnapshot.from_document(document)
+        snapshots[columns] = snapshot
+        return snapshot
+
+    def put(self, snapshot: SourceOfTruthSnapshot, columns: Tuple[str, ...]):
+        """
+        Caches a parsed snapshot. Failures to persist it are logged and do not fail the watcher.
+
+        Args:
+            snapshot: parsed snapshot
+            columns: projected columns of the snapshot
+        """
+        snapshots[columns] = snapshot
+
+        if self.store is not None and snapshot.body_hash is not None:
+            try:
+                key = self._key(snapshot.body_hash, columns)
+                self.store.write(key, snapshot.to_document())
+
+                previous = (self.store.read(self._latest_key(columns)) or {}).get('key')
+                self.store.write(self._latest_key(columns), {'key': key})
+                if previous and previous != key:
+                    self.store.delete(previous)
+            except Exception as err:
+                logger.error("Unable to persist source of truth snapshot")
+                logger.error(err)
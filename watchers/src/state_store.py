@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+from google.api_core import exceptions
+from google.cloud import storage
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+class StateStore(ABC):
+    """
+    Key/value store for JSON documents that need to survive across watcher invocations.
+
+    Implementations provide `read`, `write` and `delete`; the watchers never list keys.
+    Documents updated by concurrent invocations use `read_with_generation` and `write_if_generation`,
+    which stores without preconditions implement as an unconditional read and write.
+    """
+
+    @abstractmethod
+    def read(self, key: str) -> Optional[dict]:
+        """
+        Args:
+            key: name of the document
+        Returns:
+            The stored document, or None if the key does not exist
+        """
+
+    @abstractmethod
+    def write(self, key: str, value: dict):
+        """
+        Args:
+            key: name of the document
+            value: JSON serializable document
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        """
+        Args:
+            key: name of the document, deleting a missing key is not an error
+        """
+
+    def read_with_generation(self, key: str) -> Tuple[Optional[dict], Optional[str]]:
+        """
+        Args:
+            key: name of the document
+        Returns:
+            The stored document and its generation, (None, None) if the key does not exist
+        """
+        return self.read(key), None
+
+    def write_if_generation(self, key: str, value: dict, generation: Optional[str]) -> bool:
+        """
+        Args:
+            key: name of the document
+            value: JSON serializable document
+            generation: generation returned by `read_with_generation`, None if the document did not exist
+        Returns:
+            False if the document was written by someone else since it was read, nothing is written then
+        """
+        self.write(key, value)
+        return True
+
+
+class LocalFileStateStore(StateStore):
+    """Stores each document as a JSON file in a local directory. Intended for tests and local runs."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def read(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def read_with_generation(self, key: str) -> Tuple[Optional[dict], Optional[str]]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None, None
+
+        return json.loads(content), hashlib.sha256(content).hexdigest()
+
+    def write_if_generation(self, key: str, value: dict, generation: Optional[str]) -> bool:
+        # not atomic across processes, enough for tests and local runs
+        if self.read_with_generation(key)[1] != generation:
+            return False
+
+        self.write(key, value)
+        return True
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def write(self, key: str, value: dict):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write to a temporary file first so readers never observe a partial document
+        tmp_path = f'{self._path(key)}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key))
+
+
+class GcsStateStore(StateStore):
+    """Stores each document as a JSON object in a GCS bucket under an optional prefix."""
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.bucket = storage.Client().bucket(bucket)
+        self.prefix = prefix.strip('/')
+
+    def _name(self, key: str) -> str:
+        return f'{self.prefix}/{key}.json' if self.prefix else f'{key}.json'
+
+    def _blob(self, key: str):
+        return self.bucket.blob(self._name(key))
+
+    def read(self, key: str) -> Optional[dict]:
+        try:
+            return json.loads(self._blob(key).download_as_bytes())
+        except exceptions.NotFound:
+            return None
+
+    def write(self, key: str, value: dict):
+        self._blob(key).upload_from_string(json.dumps(value), content_type='application/json')
+
+    def delete(self, key: str):
+        try:
+            self._blob(key).delete()
+        except exceptions.NotFound:
+            pass
+
+    def read_with_generation(self, key: str) -> Tuple[Optional[dict], Optional[str]]:
+        blob = self.bucket.get_blob(self._name(key))
+        if blob is None:
+            return None, None
+
+        # the content read must be the one of the generation returned
+        return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), str(blob.generation)
+
+    def write_if_generation(self, key: str, value: dict, generation: Optional[str]) -> bool:
+        try:
+            # generation 0 only matches when the object does not exist
+            self._blob(key).upload_from_string(json.dumps(value), content_type='application/json',
+                                               if_generation_match=int(generation) if generation is not None else 0)
+            return True
+        except exceptions.PreconditionFailed:
+            return False
+
+
+def get_state_store(uri: str) -> Optional[StateStore]:
+    """
+    Returns the state store for a URI. `gs://<bucket>/<prefix>` selects GCS, `file://<path>` or a
+    plain path selects a local directory.
+
+    Args:
+        uri: location of the state, may be empty
+    Returns:
+        A StateStore, or None when no URI is configured
+    """
+    if not uri:
+        return None
+
+    parse_result = urlparse(uri)
+
+    if parse_result.scheme == 'gs':
+        return GcsStateStore(parse_result.netloc, parse_result.path)
+    elif parse_result.scheme in ('', 'file'):
+        return LocalFileStateStore(parse_result.path)
+    else:
+        raise Exception(f'Unsupported state store: {uri}')
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+from google.api_core import exceptions
+from google.cloud.devtools import cloudbuild
+from .engine import AsyncEngine, CLOUD_BUILD
+from .schedule import Deadline
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for coroutines running on a single event loop. Allows bursts of up to
+    `burst` calls and `rate` calls per second on average.
+    """
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    async def acquire(self):
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass
+class TriggerRequest:
+    store_id: str
+    zone: str
+    sync_branch: str
+
+
+@dataclass
+class TriggerResult:
+    request: TriggerRequest
+    success: bool
+    attempts: int
+    latency: float
+    error: Exception = None
+    # not sent before the deadline, the store is evaluated again by the next run
+    deferred: bool = False
+
+
+class BuildTriggerDispatcher:
+    """
+    Submits Cloud Build trigger runs concurrently under a token bucket rate limit.
+
+    The watchers queue a TriggerRequest with `submit` while evaluating stores, then `dispatch` runs every
+    queued trigger on the engine. Calls failing with RESOURCE_EXHAUSTED are retried with exponential
+    backoff and jitter, up to `max_attempts` attempts; other errors fail the request immediately. With a
+    deadline, requests that cannot be sent or retried before it are deferred instead.
+    """
+
+    def __init__(self, client: cloudbuild.CloudBuildClient, engine: AsyncEngine, trigger: str, rate: float,
+                 burst: int, max_attempts: int, initial_backoff: float = 1.0, max_backoff: float = 30.0):
+        self.client = client
+        self.engine = engine
+        self.trigger = trigger
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.requests: List[TriggerRequest] = []
+
+    def submit(self, request: TriggerRequest):
+        """Queues a trigger run, it is sent by the next `dispatch`."""
+        self.requests.append(request)
+
+    async def _run(self, bucket: TokenBucket, request: TriggerRequest, deadline: Optional[Deadline]) -> TriggerResult:
+        repo_source = cloudbuild.RepoSource()
+        repo_source.branch_name = request.sync_branch
+        repo_source.substitutions = {
+            "_STORE_ID": request.store_id,
+            "_ZONE": request.zone
+        }
+        req = cloudbuild.RunBuildTriggerRequest(
+            name=self.trigger,
+            source=repo_source
+        )
+        logger.debug(req)
+
+        start = time.monotonic()
+        attempts = 0
+        while True:
+            await bucket.acquire()
+            if deadline is not None and deadline.expired():
+                return TriggerResult(request, False, attempts, time.monotonic() - start, deferred=True)
+
+            attempts += 1
+            try:
+                await self.engine.call(CLOUD_BUILD, self.client.run_build_trigger, request=req)
+                return TriggerResult(request, True, attempts, time.monotonic() - start)
+            except exceptions.ResourceExhausted as err:
+                if attempts >= self.max_attempts:
+                    return TriggerResult(request, False, attempts, time.monotonic() - start, err)
+
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** (attempts - 1))
+                if deadline is not None and deadline.remaining() <= backoff:
+                    return TriggerResult(request, False, attempts, time.monotonic() - start, err, deferred=True)
+
+                logger.warning(f'cloud build quota exhausted for {request.zone}, retrying in {backoff:.1f}s')
+                await asyncio.sleep(backoff * random.uniform(0.5, 1))
+            except Exception as err:
+                return TriggerResult(request, False, attempts, time.monotonic() - start, err)
+
+    def dispatch(self, deadline: Deadline = None) -> List[TriggerResult]:
+        """
+        Sends every queued trigger run and clears the queue.
+
+        Args:
+            deadline: time budget of the invocation, None for no limit
+        Returns:
+            The result of every request, in submission order
+        """
+        requests, self.requests = self.requests, []
+        if not requests:
+            return []
+
+        logger.info(f'triggering {len(requests)} cloud builds, trigger: {self.trigger}')
+
+        async def run_all():
+            bucket = TokenBucket(self.rate, self.burst)
+            return await asyncio.gather(*[self._run(bucket, request, deadline) for request in requests])
+
+        results = self.engine.run(run_all())
+
+        deferred = [result for result in results if result.deferred]
+        if deferred:
+            logger.warning(f'Time budget exhausted, deferring {len(deferred)} of {len(results)} cloud builds '
+                           f'to the next run')
+
+        for result in results:
+            if result.deferred:
+                continue
+            if result.success:
+                logger.info(f'triggered cloud build for {result.request.zone} in {result.latency:.2f}s '
+                            f'({result.attempts} attempts)')
+            else:
+                logger.error(f'failed to trigger cloud build for {result.request.zone} after {result.attempts} '
+                             f'attempts ({result.latency:.2f}s)')
+                logger.error(result.error)
+
+        return results
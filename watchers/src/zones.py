@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+from google.api_core import exceptions
+from google.cloud import gdchardwaremanagement_v1alpha
+from google.cloud.gdchardwaremanagement_v1alpha import Zone
+from .engine import AsyncEngine, HARDWARE_MANAGEMENT
+from .state_store import StateStore
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+def get_zone_location(name: str) -> Optional[Tuple[str, str]]:
+    """
+    Args:
+        name: full zone resource name (projects/<project>/locations/<location>/zones/<store_id>)
+    Returns:
+        The (project, location) of the zone, or None if the name is not a zone resource name
+    """
+    parts = name.split('/')
+    if len(parts) != 6:
+        return None
+
+    return (parts[1], parts[3])
+
+
+class ZoneNameCache:
+    """
+    Persistent cache of zone resource name to the zone's globally_unique_id (the GDC zone name).
+
+    A zone's globally_unique_id does not change once assigned, so entries are reused across
+    invocations until they are older than `ttl_seconds`. Expired entries are ignored on lookup
+    and dropped on save. Zone state is never cached.
+
+    The document is shared by every watcher and shard, `save` merges the entries resolved by this
+    invocation into the stored document and only writes if nobody else wrote it in the meantime,
+    reading and merging again otherwise.
+    """
+    KEY = 'zone_names'
+    MAX_SAVE_ATTEMPTS = 5
+
+    def __init__(self, store: StateStore, ttl_seconds: int, clock=time.time):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries: Dict[str, Tuple[str, float]] = None
+        self.updates: Dict[str, Tuple[str, float]] = {}  # entries resolved by this invocation
+        self.dirty = False
+
+    def _load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        try:
+            document = self.store.read(self.KEY)
+        except Exception as err:
+            logger.error("Unable to read zone name cache, resolving all zone names from the API")
+            logger.error(err)
+            document = None
+
+        if document:
+            for name, (zone_name, resolved_at) in document.get('entries', {}).items():
+                self.entries[name] = (zone_name, resolved_at)
+
+    def get(self, name: str) -> Optional[str]:
+        """
+        Args:
+            name: full zone resource name
+        Returns:
+            The cached zone name, or None if it is not cached or expired
+        """
+        self._load()
+
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+
+        (zone_name, resolved_at) = entry
+        if self.clock() - resolved_at > self.ttl_seconds:
+            return None
+
+        return zone_name
+
+    def put(self, name: str, zone_name: str):
+        """
+        Args:
+            name: full zone resource name
+            zone_name: globally_unique_id of the zone. Zones without one yet are not cached.
+        """
+        if not zone_name:
+            return
+
+        self._load()
+
+        self.entries[name] = (zone_name, self.clock())
+        self.updates[name] = self.entries[name]
+        self.dirty = True
+
+    def save(self):
+        """Persists the cache, evicting expired entries. Failures are logged and do not fail the watcher."""
+        if self.entries is None:
+            return
+
+        now = self.clock()
+        live_entries = {name: entry for name, entry in self.entries.items() if now - entry[1] <= self.ttl_seconds}
+
+        if not self.dirty and len(live_entries) == len(self.entries):
+            return
+
+        try:
+            for _ in range(self.MAX_SAVE_ATTEMPTS):
+                try:
+                    (document, generation) = self.store.read_with_generation(self.KEY)
+                except exceptions.PreconditionFailed:
+                    continue
+
+                # keep the latest resolution of every zone, from the stored document or this invocation
+                entries = {name: (zone_name, resolved_at)
+                           for name, (zone_name, resolved_at) in (document or {}).get('entries', {}).items()}
+                for name, entry in self.updates.items():
+                    if name not in entries or entries[name][1] < entry[1]:
+                        entries[name] = entry
+                live_entries = {name: entry for name, entry in entries.items() if now - entry[1] <= self.ttl_seconds}
+
+                if self.store.write_if_generation(self.KEY, {'entries': live_entries}, generation):
+                    self.entries = live_entries
+                    self.updates = {}
+                    self.dirty = False
+                    return
+
+                logger.debug("Zone name cache updated concurrently, merging again")
+
+            logger.error(f"Unable to persist zone name cache after {self.MAX_SAVE_ATTEMPTS} concurrent updates")
+        except Exception as err:
+            logger.error("Unable to persist zone name cache")
+            logger.error(err)
+
+
+class ZoneIndex:
+    """
+    In-memory index of hardware management zones, keyed by the full zone resource name
+    (projects/<project>/locations/<location>/zones/<store_id>) built from the source of truth, whatever
+    form of the project the server returns.
+
+    The index is built from one paginated ListZones per (machine_project, location) instead of
+    a GetZone per store. Locations are listed up front with `load` or on first lookup. Locations
+    that could not be listed fall back to a GetZone per zone, their listing error is kept in
+    `location_errors`.
+
+    An index lives for a single watcher invocation and memoizes every zone it returns, so each zone
+    is fetched at most once per run. `hits` counts lookups served from memory and `misses` counts
+    the remote calls (ListZones or GetZone) lookups needed.
+    """
+
+    def __init__(self, client: gdchardwaremanagement_v1alpha.GDCHardwareManagementAsyncClient, engine: AsyncEngine,
+                 name_cache: ZoneNameCache = None):
+        self.client = client
+        self.engine = engine
+        self.name_cache = name_cache
+        self.zones: Dict[str, Zone] = {}
+        self.loaded_locations: Set[Tuple[str, str]] = set()
+        self.attempted_locations: Set[Tuple[str, str]] = set()
+        self.location_errors: Dict[Tuple[str, str], Exception] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def fetch(self, locations: Iterable[Tuple[str, str]]):
+        """
+        Lists the zones of every (machine_project, location) pair not yet indexed. Locations are
+        listed concurrently on the engine and a failing location is logged without affecting the others.
+
+        Args:
+            locations: iterable of (machine_project, location) tuples
+        """
+        locations = [key for key in dict.fromkeys(locations) if key not in self.attempted_locations]
+        self.attempted_locations.update(locations)
+
+        async def list_location(proj_loc_key):
+            (machine_project, location) = proj_loc_key
+            req = gdchardwaremanagement_v1alpha.ListZonesRequest(
+                parent=f'projects/{machine_project}/locations/{location}'
+            )
+
+            try:
+                return await self.engine.list(HARDWARE_MANAGEMENT, self.client.list_zones, request=req)
+            except Exception as err:
+                logger.error(f"Error listing zones for project: {machine_project}, location: {location}")
+                logger.error(err)
+                self.location_errors[proj_loc_key] = err
+                return None
+
+        location_zones = await asyncio.gather(*[list_location(key) for key in locations])
+
+        for proj_loc_key, zones in zip(locations, location_zones):
+            if zones is None:
+                continue
+            self.loaded_locations.add(proj_loc_key)
+
+            # the server may name the zones with the project number instead of the project id, zones are
+            # indexed under the name lookups build from the listed (project, location) and the zone id
+            (machine_project, location) = proj_loc_key
+            for zone in zones:
+                zone_id = zone.name.rsplit('/', 1)[-1]
+                self.zones[f'projects/{machine_project}/locations/{location}/zones/{zone_id}'] = zone
+
+    def load(self, locations: Iterable[Tuple[str, str]]):
+        """
+        Blocking version of `fetch`.
+
+        Args:
+            locations: iterable of (machine_project, location) tuples
+        """
+        self.engine.run(self.fetch(locations))
+
+    def get_zone(self, name: str) -> Zone:
+        """
+        Returns the zone from the index, listing its location first if needed. Zones of locations
+        that could not be listed are retrieved with a GetZone call.
+
+        Args:
+            name: full zone resource name
+        Returns:
+            Zone object
+        Raises:
+            NotFound: the zone's location was indexed but the zone is not part of it
+        """
+        if name in self.zones:
+            self.hits += 1
+            return self.zones[name]
+
+        proj_loc_key = get_zone_location(name)
+        if proj_loc_key is not None and proj_loc_key not in self.attempted_locations:
+            self.misses += 1
+            self.load([proj_loc_key])
+
+            if name in self.zones:
+                return self.zones[name]
+
+        if proj_loc_key in self.loaded_locations:
+            self.hits += 1
+            raise exceptions.NotFound(f'zone {name} not found')
+
+        self.misses += 1
+        zone = self.engine.run(self.engine.call(HARDWARE_MANAGEMENT, self.client.get_zone, name=name))
+        self.zones[name] = zone
+        return zone
+
+    def has_cached_zone_name(self, name: str) -> bool:
+        """
+        Args:
+            name: full zone resource name
+        Returns:
+            True if the zone name can be resolved from the name cache without listing the location
+        """
+        return self.name_cache is not None and self.name_cache.get(name) is not None
+
+    def get_zone_name(self, name: str) -> str:
+        """
+        Returns the globally_unique_id of the zone, from the name cache when possible.
+
+        Args:
+            name: full zone resource name
+        Returns:
+            rack zone name
+        """
+        if self.name_cache is not None:
+            zone_name = self.name_cache.get(name)
+            if zone_name is not None:
+                self.hits += 1
+                return zone_name
+
+        zone_name = self.get_zone(name).globally_unique_id
+
+        if self.name_cache is not None:
+            self.name_cache.put(name, zone_name)
+
+        return zone_name
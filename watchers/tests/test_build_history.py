@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import patch, MagicMock, call
 import os
+from datetime import datetime, timedelta, timezone
 from google.cloud.devtools import cloudbuild
 from google.protobuf.timestamp_pb2 import Timestamp
 from google.cloud.devtools.cloudbuild import Build
@@ -12,13 +13,14 @@ from src.build_history import BuildHistory, BuildSummary
 Status = Build.Status
 
 # Helper to create mock build objects
-def create_mock_build(id, status, substitutions=None, create_time_seconds=0):
+def create_mock_build(id, status, substitutions=None, create_time_seconds=0, finish_time=None):
     build = MagicMock(spec=cloudbuild.Build)
     build.id = id
     build.status = status
     build.substitutions = substitutions if substitutions else {}
     # Add a mock create_time if needed for ordering, though the current logic doesn't sort by time
     build.create_time = Timestamp(seconds=create_time_seconds)
+    build.finish_time = finish_time
     return build
 
 class TestBuildSummary(unittest.TestCase):
@@ -131,6 +133,26 @@ class TestBuildSummary(unittest.TestCase):
         self.assertEqual(summary.numberOfFailures, 2)
         self.assertTrue(summary.retriable)
 
+    def test_is_active_in_flight(self):
+        summary = BuildSummary()
+        summary.add_build(create_mock_build("b2", Status.FAILURE))
+        summary.add_build(create_mock_build("b1", Status.WORKING))
+        self.assertTrue(summary.is_active(0, datetime.now(timezone.utc)))
+
+    def test_is_active_cooldown(self):
+        now = datetime(2024, 7, 20, 12, 0, tzinfo=timezone.utc)
+        summary = BuildSummary()
+        summary.add_build(create_mock_build("b1", Status.SUCCESS, finish_time=now - timedelta(minutes=5)))
+        self.assertTrue(summary.is_active(600, now))
+        self.assertFalse(summary.is_active(60, now))
+
+    def test_is_active_latest_build_failed(self):
+        now = datetime(2024, 7, 20, 12, 0, tzinfo=timezone.utc)
+        summary = BuildSummary()
+        summary.add_build(create_mock_build("b2", Status.FAILURE, finish_time=now))
+        summary.add_build(create_mock_build("b1", Status.SUCCESS, finish_time=now))
+        self.assertFalse(summary.is_active(600, now))
+
     def test_is_retriable_false_max_retries_exceeded(self):
         summary = BuildSummary()
         build1 = create_mock_build("b1", Status.FAILURE)
@@ -359,4 +381,20 @@ class TestBuildHistory(unittest.TestCase):
         with self.assertRaisesRegex(Exception, 'missing zone_name'):
             history.should_retry_zone_build(None)
         with self.assertRaisesRegex(Exception, 'missing zone_name'):
-            history.should_retry_zone_build("")
\ No newline at end of file
+            history.should_retry_zone_build("")
+
+    def test_is_zone_build_active(self, MockCloudBuildClient):
+        mock_client = MockCloudBuildClient.return_value
+        mock_trigger = MagicMock(); mock_trigger.name = self.trigger_name; mock_trigger.id = self.trigger_id
+        mock_client.list_build_triggers.return_value = [mock_trigger]
+        now = datetime(2024, 7, 20, 12, 0, tzinfo=timezone.utc)
+        mock_client.list_builds.return_value = [
+            create_mock_build("b2", Status.QUEUED, {"_ZONE": "zone-a"}),
+            create_mock_build("b1", Status.SUCCESS, {"_ZONE": "zone-b"}, finish_time=now - timedelta(hours=1)),
+        ]
+
+        history = BuildHistory(self.project_id, self.region, self.max_retries, self.trigger_name)
+        self.assertTrue(history.is_zone_build_active("zone-a", 600, now))
+        self.assertFalse(history.is_zone_build_active("zone-b", 600, now))
+        self.assertTrue(history.is_zone_build_active("zone-b", 7200, now))
+        self.assertFalse(history.is_zone_build_active("zone-c", 600, now))
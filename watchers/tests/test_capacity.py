@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+from src.capacity import ZoneCapacity, ZoneCapacityIndex
+
+def machine(zone, hosted_node=''):
+    return mock.MagicMock(zone=zone, hosted_node=hosted_node)
+
+class TestZoneCapacityIndex(unittest.TestCase):
+
+    def test_append_counts_free_nodes_and_hosted_clusters(self):
+        index = ZoneCapacityIndex()
+        for m in [
+            machine('zone1'),
+            machine('zone1', 'projects/p1/locations/us-east4/clusters/cluster1/nodePools/pool1/nodes/n1'),
+            machine('zone1', 'projects/p1/locations/us-east4/clusters/cluster1/nodePools/pool1/nodes/n2'),
+            machine('zone2', ' '),
+        ]:
+            index.append(m)
+
+        self.assertEqual(index.get('zone1'), ZoneCapacity(1, 3, frozenset({'cluster1'})))
+        self.assertEqual(index.get('zone2'), ZoneCapacity(1, 1))
+        self.assertIsNone(index.get('zone3'))
+
+    def test_merge_adds_capacity(self):
+        index = ZoneCapacityIndex()
+        index.append(machine('zone1'))
+        other = ZoneCapacityIndex()
+        other.append(machine('zone1', 'projects/p1/locations/us-east4/clusters/cluster1/nodePools/pool1/nodes/n1'))
+        other.append(machine('zone2'))
+
+        index.merge(other)
+
+        self.assertEqual(list(index.zones), ['zone1', 'zone2'])
+        self.assertEqual(index.get('zone1'), ZoneCapacity(1, 2, frozenset({'cluster1'})))
+
+    def test_capacity_is_slotted(self):
+        with self.assertRaises(AttributeError):
+            ZoneCapacity().machines = []
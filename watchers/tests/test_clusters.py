@@ -0,0 +1,27 @@
+import unittest
+from unittest import mock
+from src.clusters import ClusterIndex
+
+def cluster(name, zone):
+    c = mock.MagicMock()
+    c.name = name
+    c.control_plane.local.node_location = zone
+    return c
+
+class TestClusterIndex(unittest.TestCase):
+
+    def test_clusters_are_indexed_by_zone(self):
+        index = ClusterIndex([cluster('c1', 'zone1'), cluster('c2', 'zone2'), cluster('c3', 'zone1')])
+
+        self.assertEqual([c.name for c in index.get('zone1')], ['c1', 'c3'])
+        self.assertEqual([c.name for c in index.get('zone2')], ['c2'])
+        self.assertEqual(index.get('zone3'), [])
+        self.assertEqual(len(index), 3)
+
+    def test_multi_cluster_zones_are_flagged(self):
+        index = ClusterIndex()
+        index.append(cluster('c1', 'zone1'))
+        index.append(cluster('c2', 'zone2'))
+        index.append(cluster('c3', 'zone1'))
+
+        self.assertEqual(index.multi_cluster_zones, {'zone1'})
@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+from dateutil.parser import parse
+from src import desired_state
+from src.desired_state import DesiredClusterState, evict_desired_states, get_desired_state, get_desired_states
+from src.maintenance_windows import MaintenanceExclusionWindow
+
+def generate_row(**kwargs):
+    row = {
+        'store_id': 'store1',
+        'zone_name': '',
+        'machine_project_id': 'm1',
+        'cluster_name': 'cluster1',
+        'node_count': '3',
+        'sync_branch': 'main',
+        'recreate_on_delete': 'true',
+        'maintenance_window_recurrence': 'FREQ=WEEKLY',
+        'maintenance_window_start': '2024-01-01T00:00:00Z',
+        'maintenance_window_end': '2024-01-01T04:00:00Z',
+        'maintenance_exclusion_name_1': 'holidays',
+        'maintenance_exclusion_start_1': '2024-12-20T00:00:00Z',
+        'maintenance_exclusion_end_1': '2025-01-02T00:00:00Z',
+        'subnet_vlans': '100,200',
+        'labels': 'env=prod,tier=edge',
+    }
+    row.update(kwargs)
+    return row
+
+
+class TestDesiredState(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(desired_state, 'compiled_states', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_from_row(self):
+        state = DesiredClusterState.from_row(generate_row())
+
+        self.assertEqual(state.node_count, 3)
+        self.assertEqual(state.maintenance_window_start, parse('2024-01-01T00:00:00Z'))
+        self.assertEqual(state.maintenance_window_end, parse('2024-01-01T04:00:00Z'))
+        self.assertTrue(state.has_maintenance_window)
+        self.assertEqual(state.subnet_vlans, frozenset({100, 200}))
+        self.assertEqual(dict(state.labels), {'env': 'prod', 'tier': 'edge'})
+        self.assertEqual(state.exclusion_windows, {MaintenanceExclusionWindow(
+            'holidays', parse('2024-12-20T00:00:00Z'), parse('2025-01-02T00:00:00Z'))})
+
+    def test_from_row_invalid_values(self):
+        state = DesiredClusterState.from_row(generate_row(node_count='three', subnet_vlans='100,abc',
+                                                          maintenance_window_start='not a date', labels='env',
+                                                          maintenance_exclusion_name_1='freeze',
+                                                          maintenance_exclusion_start_1='not a date',
+                                                          maintenance_exclusion_end_1='2024-01-02T00:00:00Z'))
+
+        self.assertIsNone(state.node_count)
+        self.assertEqual(state.subnet_vlans, frozenset({100}))
+        self.assertFalse(state.has_maintenance_window)
+        self.assertEqual(len(state.labels), 0)
+        self.assertIsNone(state.exclusion_windows)
+
+    def test_immutable(self):
+        state = DesiredClusterState.from_row(generate_row())
+
+        with self.assertRaises(AttributeError):
+            state.node_count = 5
+        with self.assertRaises(AttributeError):
+            state.extra = 1
+        with self.assertRaises(TypeError):
+            state.labels['env'] = 'dev'
+
+    def test_get_desired_state_memoized_by_content(self):
+        with mock.patch.object(DesiredClusterState, 'from_row', wraps=DesiredClusterState.from_row) as from_row:
+            state = get_desired_state(generate_row())
+            self.assertIs(get_desired_state(generate_row()), state)
+            self.assertIsNot(get_desired_state(generate_row(node_count='4')), state)
+
+        self.assertEqual(from_row.call_count, 2)
+
+    def test_get_desired_states_keeps_other_shards(self):
+        get_desired_states({('m1', 'us-east4'): {'store1': generate_row()}})
+        get_desired_states({('m1', 'us-west1'): {'store2': generate_row(store_id='store2')}})
+
+        with mock.patch.object(DesiredClusterState, 'from_row', wraps=DesiredClusterState.from_row) as from_row:
+            states = get_desired_states({('m1', 'us-east4'): {'store1': generate_row()}})
+
+        from_row.assert_not_called()
+        self.assertEqual(list(states), ['store1'])
+        self.assertEqual(len(desired_state.compiled_states), 2)
+
+    def test_evict_desired_states_drops_removed_rows(self):
+        get_desired_states({('m1', 'us-east4'): {'store1': generate_row(), 'store2': generate_row(store_id='store2')}})
+
+        evict_desired_states({('m1', 'us-east4'): {'store1': generate_row()}})
+
+        self.assertEqual(list(desired_state.compiled_states.values()), [get_desired_state(generate_row())])
@@ -0,0 +1,133 @@
+import unittest
+from unittest import mock
+from dateutil.parser import parse
+from src import drift
+from src.drift import DriftContext, DriftDetector, DriftDetectorRegistry
+from src.engine import AsyncEngine
+
+def generate_context(engine, **store_kwargs):
+    store_info = {
+        'machine_project_id': 'm1',
+        'cluster_name': 'cluster1',
+        'maintenance_window_recurrence': 'FREQ=WEEKLY',
+        'maintenance_window_start': '2024-01-01T00:00:00Z',
+        'maintenance_window_end': '2024-01-01T04:00:00Z',
+        'subnet_vlans': '100',
+        'labels': 'env=prod',
+    }
+    store_info.update(store_kwargs)
+
+    cluster = mock.MagicMock()
+    cluster.name = 'projects/p1/locations/us-east4/clusters/cluster1'
+    rw = cluster.maintenance_policy.window.recurring_window
+    rw.recurrence = 'FREQ=WEEKLY'
+    rw.window.start_time = parse('2024-01-01T00:00:00Z')
+    rw.window.end_time = parse('2024-01-01T04:00:00Z')
+
+    en_client = mock.MagicMock()
+    en_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+    en_client.list_subnets.return_value = [mock.MagicMock(vlan_id=100, ipv4_cidr=[])]
+
+    return DriftContext(engine=engine, project_id='p1', location='us-east4', zone='zone1', cluster=cluster,
+                        store_info=store_info, en_client=en_client, gkehub_client=mock.MagicMock(),
+                        memberships={'cluster1': {'env': 'prod'}}, maintenance_policies={cluster.name: {}},
+                        get_maintenance_policy=mock.MagicMock(return_value={}))
+
+
+class FakeDetector(DriftDetector):
+    def __init__(self, name, cost, reasons=(), error=None, on_error=drift.RAISE):
+        self.name = name
+        self.cost = cost
+        self.reasons = list(reasons)
+        self.error = error
+        self.on_error = on_error
+        self.fetched = False
+
+    async def fetch(self, ctx):
+        self.fetched = True
+        if self.error:
+            raise self.error
+
+    def compare(self, ctx, data):
+        return self.reasons
+
+
+class TestDriftDetectorRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+
+    def test_default_registry_in_sync(self):
+        ctx = generate_context(self.engine)
+
+        result = self.engine.run(drift.get_default_registry().detect(ctx))
+
+        self.assertFalse(result.has_update)
+        ctx.get_maintenance_policy.assert_not_called()
+
+    def test_unparseable_exclusions_are_not_compared(self):
+        ctx = generate_context(self.engine, maintenance_exclusion_name_1='freeze',
+                               maintenance_exclusion_start_1='not a date',
+                               maintenance_exclusion_end_1='2024-01-02T00:00:00Z')
+        ctx.maintenance_policies = {}
+
+        result = self.engine.run(drift.get_default_registry().detect(ctx))
+
+        self.assertFalse(result.has_update)
+        ctx.get_maintenance_policy.assert_not_called()
+
+    def test_maintenance_policy_error_skips_the_store(self):
+        ctx = generate_context(self.engine)
+        ctx.maintenance_policies = {}
+        ctx.get_maintenance_policy.side_effect = Exception('unavailable')
+
+        result = self.engine.run(drift.get_default_registry().detect(ctx))
+
+        self.assertTrue(result.error)
+
+    def test_detector_without_compare_cannot_be_created(self):
+        class IncompleteDetector(DriftDetector):
+            name = 'incomplete'
+
+        with self.assertRaises(TypeError):
+            IncompleteDetector()
+
+    def test_local_drift_skips_remote_calls(self):
+        ctx = generate_context(self.engine, maintenance_window_recurrence='FREQ=DAILY')
+
+        result = self.engine.run(drift.get_default_registry().detect(ctx))
+
+        self.assertEqual(result.reasons, ['maintenance window changed'])
+        ctx.en_client.list_subnets.assert_not_called()
+
+    def test_full_diff_gathers_every_reason(self):
+        ctx = generate_context(self.engine, maintenance_window_recurrence='FREQ=DAILY', subnet_vlans='100,200')
+        ctx.memberships = {'cluster1': {'env': 'dev'}}
+
+        result = self.engine.run(drift.get_default_registry().detect(ctx, full_diff=True))
+
+        self.assertEqual(result.reasons, ['maintenance window changed', 'fleet labels changed', 'vlan 200 missing'])
+
+    def test_detectors_run_by_cost(self):
+        cheap = FakeDetector('cheap', 0, ['drift'])
+        expensive = FakeDetector('expensive', 5, ['more drift'])
+        registry = DriftDetectorRegistry([expensive, cheap])
+
+        result = self.engine.run(registry.detect(generate_context(self.engine)))
+
+        self.assertEqual(result.reasons, ['drift'])
+        self.assertFalse(expensive.fetched)
+
+    def test_error_policies(self):
+        ctx = generate_context(self.engine)
+
+        registry = DriftDetectorRegistry([FakeDetector('report', 1, error=Exception('boom'), on_error=drift.REPORT)])
+        self.assertFalse(self.engine.run(registry.detect(ctx)).error)
+
+        registry = DriftDetectorRegistry([FakeDetector('skip', 1, error=Exception('boom'), on_error=drift.SKIP_STORE)])
+        self.assertTrue(self.engine.run(registry.detect(ctx)).error)
+
+        registry = DriftDetectorRegistry([FakeDetector('raise', 1, error=Exception('boom'))])
+        with self.assertRaises(Exception):
+            self.engine.run(registry.detect(ctx))
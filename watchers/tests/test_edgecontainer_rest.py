@@ -0,0 +1,40 @@
+import unittest
+from unittest import mock
+from src.edgecontainer_rest import EdgeContainerRestClient
+
+class TestEdgeContainerRestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.credentials = mock.MagicMock(valid=True, token='token')
+        self.client = EdgeContainerRestClient(self.credentials, endpoint='https://edgecontainer/')
+        self.client.session = mock.MagicMock()
+
+    def test_list_clusters_follows_pages(self):
+        self.client.session.get.side_effect = [
+            mock.MagicMock(status_code=200, json=mock.MagicMock(return_value={
+                'clusters': [{'name': 'c1', 'maintenancePolicy': {'maintenanceExclusions': []}}],
+                'nextPageToken': 'next'})),
+            mock.MagicMock(status_code=200, json=mock.MagicMock(return_value={'clusters': [{'name': 'c2'}]})),
+        ]
+
+        clusters = self.client.list_clusters('p1', 'us-east4')
+
+        self.assertEqual([cluster['name'] for cluster in clusters], ['c1', 'c2'])
+        self.assertEqual(self.client.session.get.call_args_list[1], mock.call(
+            'https://edgecontainer/v1/projects/p1/locations/us-east4/clusters',
+            headers={'Authorization': 'Bearer token'}, params={'pageToken': 'next'}, timeout=10))
+        self.credentials.refresh.assert_not_called()
+
+    def test_token_is_refreshed_when_expired(self):
+        self.credentials.valid = False
+        self.client.session.get.return_value = mock.MagicMock(status_code=200, json=mock.MagicMock(return_value={}))
+
+        self.client.get_cluster('projects/p1/locations/us-east4/clusters/c1')
+
+        self.credentials.refresh.assert_called_once()
+
+    def test_get_cluster_error(self):
+        self.client.session.get.return_value = mock.MagicMock(status_code=403)
+
+        with self.assertRaises(Exception):
+            self.client.get_cluster('projects/p1/locations/us-east4/clusters/c1')
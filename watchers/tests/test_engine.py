@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+import unittest
+from src import engine
+from src.engine import AsyncEngine
+
+class FakeAsyncPager:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.items:
+            raise StopAsyncIteration
+        return self.items.pop(0)
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine({'slow': 2}, default_limit=8)
+        self.addCleanup(self.engine.close)
+
+    def test_call_supports_sync_and_async_functions(self):
+        async def async_fn(value):
+            return value * 2
+
+        def sync_fn(value):
+            return value + 1
+
+        self.assertEqual(self.engine.run(self.engine.call('api', async_fn, 2)), 4)
+        self.assertEqual(self.engine.run(self.engine.call('api', sync_fn, 2)), 3)
+
+    def test_list_supports_sync_and_async_pagers(self):
+        async def async_list(request):
+            return FakeAsyncPager([request, 2])
+
+        def sync_list(request):
+            return iter([request, 2])
+
+        self.assertEqual(self.engine.run(self.engine.list('api', async_list, request=1)), [1, 2])
+        self.assertEqual(self.engine.run(self.engine.list('api', sync_list, request=1)), [1, 2])
+
+    def test_list_keeps_items_retrieved_before_failure(self):
+        def failing_list():
+            yield 1
+            raise Exception('boom')
+
+        items = []
+        with self.assertRaises(Exception):
+            self.engine.run(self.engine.list('api', failing_list, out=items))
+
+        self.assertEqual(items, [1])
+
+    def test_calls_run_concurrently(self):
+        def slow_call():
+            time.sleep(0.2)
+
+        start = time.monotonic()
+        self.engine.run_all(*[self.engine.call('api', slow_call) for _ in range(8)])
+
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_calls_are_limited_per_api(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0}
+
+        async def tracked_call():
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            await asyncio.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+
+        self.engine.run_all(*[self.engine.call('slow', tracked_call) for _ in range(6)])
+
+        self.assertEqual(state['max_active'], 2)
+
+    def test_create_runs_on_engine_loop(self):
+        def factory():
+            return asyncio.get_running_loop()
+
+        self.assertIs(self.engine.create(factory), self.engine.loop)
+
+
+class TestParseApiLimits(unittest.TestCase):
+
+    def test_parse_api_limits(self):
+        self.assertEqual(engine.parse_api_limits("edgecontainer=8, cloudbuild=4"), {'edgecontainer': 8, 'cloudbuild': 4})
+
+    def test_parse_api_limits_empty(self):
+        self.assertEqual(engine.parse_api_limits(None), {})
+        self.assertEqual(engine.parse_api_limits(""), {})
+
+    def test_parse_api_limits_invalid(self):
+        with self.assertRaises(Exception):
+            engine.parse_api_limits("edgecontainer")
+        with self.assertRaises(Exception):
+            engine.parse_api_limits("edgecontainer=0")
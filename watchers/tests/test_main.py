@@ -12,10 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import http.server
+import io
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
+from dateutil.parser import parse
 from src import main
 from google.cloud.gdchardwaremanagement_v1alpha import Zone
+from src.engine import AsyncEngine
+from src.sharding import WatcherResult
+from src import reconcile
+from src import source_of_truth
+from src.source_of_truth import SourceOfTruthCache
+from src.zones import ZoneIndex
 
 class TestMain(unittest.TestCase):
     
@@ -52,4 +66,853 @@ class TestMain(unittest.TestCase):
         mock_client.return_value.get_zone.return_value = mock_zone
 
         result = main.verify_zone_state("mock_store_id", False)
-        self.assertFalse(result)
\ No newline at end of file
+        self.assertFalse(result)
+
+    def test_verify_zone_state_uses_zone_index(self):
+        mock_zone = mock.MagicMock()
+        mock_zone.state = Zone.State.READY_FOR_CUSTOMER_FACTORY_TURNUP_CHECKS
+
+        mock_zone_index = mock.MagicMock()
+        mock_zone_index.get_zone.return_value = mock_zone
+
+        result = main.verify_zone_state("mock_store_id", False, mock_zone_index)
+
+        self.assertTrue(result)
+        mock_zone_index.get_zone.assert_called_once_with("mock_store_id")
+
+    def test_zone_is_fetched_once_per_invocation(self):
+        mock_zone = Zone(globally_unique_id='zone1', state=Zone.State.READY_FOR_CUSTOMER_FACTORY_TURNUP_CHECKS)
+
+        mock_client = mock.MagicMock()
+        mock_client.get_zone.return_value = mock_zone
+        engine = AsyncEngine()
+        self.addCleanup(engine.close)
+        zone_index = ZoneIndex(mock_client, engine)
+
+        self.assertEqual(main.get_zone_name("mock_store_id", zone_index), 'zone1')
+        self.assertTrue(main.verify_zone_state("mock_store_id", False, zone_index))
+        self.assertEqual(main.get_zone_state("mock_store_id", zone_index), Zone.State.READY_FOR_CUSTOMER_FACTORY_TURNUP_CHECKS)
+
+        mock_client.get_zone.assert_called_once_with(name="mock_store_id")
+        self.assertEqual(zone_index.misses, 1)
+        self.assertEqual(zone_index.hits, 2)
+
+    def test_get_zone_locations_only_includes_unresolved_stores(self):
+        config_zone_info = {
+            ('fleet1', 'us-east4'): {
+                'store1': {'zone_name': 'zone1', 'machine_project_id': 'm1'},
+                'store2': {'zone_name': '', 'machine_project_id': 'm2'},
+            },
+            ('fleet2', 'us-west1'): {
+                'store3': {'zone_name': 'zone3', 'machine_project_id': 'm3'},
+            },
+        }
+
+        self.assertEqual(main.get_zone_locations(config_zone_info), [('m2', 'us-east4')])
+
+    def test_list_machines_by_zone_matches_serial_order(self):
+        mock_ec_client = mock.MagicMock()
+        mock_ec_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+
+        machines = {
+            'projects/p1/locations/us-east4': [
+                mock.MagicMock(zone='zone1'), mock.MagicMock(zone='zone2')],
+            'projects/p2/locations/us-west1': [
+                mock.MagicMock(zone='zone2'), mock.MagicMock(zone='zone3')],
+        }
+        mock_ec_client.list_machines.side_effect = lambda req: iter(machines[req.parent])
+
+        with AsyncEngine() as engine:
+            zone_capacity, unprocessed_zones = engine.run(main.list_machines_by_zone(
+                engine, mock_ec_client, [('p1', 'us-east4'), ('p2', 'us-west1')]))
+
+        self.assertEqual(list(zone_capacity.zones.keys()), ['zone1', 'zone2', 'zone3'])
+        self.assertEqual(zone_capacity.get('zone2').total_nodes, 2)
+        self.assertEqual(unprocessed_zones['zone2'], ('p1', 'us-east4'))
+        self.assertEqual(unprocessed_zones['zone3'], ('p2', 'us-west1'))
+
+    def test_list_machines_by_zone_isolates_errors(self):
+        mock_ec_client = mock.MagicMock()
+        mock_ec_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+
+        def list_machines(req):
+            if req.parent == 'projects/p1/locations/us-east4':
+                yield mock.MagicMock(zone='zone1')
+                raise Exception('boom')
+            yield mock.MagicMock(zone='zone3')
+
+        mock_ec_client.list_machines.side_effect = list_machines
+
+        with AsyncEngine() as engine:
+            zone_capacity, unprocessed_zones = engine.run(main.list_machines_by_zone(
+                engine, mock_ec_client, [('p1', 'us-east4'), ('p2', 'us-west1')]))
+
+        # machines listed before the failure are kept, as with a serial listing
+        self.assertEqual(list(zone_capacity.zones.keys()), ['zone1', 'zone3'])
+        self.assertEqual(unprocessed_zones, {'zone1': ('p1', 'us-east4'), 'zone3': ('p2', 'us-west1')})
+
+    def test_list_clusters_by_location(self):
+        mock_ec_client = mock.MagicMock()
+        mock_ec_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+
+        def list_clusters(req):
+            if req.parent == 'projects/p1/locations/us-east4':
+                raise Exception('boom')
+            cluster = mock.MagicMock()
+            cluster.control_plane.local.node_location = 'zone1'
+            return iter([cluster])
+
+        mock_ec_client.list_clusters.side_effect = list_clusters
+
+        with AsyncEngine() as engine:
+            location_clusters, location_policies = engine.run(main.list_clusters_by_location(
+                engine, mock_ec_client, [('p1', 'us-east4'), ('p2', 'us-west1')]))
+
+        self.assertIsNone(location_clusters[('p1', 'us-east4')])
+        self.assertEqual(len(location_clusters[('p2', 'us-west1')].get('zone1')), 1)
+        self.assertEqual(location_policies, {})
+
+    def test_list_clusters_by_location_lists_policy_locations_once(self):
+        mock_ec_client = mock.MagicMock()
+        mock_ec_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+        cluster = mock.MagicMock()
+        cluster.control_plane.local.node_location = 'zone2'
+        mock_ec_client.list_clusters.side_effect = lambda req: iter([cluster])
+        rest_client = mock.MagicMock()
+        policy = {'window': {'recurringWindow': {'recurrence': 'FREQ=WEEKLY'}}, 'maintenanceExclusions': [{'id': 'x'}]}
+
+        def list_clusters(project_id, location):
+            if project_id == 'p2':
+                raise Exception('boom')
+            return [{'name': 'projects/p1/locations/us-east4/clusters/c1',
+                     'controlPlane': {'local': {'nodeLocation': 'zone1'}}, 'maintenancePolicy': policy}]
+
+        rest_client.list_clusters.side_effect = list_clusters
+
+        with AsyncEngine() as engine:
+            location_clusters, location_policies = engine.run(main.list_clusters_by_location(
+                engine, mock_ec_client, [('p1', 'us-east4'), ('p2', 'us-west1')], rest_client,
+                [('p1', 'us-east4'), ('p2', 'us-west1')]))
+
+        self.assertEqual(location_clusters[('p1', 'us-east4')].get('zone1')[0].name,
+                         'projects/p1/locations/us-east4/clusters/c1')
+        self.assertEqual(location_policies[('p1', 'us-east4')], {'projects/p1/locations/us-east4/clusters/c1': policy})
+        # a failed REST listing falls back to ListClusters, without maintenance policies
+        self.assertEqual(len(location_clusters[('p2', 'us-west1')].get('zone2')), 1)
+        self.assertIsNone(location_policies[('p2', 'us-west1')])
+        self.assertEqual([c.args[0].parent for c in mock_ec_client.list_clusters.call_args_list],
+                         ['projects/p2/locations/us-west1'])
+
+    def run_zone_active_metric(self, params):
+        zones = {'projects/p1/locations/us-east4': [
+            Zone(name='projects/p1/locations/us-east4/zones/store1', globally_unique_id='zone1', state=Zone.State.ACTIVE),
+            Zone(name='projects/p1/locations/us-east4/zones/store2', globally_unique_id='zone2', state=Zone.State.PREPARING)]}
+
+        def list_zones(request):
+            if request.parent == 'projects/p2/locations/us-west1':
+                raise main.exceptions.ServiceUnavailable('unavailable')
+            if request.parent == 'projects/p3/locations/us-central1':
+                raise main.exceptions.PermissionDenied('denied')
+            return iter(zones[request.parent])
+
+        client = mock.MagicMock()
+        client.list_zones.side_effect = list_zones
+
+        with mock.patch('src.main.monitoring_v3.MetricServiceClient') as mock_metric_client, \
+                mock.patch('src.main.get_git_token_from_secrets_manager'), \
+                mock.patch('src.main.ClusterIntentReader') as mock_reader, \
+                mock.patch.object(source_of_truth, 'snapshots', {}), \
+                AsyncEngine() as engine, \
+                mock.patch('src.main.get_zone_index', return_value=ZoneIndex(client, engine)):
+            mock_reader.return_value.open_source_of_truth.return_value = source_of_truth.SourceOfTruthStream([
+                'store_id,fleet_project_id,machine_project_id,location,cluster_name,cluster_version\n',
+                'store1,f1,p1,us-east4,cluster1,1.7.0\n',
+                'store2,f1,p1,us-east4,cluster2,1.7.0\n',
+                'store3,f2,p2,us-west1,cluster3,1.7.0\n',
+                'store4,f3,p3,us-central1,cluster4,1.7.0\n'])
+            result = main.run_zone_active_metric(params, engine)
+
+        client.get_zone.assert_not_called()
+        time_series = [ts for c in mock_metric_client.return_value.create_time_series.call_args_list
+                       for ts in c.args[0].time_series]
+        return result, time_series
+
+    def test_zone_active_metric_uses_location_listing_errors(self):
+        params = mock.MagicMock(region='us-east4', state_store=None, metric_change_only=False,
+                                zone_active_store_metrics=True, zone_active_fleet_metrics=False)
+
+        result, time_series = self.run_zone_active_metric(params)
+
+        self.assertEqual(result, 'total zone active flag updated = 3')
+        self.assertEqual({ts.metric.labels['store_id']: ts.points[0].value.int64_value for ts in time_series},
+                         {'store1': 1, 'store2': 0, 'store3': 1})
+        self.assertEqual(time_series[2].metric.labels['zone_name'], '')
+
+    def test_zone_active_metric_fleet_only(self):
+        params = mock.MagicMock(region='us-east4', state_store=None, metric_change_only=False,
+                                zone_active_store_metrics=False, zone_active_fleet_metrics=True)
+
+        result, time_series = self.run_zone_active_metric(params)
+
+        self.assertEqual(result, 'total zone active flag updated = 4')
+        self.assertEqual({(ts.metric.labels['fleet_project_id'], ts.metric.labels['state']): ts.points[0].value.int64_value
+                          for ts in time_series},
+                         {('f1', 'active'): 1, ('f1', 'inactive'): 1, ('f2', 'active'): 1, ('f2', 'inactive'): 0})
+
+    def generate_response(self, status_code, body='', etag=None):
+        headers = {'ETag': etag} if etag else {}
+        content = body.encode('utf-8')
+        response = mock.MagicMock(status_code=status_code, headers=headers)
+        response.iter_content.side_effect = lambda chunk_size: iter([content[i:i + 4] for i in range(0, len(content), 4)])
+        return response
+
+    def generate_intent_reader(self, max_stale=86400):
+        patcher = mock.patch.object(source_of_truth, 'cached_files', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return main.ClusterIntentReader('github.com/org/repo', 'main', 'sot.csv', 'token', SourceOfTruthCache(), max_stale)
+
+    @mock.patch('src.main.requests.get')
+    def test_intent_reader_sends_conditional_requests(self, mock_get):
+        reader = self.generate_intent_reader()
+        mock_get.return_value = self.generate_response(200, 'store_id\nstore1\n', '"v1"')
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\n')
+        self.assertEqual(mock_get.call_args.kwargs['headers']['Accept-Encoding'], 'gzip')
+        self.assertNotIn('If-None-Match', mock_get.call_args.kwargs['headers'])
+
+        mock_get.return_value = self.generate_response(304)
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\n')
+        self.assertEqual(mock_get.call_args.kwargs['headers']['If-None-Match'], '"v1"')
+
+    def test_intent_reader_streams_http_response(self):
+        body = 'store_id,location\n' + ''.join(f'store{i},us-east4\n' for i in range(10000))
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                if 'gzip' in self.path:
+                    content = gzip.compress(content)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        for path in ('/sot.csv', '/gzip/sot.csv'):
+            reader = self.generate_intent_reader()
+            url = f'http://127.0.0.1:{server.server_port}{path}'
+            with mock.patch.object(main.ClusterIntentReader, '_get_url', return_value=url):
+                self.assertEqual(reader.retrieve_source_of_truth(), body)
+            self.assertEqual(reader.cache.get(url).body, body)
+
+    @mock.patch('src.main.requests.get')
+    def test_intent_reader_serves_stale_file_on_provider_errors(self, mock_get):
+        reader = self.generate_intent_reader()
+        mock_get.return_value = self.generate_response(200, 'store_id\nstore1\n')
+        reader.retrieve_source_of_truth()
+
+        mock_get.return_value = self.generate_response(503)
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\n')
+
+        mock_get.side_effect = main.requests.ConnectionError('unreachable')
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\n')
+
+        mock_get.side_effect = None
+        mock_get.return_value = self.generate_response(404)
+        with self.assertRaises(Exception):
+            reader.retrieve_source_of_truth()
+
+    @mock.patch('src.main.requests.get')
+    def test_intent_reader_does_not_serve_files_older_than_max_stale(self, mock_get):
+        reader = self.generate_intent_reader(max_stale=0)
+        mock_get.return_value = self.generate_response(200, 'store_id\nstore1\n')
+        reader.retrieve_source_of_truth()
+
+        mock_get.return_value = self.generate_response(503)
+        with self.assertRaises(Exception):
+            reader.retrieve_source_of_truth()
+
+    @mock.patch('src.main.requests.get')
+    def test_intent_reader_retrieves_shards(self, mock_get):
+        reader = self.generate_intent_reader()
+        reader.sourceOfTruth = 'sot/*.csv'
+        listing = mock.MagicMock(status_code=200, headers={})
+        listing.json.return_value = [{'path': 'sot/west.csv', 'type': 'file'},
+                                     {'path': 'sot/east.csv', 'type': 'file'},
+                                     {'path': 'sot/README.md', 'type': 'file'},
+                                     {'path': 'sot/archive', 'type': 'dir'}]
+        files = {'https://raw.githubusercontent.com/org/repo/main/sot/east.csv': 'store_id\nstore1\n',
+                 'https://raw.githubusercontent.com/org/repo/main/sot/west.csv': 'store_id\nstore2\n'}
+
+        def get(url, headers, timeout, stream=False):
+            if url == 'https://api.github.com/repos/org/repo/contents/sot?ref=main':
+                return listing
+            if 'If-None-Match' in headers:
+                return self.generate_response(304)
+            return self.generate_response(200, files[url], '"v1"')
+
+        mock_get.side_effect = get
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\nstore2\n')
+        self.assertEqual(mock_get.call_count, 3)
+
+        # unchanged shards are only revalidated, the content hash is known before reading the merged file
+        stream = reader.open_source_of_truth()
+        self.assertEqual(stream.body_hash, reader.body_hash)
+        self.assertEqual(''.join(stream), 'store_id\nstore1\nstore2\n')
+
+        mock_get.side_effect = main.requests.ConnectionError('unreachable')
+        self.assertEqual(reader.retrieve_source_of_truth(), 'store_id\nstore1\nstore2\n')
+
+    def test_intent_reader_urls(self):
+        reader = main.ClusterIntentReader('gitlab.com/org/repo', 'main', 'sot/', 'token')
+
+        self.assertTrue(reader.is_sharded())
+        self.assertEqual(reader._get_url('sot/east.csv'),
+                         'https://gitlab.com/api/v4/projects/org%2Frepo/repository/files/sot%2Feast.csv/raw?ref=main&private_token=token')
+        self.assertEqual(reader._get_listing_url('sot'),
+                         'https://gitlab.com/api/v4/projects/org%2Frepo/repository/tree?path=sot&ref=main&per_page=100&private_token=token')
+        self.assertFalse(main.ClusterIntentReader('gitlab.com/org/repo', 'main', 'sot.csv', 'token').is_sharded())
+
+    @mock.patch('src.main.get_git_token_from_secrets_manager')
+    @mock.patch('src.main.requests.get')
+    def test_read_intent_data_reuses_snapshot_of_unchanged_file(self, mock_get, mock_token):
+        self.generate_intent_reader()
+        params = mock.MagicMock(state_store=None, sot_max_stale=86400, source_of_truth_repo='github.com/org/repo',
+                                source_of_truth_path='sot.csv')
+        mock_get.return_value = self.generate_response(
+            200, 'store_id,machine_project_id,fleet_project_id,location\nstore1,p1,f1,us-east4\n', '"v1"')
+
+        with mock.patch.object(source_of_truth, 'snapshots', {}):
+            config_zone_info = main.read_intent_data(params, 'machine_project_id')
+            self.assertEqual(list(config_zone_info), [('p1', 'us-east4')])
+
+            mock_get.return_value = self.generate_response(304)
+            with mock.patch('src.main.SourceOfTruthSnapshot.parse') as mock_parse:
+                self.assertIs(main.read_intent_data(params, 'machine_project_id'), config_zone_info)
+                fleet_zone_info = main.read_intent_data(params, 'fleet_project_id')
+            mock_parse.assert_not_called()
+
+        self.assertEqual(list(fleet_zone_info), [('f1', 'us-east4')])
+        self.assertIs(fleet_zone_info[('f1', 'us-east4')]['store1'], config_zone_info[('p1', 'us-east4')]['store1'])
+
+    @mock.patch('src.main.get_git_token_from_secrets_manager')
+    @mock.patch('src.main.requests.get')
+    def test_read_intent_data_loads_persisted_snapshot(self, mock_get, mock_token):
+        self.generate_intent_reader()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        params = mock.MagicMock(state_store=directory, sot_max_stale=86400, source_of_truth_repo='github.com/org/repo',
+                                source_of_truth_path='sot.csv')
+        mock_get.return_value = self.generate_response(
+            200, 'store_id,machine_project_id,location\nstore1,p1,us-east4\n', '"v1"')
+
+        with mock.patch.object(source_of_truth, 'snapshots', {}):
+            config_zone_info = main.read_intent_data(params, 'machine_project_id')
+
+        # another function, or a cold start, only revalidates the file and loads the parsed snapshot
+        mock_get.return_value = self.generate_response(304)
+        with mock.patch.object(source_of_truth, 'cached_files', {}), \
+                mock.patch.object(source_of_truth, 'snapshots', {}), \
+                mock.patch('src.main.SourceOfTruthSnapshot.parse') as mock_parse:
+            self.assertEqual(main.read_intent_data(params, 'machine_project_id'), config_zone_info)
+        mock_parse.assert_not_called()
+
+    @mock.patch('src.main.get_git_token_from_secrets_manager')
+    @mock.patch('src.main.requests.get')
+    def test_read_intent_data_projects_columns(self, mock_get, mock_token):
+        self.generate_intent_reader()
+        params = mock.MagicMock(state_store=None, sot_max_stale=86400, source_of_truth_repo='github.com/org/repo',
+                                source_of_truth_path='sot.csv')
+        mock_get.return_value = self.generate_response(
+            200, 'store_id,machine_project_id,location,cluster_name,sync_repo\nstore1,p1,us-east4,cluster1,repo\n')
+
+        with mock.patch.object(source_of_truth, 'snapshots', {}):
+            config_zone_info = main.read_intent_data(params, 'machine_project_id')
+
+        self.assertEqual(config_zone_info, {('p1', 'us-east4'): {'store1': {
+            'store_id': 'store1', 'machine_project_id': 'p1', 'location': 'us-east4', 'cluster_name': 'cluster1'}}})
+        self.assertTrue(mock_get.call_args.kwargs['stream'])
+
+    def generate_watcher_params(self, **kwargs):
+        params = mock.MagicMock(max_workers=4, state_store=None, drift_full_diff=False, build_cooldown=0,
+                                cloud_build_trigger='projects/p1/locations/us-central1/triggers/t1', trigger_rate=100,
+                                trigger_burst=10, trigger_max_attempts=1)
+        params.configure_mock(**kwargs)
+        return params
+
+    def generate_watcher_row(self, store_id, zone, **kwargs):
+        row = {
+            'store_id': store_id,
+            'machine_project_id': 'm1',
+            'fleet_project_id': 'f1',
+            'location': 'us-east4',
+            'cluster_name': f'cluster-{store_id}',
+            'zone_name': zone,
+            'node_count': '3',
+            'sync_branch': 'main',
+            'maintenance_window_recurrence': 'FREQ=WEEKLY',
+            'maintenance_window_start': '2024-01-01T00:00:00Z',
+            'maintenance_window_end': '2024-01-01T04:00:00Z',
+            'subnet_vlans': '100',
+            'labels': 'env=prod',
+        }
+        row.update(kwargs)
+        return row
+
+    def generate_watcher_clients(self, ec_client):
+        clients = {
+            main.edgecontainer.EdgeContainerAsyncClient: ec_client,
+            main.edgenetwork.EdgeNetworkClient: mock.MagicMock(),
+            main.gkehub_v1.GkeHubClient: mock.MagicMock(),
+        }
+        clients[main.edgenetwork.EdgeNetworkClient].common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+        clients[main.edgenetwork.EdgeNetworkClient].list_subnets.side_effect = \
+            lambda req: [mock.MagicMock(vlan_id=100, ipv4_cidr=[])]
+        ec_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+        return lambda client_class, variable: clients.get(client_class) or mock.MagicMock()
+
+    def test_run_zone_watcher(self):
+        # store1 needs a cluster, store2 already has one, store3 has no machines listed, store4 is in a
+        # location whose machines cannot be listed
+        config_zone_info = {
+            ('m1', 'us-east4'): {
+                'store1': self.generate_watcher_row('store1', 'zone1'),
+                'store2': self.generate_watcher_row('store2', 'zone2'),
+                'store3': self.generate_watcher_row('store3', 'zone3'),
+            },
+            ('m1', 'us-west1'): {'store4': self.generate_watcher_row('store4', 'zone4', location='us-west1')},
+        }
+        machines = [mock.MagicMock(zone='zone1', hosted_node='') for _ in range(3)] + [
+            mock.MagicMock(zone='zone2', hosted_node='projects/m1/locations/us-east4/clusters/cluster-store2/nodePools/p/nodes/n')]
+
+        def list_machines(req):
+            if req.parent == 'projects/m1/locations/us-west1':
+                raise main.exceptions.ServiceUnavailable('unavailable')
+            return iter(machines)
+
+        ec_client = mock.MagicMock()
+        ec_client.list_machines.side_effect = list_machines
+        builds = mock.MagicMock()
+        builds.should_retry_zone_build.return_value = False
+
+        with AsyncEngine() as engine, \
+                mock.patch('src.main.get_client', side_effect=self.generate_watcher_clients(ec_client)), \
+                mock.patch('src.main.BuildHistory', return_value=builds), \
+                mock.patch('src.main.cloudbuild.CloudBuildClient') as mock_cloudbuild:
+            result = main.run_zone_watcher(self.generate_watcher_params(), engine, config_zone_info,
+                                           main.StoreSchedule.from_zone_info(config_zone_info, main.Deadline(60), 5))
+
+        self.assertEqual(result.outcomes, {
+            'store1': (reconcile.TRIGGERED, 'zone1'),
+            'store2': (reconcile.IN_SYNC, 'zone2'),
+            'store3': (reconcile.NO_MACHINES, 'zone3'),
+            'store4': (reconcile.NO_MACHINES, 'zone4'),
+        })
+        self.assertEqual(result.count, 3)
+        self.assertEqual(result.deferred, [])
+        self.assertEqual(mock_cloudbuild.return_value.run_build_trigger.call_count, 1)
+        substitutions = mock_cloudbuild.return_value.run_build_trigger.call_args.kwargs['request'].source.substitutions
+        self.assertEqual((substitutions['_STORE_ID'], substitutions['_ZONE']), ('store1', 'zone1'))
+
+    def run_cluster_watcher(self, config_zone_info, deadline, get_cluster=None):
+        def cluster(store_id, zone):
+            c = mock.MagicMock()
+            c.name = f'projects/f1/locations/us-east4/clusters/cluster-{store_id}'
+            c.control_plane.local.node_location = zone
+            rw = c.maintenance_policy.window.recurring_window
+            rw.recurrence = 'FREQ=WEEKLY'
+            rw.window.start_time = parse('2024-01-01T00:00:00Z')
+            rw.window.end_time = parse('2024-01-01T04:00:00Z')
+            return c
+
+        ec_client = mock.MagicMock()
+        ec_client.list_clusters.side_effect = lambda req: iter([cluster(f'store{i}', f'zone{i}') for i in range(1, 4)])
+        clients = self.generate_watcher_clients(ec_client)
+        gkehub_client = clients(main.gkehub_v1.GkeHubClient, None)
+        memberships = [mock.MagicMock(labels={'env': 'prod'}), mock.MagicMock(labels={'env': 'prod'}),
+                       mock.MagicMock(labels={'env': 'dev'})]
+        for i, membership in enumerate(memberships):
+            membership.name = f'projects/f1/locations/global/memberships/cluster-store{i + 1}'
+        gkehub_client.list_memberships.side_effect = lambda request: iter(memberships)
+
+        # the maintenance policies can't be listed, they are retrieved per cluster
+        rest_client = mock.MagicMock()
+        rest_client.list_clusters.side_effect = Exception('unavailable')
+        rest_client.get_cluster.side_effect = get_cluster or (lambda name: {'maintenancePolicy': {}})
+        builds = mock.MagicMock()
+        builds.is_zone_build_active.return_value = False
+
+        with AsyncEngine() as engine, \
+                mock.patch('src.main.get_client', side_effect=clients), \
+                mock.patch('src.main.EdgeContainerRestClient', return_value=rest_client), \
+                mock.patch('src.main.BuildHistory', return_value=builds), \
+                mock.patch('src.main.cloudbuild.CloudBuildClient') as mock_cloudbuild:
+            result = main.run_cluster_watcher(self.generate_watcher_params(), engine, config_zone_info,
+                                              main.StoreSchedule.from_zone_info(config_zone_info, deadline, 5))
+
+        rest_client.close.assert_called_once()
+        triggered = [c.kwargs['request'] for c in mock_cloudbuild.return_value.run_build_trigger.call_args_list]
+        return result, triggered
+
+    def test_run_cluster_watcher(self):
+        # store1 is in sync, the maintenance policy of store2 cannot be retrieved, store3 has label drift
+        config_zone_info = {('f1', 'us-east4'): {
+            f'store{i}': self.generate_watcher_row(f'store{i}', f'zone{i}') for i in range(1, 4)}}
+
+        def get_cluster(name):
+            if name.endswith('cluster-store2'):
+                raise Exception('unavailable')
+            return {'maintenancePolicy': {}}
+
+        result, triggered = self.run_cluster_watcher(config_zone_info, main.Deadline(60), get_cluster)
+
+        self.assertEqual(result.outcomes, {
+            'store1': (reconcile.IN_SYNC, 'zone1'),
+            'store2': (reconcile.ERROR, 'zone2'),
+            'store3': (reconcile.TRIGGERED, 'zone3'),
+        })
+        self.assertEqual(result.count, 3)
+        self.assertEqual([request.source.substitutions['_STORE_ID'] for request in triggered], ['store3'])
+
+    def test_run_cluster_watcher_defers_stores_past_the_deadline(self):
+        config_zone_info = {('f1', 'us-east4'): {
+            f'store{i}': self.generate_watcher_row(f'store{i}', f'zone{i}') for i in range(1, 4)}}
+
+        result, triggered = self.run_cluster_watcher(config_zone_info, main.Deadline(0))
+
+        self.assertEqual(result.outcomes, {})
+        self.assertEqual(sorted(result.deferred), ['store1', 'store2', 'store3'])
+        self.assertEqual(triggered, [])
+
+    def test_run_watcher_unsharded(self):
+        params = mock.MagicMock(max_shards=0, incremental=False, state_store=None)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {'store1': {}}}
+        run_stores = mock.MagicMock(return_value=WatcherResult(1))
+
+        result = main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(result, 'total zones triggered = 1')
+        self.assertEqual(run_stores.call_args.args[0], config_zone_info)
+        self.assertEqual(list(run_stores.call_args.args[1]), [(('p1', 'us-east4'), 'store1')])
+
+    def test_run_watcher_coordinator_aggregates_shards(self):
+        params = mock.MagicMock(max_shards=4, stores_per_shard=1, shard_strategy='location', shard_dispatcher='http',
+                                incremental=False, state_store=None)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {
+            ('p1', 'us-east4'): {'store1': {}, 'store2': {}},
+            ('p2', 'us-west1'): {'store3': {}},
+        }
+        run_stores = mock.MagicMock()
+
+        with mock.patch('src.main.HttpShardDispatcher') as mock_dispatcher:
+            mock_dispatcher.return_value.dispatch.return_value = [WatcherResult(2), WatcherResult(1)]
+            result = main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(result, 'total zones triggered = 3')
+        self.assertEqual(len(mock_dispatcher.return_value.dispatch.call_args.args[0]), 2)
+        run_stores.assert_not_called()
+
+    def test_run_watcher_in_process_runs_unsharded(self):
+        params = mock.MagicMock(max_shards=4, stores_per_shard=1, shard_strategy='location', shard_dispatcher='inprocess',
+                                incremental=False, state_store=None)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {'store1': {}}, ('p2', 'us-west1'): {'store2': {}}}
+        run_stores = mock.MagicMock(return_value=WatcherResult(2))
+
+        with mock.patch('src.main.HttpShardDispatcher') as mock_dispatcher:
+            result = main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(result, 'total zones triggered = 2')
+        run_stores.assert_called_once()
+        self.assertEqual(run_stores.call_args.args[0], config_zone_info)
+        mock_dispatcher.assert_not_called()
+
+    def test_run_watcher_worker_processes_its_shard(self):
+        params = mock.MagicMock()
+        req = mock.MagicMock()
+        req.get_json.return_value = {'shard': {'index': 0, 'count': 2, 'strategy': 'location', 'locations': [['p2', 'us-west1']]}}
+        config_zone_info = {
+            ('p1', 'us-east4'): {'store1': {}, 'store2': {}},
+            ('p2', 'us-west1'): {'store3': {}},
+        }
+        run_stores = mock.MagicMock(return_value=WatcherResult(1, {'zone9': ('p2', 'us-west1')}))
+
+        result = main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(result, {'count': 1, 'unprocessed_zones': {'zone9': ['p2', 'us-west1']}, 'outcomes': {}, 'deferred': []})
+        self.assertEqual(run_stores.call_args.args[0], {('p2', 'us-west1'): {'store3': {}}})
+
+    def test_run_watcher_sends_remaining_budget_to_workers(self):
+        params = mock.MagicMock(max_shards=4, stores_per_shard=1, shard_strategy='location', shard_dispatcher='http',
+                                incremental=False, state_store=None)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {'store1': {}}, ('p2', 'us-west1'): {'store2': {}}}
+        deadline = mock.MagicMock()
+        deadline.remaining.return_value = 40
+
+        with mock.patch('src.main.HttpShardDispatcher') as mock_dispatcher:
+            mock_dispatcher.return_value.dispatch.return_value = [WatcherResult(1), WatcherResult(1)]
+            main.run_watcher(req, params, mock.MagicMock(), config_zone_info, mock.MagicMock(), 'zone_watcher', deadline)
+
+        shards = mock_dispatcher.return_value.dispatch.call_args.args[0]
+        self.assertEqual([shard.budget for shard in shards], [40 - main.SHARD_RESPONSE_MARGIN] * 2)
+
+    def test_run_watcher_worker_uses_shard_budget(self):
+        req = mock.MagicMock()
+        req.get_json.return_value = {'shard': {'index': 0, 'count': 1, 'strategy': 'location',
+                                               'locations': [['p1', 'us-east4']], 'budget': 0}}
+        config_zone_info = {('p1', 'us-east4'): {'store1': {}}}
+        run_stores = mock.MagicMock(return_value=WatcherResult())
+
+        main.run_watcher(req, mock.MagicMock(), mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher',
+                         main.Deadline(45))
+
+        self.assertTrue(run_stores.call_args.args[1].deadline.expired())
+
+    def test_run_watcher_defers_stores_of_deferred_triggers(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        params = mock.MagicMock(max_shards=0, incremental=False, drift_slices=1000, state_store=state_dir,
+                                trigger_reserve=10)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {'store1': {}, 'store2': {}}}
+        schedules = []
+
+        def run_stores(zone_info, schedule):
+            schedules.append(schedule)
+            # store2 was evaluated but its trigger could not be sent before the deadline
+            return WatcherResult(1, outcomes={'store1': (reconcile.TRIGGERED, 'zone1')}, deferred=['store2'])
+
+        main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher', main.Deadline(45))
+        main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher', main.Deadline(45))
+
+        self.assertEqual(schedules[0].reserve, 10)
+        self.assertEqual([store_id for _, store_id in schedules[1].stores], ['store2', 'store1'])
+
+    def test_run_watcher_incremental_only_evaluates_selected_stores(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        params = mock.MagicMock(max_shards=0, incremental=True, drift_slices=1000, state_store=state_dir)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {'store1': {'cluster_name': 'c1'}, 'store2': {'cluster_name': 'c2'}}}
+        outcomes = {'store1': (reconcile.IN_SYNC, 'zone1'), 'store2': (reconcile.TRIGGERED, 'zone2')}
+        run_stores = mock.MagicMock(side_effect=lambda zone_info, schedule: WatcherResult(
+            outcomes={store_id: outcomes[store_id] for stores in zone_info.values() for store_id in stores}))
+
+        with mock.patch('src.reconcile.ReconcileState._in_drift_slice', return_value=False):
+            main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+            main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(run_stores.call_args_list[1].args[0], {('p1', 'us-east4'): {'store2': {'cluster_name': 'c2'}}})
+
+    def test_run_watcher_resumes_deferred_stores_first(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        params = mock.MagicMock(max_shards=0, incremental=False, drift_slices=1, state_store=state_dir)
+        req = mock.MagicMock()
+        req.get_json.return_value = None
+        config_zone_info = {('p1', 'us-east4'): {f'store{i}': {} for i in range(4)}}
+        schedules = []
+
+        def run_stores(zone_info, schedule):
+            # evaluate two stores per run, as if the time budget ran out
+            stores = [store_id for _, store_id in schedule.stores]
+            schedules.append(stores)
+            return WatcherResult(outcomes={store_id: (reconcile.IN_SYNC, None) for store_id in stores[:2]},
+                                 deferred=stores[2:])
+
+        for _ in range(3):
+            main.run_watcher(req, params, mock.MagicMock(), config_zone_info, run_stores, 'zone_watcher')
+
+        self.assertEqual(schedules[0], ['store0', 'store1', 'store2', 'store3'])
+        # never reconciled stores first
+        self.assertEqual(schedules[1], ['store2', 'store3', 'store0', 'store1'])
+        # steady state, resuming from the cursor
+        self.assertEqual(schedules[2], ['store0', 'store1', 'store2', 'store3'])
+
+    def generate_cluster_store_info(self, **kwargs):
+        store_info = {
+            'machine_project_id': 'm1',
+            'cluster_name': 'cluster1',
+            'maintenance_window_recurrence': '',
+            'maintenance_window_start': '',
+            'maintenance_window_end': '',
+            'subnet_vlans': '100,200',
+            'labels': 'env=prod',
+        }
+        store_info.update(kwargs)
+        return store_info
+
+    def generate_drift_clients(self, vlans=(100, 200), labels=None, delay=0):
+        en_client = mock.MagicMock()
+        en_client.common_location_path.side_effect = lambda p, l: f'projects/{p}/locations/{l}'
+
+        def list_subnets(req):
+            time.sleep(delay)
+            return [mock.MagicMock(vlan_id=vlan, ipv4_cidr=[]) for vlan in vlans]
+
+        en_client.list_subnets.side_effect = list_subnets
+
+        gkehub_client = mock.MagicMock()
+
+        def get_membership(request):
+            time.sleep(delay)
+            return mock.MagicMock(labels=labels if labels is not None else {'env': 'prod'})
+
+        gkehub_client.get_membership.side_effect = get_membership
+        return en_client, gkehub_client
+
+    def test_check_cluster_drift_in_sync(self):
+        en_client, gkehub_client = self.generate_drift_clients()
+
+        with AsyncEngine() as engine:
+            has_update = engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info()))
+
+        self.assertFalse(has_update)
+
+    def test_check_cluster_drift_detects_missing_vlan_and_labels(self):
+        with AsyncEngine() as engine:
+            en_client, gkehub_client = self.generate_drift_clients(vlans=(100,))
+            self.assertTrue(engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info())))
+
+            en_client, gkehub_client = self.generate_drift_clients(labels={'env': 'dev'})
+            self.assertTrue(engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info())))
+
+    def test_check_cluster_drift_subnet_error(self):
+        en_client, gkehub_client = self.generate_drift_clients()
+        en_client.list_subnets.side_effect = Exception('boom')
+
+        with AsyncEngine() as engine:
+            has_update = engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info()))
+
+        self.assertIsNone(has_update)
+
+    @mock.patch('src.main.get_maintenance_window_property')
+    def test_check_cluster_drift_runs_checks_in_parallel(self, mock_get_mw):
+        def get_mw(cluster_name, rest_client=None):
+            time.sleep(0.3)
+            return {}
+
+        mock_get_mw.side_effect = get_mw
+        en_client, gkehub_client = self.generate_drift_clients(delay=0.3)
+        cluster = mock.MagicMock()
+        cluster.maintenance_policy.window.recurring_window.recurrence = 'FREQ=WEEKLY'
+        cluster.maintenance_policy.window.recurring_window.window.start_time = parse('2024-01-01T00:00:00Z')
+        cluster.maintenance_policy.window.recurring_window.window.end_time = parse('2024-01-01T04:00:00Z')
+        store_info = self.generate_cluster_store_info(maintenance_window_recurrence='FREQ=WEEKLY',
+                                                      maintenance_window_start='2024-01-01T00:00:00Z',
+                                                      maintenance_window_end='2024-01-01T04:00:00Z')
+
+        start = time.monotonic()
+        with AsyncEngine() as engine:
+            engine.run(main.check_cluster_drift(engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1',
+                                                cluster, store_info))
+
+        mock_get_mw.assert_called_once_with(cluster.name, None)
+        self.assertLess(time.monotonic() - start, 0.8)
+
+    def test_check_cluster_drift_uses_prefetched_memberships(self):
+        en_client, gkehub_client = self.generate_drift_clients()
+
+        with AsyncEngine() as engine:
+            self.assertFalse(engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info(), {'cluster1': {'env': 'prod'}})))
+            self.assertTrue(engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info(), {'cluster1': {'env': 'dev'}})))
+            # a missing membership is reported instead of raising
+            self.assertFalse(engine.run(main.check_cluster_drift(
+                engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1', mock.MagicMock(),
+                self.generate_cluster_store_info(), {})))
+
+        gkehub_client.get_membership.assert_not_called()
+
+    def test_list_memberships_by_project(self):
+        gkehub_client = mock.MagicMock()
+
+        def list_memberships(request):
+            if request.parent == 'projects/p2/locations/global':
+                raise Exception('boom')
+            membership = mock.MagicMock(labels={'env': 'prod'})
+            membership.name = 'projects/p1/locations/global/memberships/cluster1'
+            return iter([membership])
+
+        gkehub_client.list_memberships.side_effect = list_memberships
+
+        with AsyncEngine() as engine:
+            project_memberships = engine.run(main.list_memberships_by_project(engine, gkehub_client, ['p1', 'p2', 'p1']))
+
+        self.assertEqual(project_memberships, {'p1': {'cluster1': {'env': 'prod'}}, 'p2': None})
+        self.assertEqual(gkehub_client.list_memberships.call_count, 2)
+
+    def test_get_label_projects(self):
+        config_zone_info = {
+            ('p1', 'us-east4'): {'store1': {'labels': 'env=prod'}},
+            ('p2', 'us-east4'): {'store2': {'labels': ' '}, 'store3': {}},
+        }
+
+        self.assertEqual(main.get_label_projects(config_zone_info), ['p1'])
+
+    @mock.patch('src.main.get_maintenance_window_property')
+    def test_check_cluster_drift_uses_prefetched_maintenance_policies(self, mock_get_mw):
+        en_client, gkehub_client = self.generate_drift_clients()
+        cluster = mock.MagicMock()
+        cluster.name = 'projects/p1/locations/us-east4/clusters/cluster1'
+        cluster.maintenance_policy.window.recurring_window.recurrence = 'FREQ=WEEKLY'
+        cluster.maintenance_policy.window.recurring_window.window.start_time = parse('2024-01-01T00:00:00Z')
+        cluster.maintenance_policy.window.recurring_window.window.end_time = parse('2024-01-01T04:00:00Z')
+        store_info = self.generate_cluster_store_info(maintenance_window_recurrence='FREQ=WEEKLY',
+                                                      maintenance_window_start='2024-01-01T00:00:00Z',
+                                                      maintenance_window_end='2024-01-01T04:00:00Z')
+
+        with AsyncEngine() as engine:
+            has_update = engine.run(main.check_cluster_drift(engine, en_client, gkehub_client, 'p1', 'us-east4', 'zone1',
+                                                             cluster, store_info, None, None, {cluster.name: {}}))
+
+        self.assertFalse(has_update)
+        mock_get_mw.assert_not_called()
+
+    def test_get_active_build_zones(self):
+        builds = mock.MagicMock()
+        builds.is_zone_build_active.side_effect = lambda zone, cooldown: zone == 'zone1'
+
+        self.assertEqual(main.get_active_build_zones(builds, {'zone1', 'zone2'}, 600), {'zone1'})
+
+        builds.is_zone_build_active.side_effect = Exception('No triggers found named trigger')
+        self.assertEqual(main.get_active_build_zones(builds, {'zone1', 'zone2'}, 600), set())
+
+    def test_get_maintenance_window_locations(self):
+        config_zone_info = {
+            ('p1', 'us-east4'): {'store1': {'maintenance_window_recurrence': 'FREQ=WEEKLY', 'maintenance_window_start': 's',
+                                            'maintenance_window_end': 'e'}},
+            ('p2', 'us-east4'): {'store2': {'maintenance_window_recurrence': 'FREQ=WEEKLY', 'maintenance_window_start': '',
+                                            'maintenance_window_end': 'e'}},
+        }
+
+        self.assertEqual(main.get_maintenance_window_locations(config_zone_info), [('p1', 'us-east4')])
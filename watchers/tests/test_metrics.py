@@ -0,0 +1,157 @@
+import tempfile
+import unittest
+from unittest import mock
+from google.api_core import exceptions
+from google.cloud import monitoring_v3
+from google.protobuf import any_pb2
+from src.engine import AsyncEngine
+from src.metrics import ZONE_ACTIVE_COUNT_METRIC, MetricEmissionState, TimeSeriesWriter, get_zone_active_count_series
+from src.state_store import LocalFileStateStore
+
+def time_series(store_id, value):
+    return {
+        'metric': {'type': 'custom.googleapis.com/gdc_zone_active', 'labels': {'store_id': store_id}},
+        'resource': {'type': 'global', 'labels': {'project_id': 'p1'}},
+        'points': [{'interval': {'end_time': {'seconds': 0}}, 'value': {'int64_value': value}}]
+    }
+
+class TestMetricEmissionState(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LocalFileStateStore(tempfile.mkdtemp())
+        self.now = 1000.0
+
+    def new_state(self):
+        return MetricEmissionState(self.store, 'metrics_test', 600, clock=lambda: self.now)
+
+    def test_only_changed_series_are_selected(self):
+        series = [time_series('store1', 1), time_series('store2', 0)]
+        state = self.new_state()
+        self.assertEqual(state.select(series), series)
+        state.record(series)
+        state.save(series)
+
+        self.now += 60
+        state = self.new_state()
+        changed = [time_series('store1', 1), time_series('store2', 1)]
+        self.assertEqual(state.select(changed), [changed[1]])
+
+    def test_heartbeat(self):
+        series = [time_series('store1', 1)]
+        state = self.new_state()
+        state.record(series)
+        state.save(series)
+
+        self.now += 600
+        self.assertEqual(self.new_state().select(series), series)
+
+    def test_unwritten_series_are_selected_again(self):
+        series = [time_series('store1', 1), time_series('store2', 1)]
+        state = self.new_state()
+        state.record(series[:1])
+        state.save(series)
+
+        self.assertEqual(self.new_state().select(series), series[1:])
+
+    def test_removed_series_are_dropped(self):
+        state = self.new_state()
+        state.record([time_series('store1', 1), time_series('store2', 1)])
+        state.save([time_series('store1', 1)])
+
+        self.assertEqual(len(self.store.read('metrics_test')['entries']), 1)
+
+
+class TestTimeSeriesWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+        self.client = mock.MagicMock()
+
+    def test_write_in_batches(self):
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1', batch_size=2)
+
+        failed = writer.write([time_series(f'store{i}', 1) for i in range(5)])
+
+        self.assertEqual(failed, [])
+        self.assertEqual(self.client.create_time_series.call_count, 3)
+        self.assertEqual(sorted(len(c.args[0].time_series) for c in self.client.create_time_series.call_args_list), [1, 2, 2])
+
+    def test_retries_transient_errors(self):
+        self.client.create_time_series.side_effect = [exceptions.ServiceUnavailable('unavailable'), None]
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1', initial_backoff=0.01)
+
+        self.assertEqual(writer.write([time_series('store1', 1)]), [])
+        self.assertEqual(self.client.create_time_series.call_count, 2)
+
+    def test_failed_batch_does_not_affect_others(self):
+        def create_time_series(request):
+            if request.time_series[0].metric.labels['store_id'] == 'store0':
+                raise exceptions.PermissionDenied('denied')
+
+        self.client.create_time_series.side_effect = create_time_series
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1', batch_size=2)
+        series = [time_series(f'store{i}', 1) for i in range(4)]
+
+        self.assertEqual(writer.write(series), series[:2])
+        self.assertEqual(self.client.create_time_series.call_count, 2)
+
+    def test_partially_written_batch_is_not_written_again(self):
+        self.client.create_time_series.side_effect = exceptions.InvalidArgument(
+            'One or more TimeSeries could not be written: timeSeries[2]: Field timeSeries[2].points[0] had an invalid value')
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1')
+
+        with self.assertLogs('src.metrics', 'ERROR') as logs:
+            self.assertEqual(writer.write([time_series(f'store{i}', 1) for i in range(5)]), [])
+
+        self.assertEqual(self.client.create_time_series.call_count, 1)
+        self.assertIn('Dropping 1 of 5 time series', logs.output[0])
+        self.assertIn('store2', logs.output[0])
+
+    def test_partially_written_batch_with_summary_is_not_written_again(self):
+        summary = any_pb2.Any()
+        summary.Pack(monitoring_v3.CreateTimeSeriesSummary.pb(
+            monitoring_v3.CreateTimeSeriesSummary(total_point_count=5, success_point_count=3)))
+        self.client.create_time_series.side_effect = exceptions.InvalidArgument('invalid', details=[summary])
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1')
+
+        with self.assertLogs('src.metrics', 'ERROR') as logs:
+            self.assertEqual(writer.write([time_series(f'store{i}', 1) for i in range(5)]), [])
+
+        self.assertEqual(self.client.create_time_series.call_count, 1)
+        self.assertIn('Dropping 2 of 5 points', logs.output[0])
+
+    def test_invalid_series_are_isolated_and_dropped(self):
+        written = []
+
+        def create_time_series(request):
+            store_ids = [ts.metric.labels['store_id'] for ts in request.time_series]
+            if 'store2' in store_ids:
+                raise exceptions.InvalidArgument('bad series')
+            written.extend(store_ids)
+
+        self.client.create_time_series.side_effect = create_time_series
+        writer = TimeSeriesWriter(self.client, self.engine, 'p1')
+
+        self.assertEqual(writer.write([time_series(f'store{i}', 1) for i in range(5)]), [])
+        self.assertEqual(sorted(written), ['store0', 'store1', 'store3', 'store4'])
+
+
+class TestZoneActiveCountSeries(unittest.TestCase):
+
+    def test_rollup_by_fleet_location_and_version(self):
+        series = get_zone_active_count_series([
+            ('f1', 'us-east4', '1.7.0', 1),
+            ('f1', 'us-east4', '1.7.0', 0),
+            ('f1', 'us-east4', '1.7.0', 1),
+            ('f2', 'us-west1', '1.8.0', 0),
+        ], {'seconds': 0})
+
+        counts = {tuple(ts['metric']['labels'].values()): ts['points'][0]['value']['int64_value'] for ts in series}
+        self.assertEqual(counts, {
+            ('f1', 'us-east4', '1.7.0', 'active'): 2,
+            ('f1', 'us-east4', '1.7.0', 'inactive'): 1,
+            ('f2', 'us-west1', '1.8.0', 'active'): 0,
+            ('f2', 'us-west1', '1.8.0', 'inactive'): 1,
+        })
+        self.assertEqual(series[0]['metric']['type'], ZONE_ACTIVE_COUNT_METRIC)
@@ -0,0 +1,87 @@
+import unittest
+from unittest import mock
+from src import reconcile, schedule
+from src.reconcile import ReconcileState
+
+def generate_config_zone_info():
+    return {
+        ('p1', 'us-east4'): {
+            'store1': {'cluster_name': 'c1', 'node_count': '3'},
+            'store2': {'cluster_name': 'c2', 'node_count': '3'},
+            'store3': {'cluster_name': 'c3', 'node_count': '3'},
+        }
+    }
+
+class TestReconcileState(unittest.TestCase):
+
+    def setUp(self):
+        self.store = mock.MagicMock()
+        self.store.read.return_value = None
+        self.state = ReconcileState(self.store, 'reconcile_zone_watcher', drift_slices=1000, clock=lambda: 100)
+        patcher = mock.patch.object(ReconcileState, '_in_drift_slice', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_row_hash_ignores_column_order(self):
+        self.assertEqual(reconcile.get_row_hash({'a': '1', 'b': '2'}), reconcile.get_row_hash({'b': '2', 'a': '1'}))
+        self.assertNotEqual(reconcile.get_row_hash({'a': '1'}), reconcile.get_row_hash({'a': '2'}))
+
+    def test_new_stores_are_selected(self):
+        config_zone_info = generate_config_zone_info()
+
+        self.assertEqual(self.state.select(config_zone_info), config_zone_info)
+
+    def test_only_changed_and_non_terminal_stores_are_selected(self):
+        config_zone_info = generate_config_zone_info()
+        self.state.record(config_zone_info, {
+            'store1': (reconcile.IN_SYNC, 'zone1'),
+            'store2': (reconcile.TRIGGERED, 'zone2'),
+            'store3': (reconcile.IN_SYNC, 'zone3'),
+        })
+        config_zone_info[('p1', 'us-east4')]['store3']['node_count'] = '5'
+
+        selected = self.state.select(config_zone_info)
+
+        self.assertEqual(list(selected[('p1', 'us-east4')]), ['store2', 'store3'])
+        self.assertEqual(self.state.get_zones(['store1', 'store4']), {'zone1'})
+
+    def test_stores_without_outcome_are_reevaluated(self):
+        config_zone_info = generate_config_zone_info()
+        self.state.record(config_zone_info, {'store1': (reconcile.IN_SYNC, 'zone1')})
+
+        selected = self.state.select(config_zone_info)
+
+        self.assertEqual(list(selected[('p1', 'us-east4')]), ['store2', 'store3'])
+
+    def test_drift_slice_rotates_through_unchanged_stores(self):
+        mock.patch.stopall()
+        config_zone_info = generate_config_zone_info()
+        state = ReconcileState(self.store, 'reconcile_zone_watcher', drift_slices=3)
+        state.record(config_zone_info, {store_id: (reconcile.IN_SYNC, None) for store_id in config_zone_info[('p1', 'us-east4')]})
+
+        selected_stores = []
+        for _ in range(3):
+            selected_stores.extend(state.select(config_zone_info).get(('p1', 'us-east4'), {}))
+            state.save(config_zone_info)
+
+        self.assertEqual(sorted(selected_stores), ['store1', 'store2', 'store3'])
+
+    def test_save_drops_removed_stores(self):
+        config_zone_info = generate_config_zone_info()
+        self.state.record(config_zone_info, {'store1': (reconcile.IN_SYNC, 'zone1')})
+        del config_zone_info[('p1', 'us-east4')]['store2']
+
+        self.state.save(config_zone_info)
+
+        document = self.store.write.call_args[0][1]
+        self.assertEqual(document['run'], 1)
+        self.assertEqual(sorted(document['entries']), ['store1', 'store3'])
+
+    def test_priority_and_deferred_stores(self):
+        config_zone_info = generate_config_zone_info()
+        self.state.record(config_zone_info, {'store1': (reconcile.IN_SYNC, 'zone1'), 'store2': (reconcile.ERROR, 'zone2')},
+                          deferred=['store3'])
+
+        self.assertEqual(self.state.get_priority('store1'), schedule.STEADY_STATE)
+        self.assertEqual(self.state.get_priority('store2'), schedule.RETRIABLE)
+        self.assertEqual(self.state.get_priority('store3'), schedule.NEVER_RECONCILED)
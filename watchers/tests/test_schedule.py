@@ -0,0 +1,57 @@
+import unittest
+from src import schedule
+from src.schedule import Deadline, StoreSchedule
+
+def generate_config_zone_info():
+    return {
+        ('p1', 'us-east4'): {'store1': {}, 'store2': {}},
+        ('p2', 'us-west1'): {'store3': {}, 'store4': {}},
+    }
+
+class TestSchedule(unittest.TestCase):
+
+    def test_order_stores_keeps_source_of_truth_order(self):
+        self.assertEqual([store_id for _, store_id in schedule.order_stores(generate_config_zone_info())],
+                         ['store1', 'store2', 'store3', 'store4'])
+
+    def test_order_stores_by_priority_from_cursor(self):
+        priorities = {'store1': schedule.STEADY_STATE, 'store2': schedule.RETRIABLE,
+                      'store3': schedule.STEADY_STATE, 'store4': schedule.NEVER_RECONCILED}
+
+        stores = schedule.order_stores(generate_config_zone_info(), priorities.get, cursor='store3')
+
+        self.assertEqual(stores, [(('p2', 'us-west1'), 'store4'), (('p1', 'us-east4'), 'store2'),
+                                  (('p2', 'us-west1'), 'store3'), (('p1', 'us-east4'), 'store1')])
+
+    def test_schedule_defers_stores_after_deadline(self):
+        now = [0]
+        deadline = Deadline(10, clock=lambda: now[0])
+        store_schedule = StoreSchedule.from_zone_info(generate_config_zone_info(), deadline)
+
+        evaluated = []
+        for _, store_id in store_schedule:
+            evaluated.append(store_id)
+            now[0] += 5
+
+        self.assertEqual(evaluated, ['store1', 'store2'])
+        self.assertEqual(store_schedule.deferred, ['store3', 'store4'])
+
+    def test_schedule_keeps_reserve_before_deadline(self):
+        now = [0]
+        deadline = Deadline(10, clock=lambda: now[0])
+        store_schedule = StoreSchedule.from_zone_info(generate_config_zone_info(), deadline, reserve=4)
+
+        evaluated = []
+        for _, store_id in store_schedule:
+            evaluated.append(store_id)
+            now[0] += 3
+
+        self.assertEqual(evaluated, ['store1', 'store2'])
+        self.assertEqual(store_schedule.deferred, ['store3', 'store4'])
+        self.assertFalse(store_schedule.deadline.expired())
+
+    def test_schedule_without_deadline_evaluates_every_store(self):
+        store_schedule = StoreSchedule.from_zone_info(generate_config_zone_info())
+
+        self.assertEqual(len(list(store_schedule)), 4)
+        self.assertEqual(store_schedule.deferred, [])
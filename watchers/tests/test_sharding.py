@@ -0,0 +1,108 @@
+import unittest
+from unittest import mock
+from src import sharding
+from src.engine import AsyncEngine
+from src.sharding import Shard, WatcherResult
+
+def generate_config_zone_info():
+    return {
+        ('p1', 'us-east4'): {f'store{i}': {'store_id': f'store{i}'} for i in range(6)},
+        ('p2', 'us-west1'): {f'store{i}': {'store_id': f'store{i}'} for i in range(6, 9)},
+        ('p3', 'us-central1'): {f'store{i}': {'store_id': f'store{i}'} for i in range(9, 11)},
+    }
+
+class TestSharding(unittest.TestCase):
+
+    def test_get_shard_count(self):
+        self.assertEqual(sharding.get_shard_count(1000, 0, 250), 1)
+        self.assertEqual(sharding.get_shard_count(1000, 8, 250), 4)
+        self.assertEqual(sharding.get_shard_count(1001, 8, 250), 5)
+        self.assertEqual(sharding.get_shard_count(10000, 8, 250), 8)
+        self.assertEqual(sharding.get_shard_count(0, 8, 250), 1)
+
+    def test_location_strategy_balances_whole_locations(self):
+        config_zone_info = generate_config_zone_info()
+
+        shards = sharding.plan_shards(config_zone_info, 2, sharding.LOCATION_STRATEGY)
+
+        self.assertEqual([shard.locations for shard in shards],
+                         [[('p1', 'us-east4')], [('p2', 'us-west1'), ('p3', 'us-central1')]])
+        self.assertEqual(sharding.select_shard(config_zone_info, shards[1]),
+                         {key: config_zone_info[key] for key in [('p2', 'us-west1'), ('p3', 'us-central1')]})
+
+    def test_hash_strategy_covers_every_store_once(self):
+        config_zone_info = generate_config_zone_info()
+
+        shards = sharding.plan_shards(config_zone_info, 3, sharding.HASH_STRATEGY)
+
+        selected = {}
+        for shard in shards:
+            for key, stores in sharding.select_shard(config_zone_info, shard).items():
+                for store_id in stores:
+                    self.assertNotIn(store_id, selected)
+                    selected[store_id] = key
+
+        self.assertEqual(len(selected), 11)
+
+    def test_shard_serialization_round_trip(self):
+        shard = Shard(1, 3, sharding.HASH_STRATEGY, [('p1', 'us-east4')])
+
+        self.assertEqual(Shard.from_dict(shard.to_dict()), shard)
+
+    def test_aggregate_only_reports_zones_unprocessed_by_every_shard(self):
+        shards = [
+            Shard(0, 2, sharding.HASH_STRATEGY, [('p1', 'us-east4')]),
+            Shard(1, 2, sharding.HASH_STRATEGY, [('p1', 'us-east4'), ('p2', 'us-west1')]),
+        ]
+        results = [
+            WatcherResult(1, {'zone1': ('p1', 'us-east4'), 'zone2': ('p1', 'us-east4')}),
+            WatcherResult(2, {'zone2': ('p1', 'us-east4'), 'zone3': ('p2', 'us-west1')}),
+        ]
+
+        aggregate = sharding.aggregate_shard_results(shards, results)
+
+        self.assertEqual(aggregate.count, 3)
+        self.assertEqual(aggregate.unprocessed_zones, {'zone2': ('p1', 'us-east4'), 'zone3': ('p2', 'us-west1')})
+
+    def test_aggregate_skips_failed_shards(self):
+        shards = [
+            Shard(0, 2, sharding.HASH_STRATEGY, [('p1', 'us-east4')]),
+            Shard(1, 2, sharding.HASH_STRATEGY, [('p1', 'us-east4')]),
+        ]
+        results = [WatcherResult(1, {'zone1': ('p1', 'us-east4')}), None]
+
+        aggregate = sharding.aggregate_shard_results(shards, results)
+
+        self.assertEqual(aggregate.count, 1)
+        self.assertEqual(aggregate.unprocessed_zones, {})
+
+    @mock.patch('google.oauth2.id_token.fetch_id_token')
+    @mock.patch('requests.post')
+    def test_http_dispatcher_posts_each_shard(self, mock_post, mock_fetch_id_token):
+        mock_fetch_id_token.return_value = 'token'
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'count': 2, 'unprocessed_zones': {'zone1': ['p1', 'us-east4']}}
+
+        shard = Shard(0, 1, sharding.LOCATION_STRATEGY, [('p1', 'us-east4')])
+
+        with AsyncEngine() as engine:
+            results = sharding.HttpShardDispatcher('https://worker/', engine).dispatch([shard])
+
+        self.assertEqual(results, [WatcherResult(2, {'zone1': ('p1', 'us-east4')})])
+        mock_post.assert_called_once_with('https://worker/', json={'shard': shard.to_dict()},
+                                          headers={'Authorization': 'Bearer token'}, timeout=55)
+
+    @mock.patch('google.oauth2.id_token.fetch_id_token')
+    @mock.patch('requests.post')
+    def test_http_dispatcher_times_out_after_shard_budget(self, mock_post, mock_fetch_id_token):
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'count': 0}
+
+        shard = Shard(0, 1, sharding.LOCATION_STRATEGY, [('p1', 'us-east4')], budget=30)
+
+        with AsyncEngine() as engine:
+            sharding.HttpShardDispatcher('https://worker/', engine).dispatch([shard])
+
+        self.assertEqual(mock_post.call_args.kwargs['json'], {'shard': shard.to_dict()})
+        self.assertEqual(mock_post.call_args.kwargs['timeout'], 30 + sharding.SHARD_RESPONSE_MARGIN)
+        self.assertEqual(Shard.from_dict(shard.to_dict()), shard)
@@ -0,0 +1,278 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from src import source_of_truth
+from src.reconcile import get_row_hash
+from src.source_of_truth import (IntentData, SourceOfTruthCache, SourceOfTruthSnapshot, SourceOfTruthSnapshotCache,
+                                 SourceOfTruthStream, get_body_hash, get_shards_hash, iter_lines, iter_rows,
+                                 merge_shards)
+from src.state_store import LocalFileStateStore
+
+class TestSourceOfTruthCache(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(source_of_truth, 'cached_files', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+
+    def test_entries_are_kept_in_memory(self):
+        cache = SourceOfTruthCache()
+        cache.put('https://example.com/sot.csv', 'a,b\n', '"etag1"')
+
+        entry = SourceOfTruthCache().get('https://example.com/sot.csv')
+        self.assertEqual((entry.body, entry.etag), ('a,b\n', '"etag1"'))
+        self.assertIsNone(cache.get('https://example.com/other.csv'))
+
+    def test_entries_are_persisted_without_the_url(self):
+        url = 'https://gitlab.com/api/v4/projects/p/repository/files/sot.csv/raw?ref=main&private_token=secret'
+        SourceOfTruthCache(LocalFileStateStore(self.directory)).put(url, 'a,b\n', '"etag1"')
+        source_of_truth.cached_files.clear()
+
+        entry = SourceOfTruthCache(LocalFileStateStore(self.directory)).get(url)
+        self.assertEqual((entry.body, entry.etag), ('a,b\n', '"etag1"'))
+        self.assertEqual(entry.body_hash, source_of_truth.get_body_hash('a,b\n'))
+
+        with open(f'{self.directory}/{SourceOfTruthCache._key(url)}.json') as f:
+            self.assertNotIn('secret', f.read())
+
+    def test_age(self):
+        now = [1000.0]
+        cache = SourceOfTruthCache(clock=lambda: now[0])
+        entry = cache.put('https://example.com/sot.csv', 'a,b\n', None)
+
+        now[0] += 60
+        self.assertEqual(cache.age(entry), 60)
+        cache.revalidated('https://example.com/sot.csv', entry)
+        self.assertEqual(cache.age(entry), 0)
+
+    def test_revalidation_is_persisted(self):
+        now = [1000.0]
+        url = 'https://example.com/sot.csv'
+        cache = SourceOfTruthCache(LocalFileStateStore(self.directory), clock=lambda: now[0])
+        entry = cache.put(url, 'a,b\n', '"etag1"')
+
+        now[0] += 600
+        cache.revalidated(url, entry)
+        source_of_truth.cached_files.clear()
+
+        now[0] += 60
+        entry = SourceOfTruthCache(LocalFileStateStore(self.directory), clock=lambda: now[0]).get(url)
+        self.assertEqual(cache.age(entry), 60)
+
+        # a revalidation of a previous revision does not apply to the new file
+        cache.put(url, 'a,b,c\n', '"etag2"')
+        source_of_truth.cached_files.clear()
+        now[0] += 60
+        entry = SourceOfTruthCache(LocalFileStateStore(self.directory), clock=lambda: now[0]).get(url)
+        self.assertEqual(cache.age(entry), 60)
+
+
+class TestIterRows(unittest.TestCase):
+
+    SOT = ('store_id,location,maintenance_exclusion_name_1,maintenance_exclusion_name_2,labels,sync_repo\r\n'
+           'store1,us-east4,x1,x2,"env=prod,tier=edge",repo\r\n'
+           '\r\n'
+           'store2,us-west1,"multi\nline"\r\n')
+
+    def test_rows_match_dict_reader(self):
+        import csv
+        self.assertEqual(list(iter_rows(io.StringIO(self.SOT, newline=''))),
+                         list(csv.DictReader(io.StringIO(self.SOT, newline=''))))
+
+    def test_projection(self):
+        rows = list(iter_rows(io.StringIO(self.SOT, newline=''), ('store_id', 'maintenance_exclusion_*', 'labels')))
+
+        self.assertEqual(rows, [
+            {'store_id': 'store1', 'maintenance_exclusion_name_1': 'x1', 'maintenance_exclusion_name_2': 'x2',
+             'labels': 'env=prod,tier=edge'},
+            {'store_id': 'store2', 'maintenance_exclusion_name_1': 'multi\nline', 'maintenance_exclusion_name_2': None,
+             'labels': None},
+        ])
+
+    def test_empty_file(self):
+        self.assertEqual(list(iter_rows([])), [])
+
+
+class TestSourceOfTruthStream(unittest.TestCase):
+
+    def test_hash_and_completion(self):
+        body = 'store_id\nstore1\nstore2\n'
+        on_complete = mock.MagicMock()
+        close = mock.MagicMock()
+        stream = SourceOfTruthStream(io.StringIO(body, newline=''), on_complete=on_complete, close=close)
+
+        self.assertEqual(''.join(stream), body)
+        self.assertEqual(stream.body_hash, get_body_hash(body))
+        on_complete.assert_called_once_with(body)
+        close.assert_called_once()
+
+    def test_incomplete_file_is_not_completed(self):
+        on_complete = mock.MagicMock()
+        close = mock.MagicMock()
+        stream = SourceOfTruthStream(io.StringIO('store_id\nstore1\n', newline=''), on_complete=on_complete, close=close)
+
+        lines = iter(stream)
+        next(lines)
+        lines.close()
+
+        on_complete.assert_not_called()
+        close.assert_called_once()
+
+
+class TestStoreRow(unittest.TestCase):
+
+    SOT = ('store_id,location,sync_branch\n'
+           'store1,us-east4,main\n'
+           'store2,us-east4,main\n')
+
+    def test_mapping(self):
+        row = next(iter_rows(io.StringIO(self.SOT, newline='')))
+
+        self.assertEqual(row['store_id'], 'store1')
+        self.assertEqual(row.get('sync_branch'), 'main')
+        self.assertIsNone(row.get('labels'))
+        self.assertEqual(row.get('labels', ''), '')
+        self.assertIn('location', row)
+        self.assertEqual(list(row.keys()), ['store_id', 'location', 'sync_branch'])
+        self.assertEqual(row, {'store_id': 'store1', 'location': 'us-east4', 'sync_branch': 'main'})
+        with self.assertRaises(KeyError):
+            row['labels']
+        with self.assertRaises(AttributeError):
+            row.extra = 1
+
+    def test_rows_share_columns_and_values(self):
+        (row1, row2) = iter_rows(io.StringIO(self.SOT, newline=''))
+
+        self.assertIs(row1.columns, row2.columns)
+        self.assertIs(row1['sync_branch'], row2['sync_branch'])
+
+    def test_row_hash_matches_dict(self):
+        row = next(iter_rows(io.StringIO(self.SOT, newline='')))
+
+        self.assertEqual(get_row_hash(row), get_row_hash(dict(row)))
+
+    def test_intent_data(self):
+        intent_data = IntentData()
+        for row in iter_rows(io.StringIO(self.SOT, newline='')):
+            intent_data.add(('p1', row['location']), row)
+
+        self.assertEqual(list(intent_data), [('p1', 'us-east4')])
+        self.assertEqual(list(intent_data[('p1', 'us-east4')]), ['store1', 'store2'])
+        self.assertEqual(intent_data.get_store('store2')['store_id'], 'store2')
+        self.assertIsNone(intent_data.get_store('store3'))
+
+
+class TestSourceOfTruthSnapshot(unittest.TestCase):
+
+    SOT = ('store_id,machine_project_id,fleet_project_id,location\n'
+           'store1,p1,f1,us-east4\n'
+           'store2,p2,f1,us-east4\n')
+
+    def setUp(self):
+        patcher = mock.patch.object(source_of_truth, 'snapshots', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def parse(self):
+        return SourceOfTruthSnapshot.parse(SourceOfTruthStream(io.StringIO(self.SOT, newline='')))
+
+    def test_views(self):
+        snapshot = self.parse()
+
+        self.assertEqual(snapshot.body_hash, get_body_hash(self.SOT))
+        self.assertEqual([row['store_id'] for row in snapshot.rows], ['store1', 'store2'])
+        self.assertEqual(list(snapshot.grouped_by('machine_project_id')), [('p1', 'us-east4'), ('p2', 'us-east4')])
+        self.assertEqual(list(snapshot.grouped_by('fleet_project_id')[('f1', 'us-east4')]), ['store1', 'store2'])
+        self.assertIs(snapshot.grouped_by('fleet_project_id'), snapshot.grouped_by('fleet_project_id'))
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        snapshot = self.parse()
+        columns = ('store_id', 'location')
+
+        SourceOfTruthSnapshotCache(LocalFileStateStore(directory)).put(snapshot, columns)
+        self.assertIs(SourceOfTruthSnapshotCache().get(snapshot.body_hash, columns), snapshot)
+        self.assertIsNone(SourceOfTruthSnapshotCache().get('other', columns))
+
+        source_of_truth.snapshots.clear()
+        self.assertIsNone(SourceOfTruthSnapshotCache().get(snapshot.body_hash, columns))
+        self.assertIsNone(SourceOfTruthSnapshotCache(LocalFileStateStore(directory)).get(snapshot.body_hash, ('store_id',)))
+
+        loaded = SourceOfTruthSnapshotCache(LocalFileStateStore(directory)).get(snapshot.body_hash, columns)
+        self.assertEqual(loaded.columns, snapshot.columns)
+        self.assertEqual(loaded.rows, snapshot.rows)
+        self.assertIs(loaded.rows[0]['location'], loaded.rows[1]['location'])
+
+    def test_cache_deletes_previous_revision(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        snapshot = self.parse()
+        columns = ('store_id', 'location')
+        cache = SourceOfTruthSnapshotCache(LocalFileStateStore(directory))
+
+        cache.put(snapshot, columns)
+        cache.put(SourceOfTruthSnapshot('other', snapshot.columns, snapshot.rows), columns)
+        cache.put(SourceOfTruthSnapshot('other', snapshot.columns, snapshot.rows), columns)
+
+        source_of_truth.snapshots.clear()
+        self.assertIsNone(cache.get(snapshot.body_hash, columns))
+        self.assertIsNotNone(cache.get('other', columns))
+        self.assertEqual(len([name for name in os.listdir(directory) if name.startswith('sot_snapshot_')]), 2)
+
+
+class TestMergeShards(unittest.TestCase):
+
+    def test_same_header(self):
+        shards = [('sot/east.csv', 'store_id,location\nstore1,us-east4\n'),
+                  ('sot/west.csv', 'store_id,location\nstore2,us-west1')]
+
+        self.assertEqual(''.join(merge_shards(shards)), 'store_id,location\nstore1,us-east4\nstore2,us-west1\n')
+
+    def test_different_headers(self):
+        shards = [('sot/east.csv', 'store_id,location\nstore1,us-east4\n'),
+                  ('sot/west.csv', 'location,store_id,labels\nus-west1,store2,"a=1,b=2"\n')]
+
+        rows = list(iter_rows(merge_shards(shards)))
+
+        self.assertEqual(rows, [{'store_id': 'store1', 'location': 'us-east4', 'labels': ''},
+                                {'store_id': 'store2', 'location': 'us-west1', 'labels': 'a=1,b=2'}])
+
+    def test_duplicate_store(self):
+        shards = [('sot/east.csv', 'store_id,location\nstore1,us-east4\n'),
+                  ('sot/west.csv', 'store_id,location\nstore1,us-west1\n')]
+
+        with self.assertRaisesRegex(Exception, 'store1 of source of truth shard sot/west.csv is already listed in sot/east.csv'):
+            list(merge_shards(shards))
+
+    def test_duplicate_store_in_one_shard(self):
+        shards = [('sot/east.csv', 'store_id,location\nstore1,us-east4\nstore1,us-east1\n')]
+
+        rows = list(iter_rows(merge_shards(shards)))
+
+        self.assertEqual([row['location'] for row in rows], ['us-east4', 'us-east1'])
+
+    def test_missing_store_id(self):
+        with self.assertRaises(Exception):
+            list(merge_shards([('sot/east.csv', 'location\nus-east4\n')]))
+
+    def test_shards_hash(self):
+        shards_hash = get_shards_hash([('a.csv', 'h1'), ('b.csv', 'h2')])
+
+        self.assertEqual(shards_hash, get_shards_hash([('b.csv', 'h2'), ('a.csv', 'h1')]))
+        self.assertNotEqual(shards_hash, get_shards_hash([('a.csv', 'h1'), ('b.csv', 'h3')]))
+        self.assertNotEqual(shards_hash, get_shards_hash([('a.csv', 'h1')]))
+
+
+class TestIterLines(unittest.TestCase):
+
+    def test_chunks(self):
+        content = 'store_id,labels\r\nstore1,"a=é\nb"\nstore2,\u00e9'.encode('utf-8')
+        chunks = [content[i:i + 3] for i in range(0, len(content), 3)]
+
+        self.assertEqual(list(iter_lines(chunks)), ['store_id,labels\r\n', 'store1,"a=é\n', 'b"\n', 'store2,é'])
+        self.assertEqual(list(iter_lines([])), [])
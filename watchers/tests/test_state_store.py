@@ -0,0 +1,72 @@
+import tempfile
+import unittest
+from unittest import mock
+from src import state_store
+
+class TestStateStore(unittest.TestCase):
+
+    def test_local_file_state_store_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = state_store.LocalFileStateStore(tmp_dir)
+
+            self.assertIsNone(store.read('missing'))
+
+            store.write('doc', {'a': [1, 2]})
+            self.assertEqual(store.read('doc'), {'a': [1, 2]})
+
+    def test_local_file_state_store_conditional_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = state_store.LocalFileStateStore(tmp_dir)
+
+            self.assertEqual(store.read_with_generation('doc'), (None, None))
+            self.assertTrue(store.write_if_generation('doc', {'a': 1}, None))
+            self.assertFalse(store.write_if_generation('doc', {'a': 2}, None))
+
+            (document, generation) = store.read_with_generation('doc')
+            self.assertEqual(document, {'a': 1})
+            store.write('doc', {'a': 3})
+            self.assertFalse(store.write_if_generation('doc', {'a': 2}, generation))
+            self.assertEqual(store.read('doc'), {'a': 3})
+
+    @mock.patch('google.cloud.storage.Client')
+    def test_gcs_state_store_conditional_write(self, mock_client):
+        from google.api_core import exceptions
+        store = state_store.get_state_store('gs://my-bucket/watcher-state')
+        blob = mock_client.return_value.bucket.return_value.blob.return_value
+
+        self.assertTrue(store.write_if_generation('doc', {'a': 1}, None))
+        self.assertEqual(blob.upload_from_string.call_args.kwargs['if_generation_match'], 0)
+
+        blob.upload_from_string.side_effect = exceptions.PreconditionFailed('conflict')
+        self.assertFalse(store.write_if_generation('doc', {'a': 1}, '42'))
+        self.assertEqual(blob.upload_from_string.call_args.kwargs['if_generation_match'], 42)
+
+    def test_incomplete_state_store_cannot_be_created(self):
+        class ReadOnlyStateStore(state_store.StateStore):
+            def read(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStateStore()
+
+    def test_get_state_store_not_configured(self):
+        self.assertIsNone(state_store.get_state_store(None))
+        self.assertIsNone(state_store.get_state_store(''))
+
+    def test_get_state_store_local(self):
+        store = state_store.get_state_store('file:///tmp/watcher-state')
+
+        self.assertIsInstance(store, state_store.LocalFileStateStore)
+        self.assertEqual(store.directory, '/tmp/watcher-state')
+
+    @mock.patch('google.cloud.storage.Client')
+    def test_get_state_store_gcs(self, mock_client):
+        store = state_store.get_state_store('gs://my-bucket/watcher-state')
+
+        self.assertIsInstance(store, state_store.GcsStateStore)
+        mock_client.return_value.bucket.assert_called_once_with('my-bucket')
+        self.assertEqual(store.prefix, 'watcher-state')
+
+    def test_get_state_store_unsupported(self):
+        with self.assertRaises(Exception):
+            state_store.get_state_store('s3://my-bucket/watcher-state')
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+from google.api_core import exceptions
+from src.engine import AsyncEngine
+from src.schedule import Deadline
+from src.triggers import BuildTriggerDispatcher, TokenBucket, TriggerRequest
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_bucket_limits_rate_after_burst(self):
+        bucket = TokenBucket(rate=20, burst=2)
+
+        async def acquire_all():
+            for _ in range(4):
+                await bucket.acquire()
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+
+        # 2 tokens from the burst, then 2 more at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class TestBuildTriggerDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+        self.client = mock.MagicMock()
+
+    def test_dispatch_submits_every_request(self):
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=3)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+        dispatcher.submit(TriggerRequest('store2', 'zone2', 'main'))
+
+        results = dispatcher.dispatch()
+
+        self.assertEqual([(r.request.zone, r.success, r.attempts) for r in results],
+                         [('zone1', True, 1), ('zone2', True, 1)])
+        self.assertEqual(self.client.run_build_trigger.call_count, 2)
+        req = self.client.run_build_trigger.call_args_list[0].kwargs['request']
+        self.assertEqual(req.name, 'trigger')
+        self.assertEqual(dict(req.source.substitutions), {'_STORE_ID': 'store1', '_ZONE': 'zone1'})
+        self.assertEqual(dispatcher.dispatch(), [])
+
+    @mock.patch('random.uniform', return_value=0)
+    def test_dispatch_retries_resource_exhausted(self, _):
+        self.client.run_build_trigger.side_effect = [exceptions.ResourceExhausted('quota'), mock.MagicMock()]
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=3)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+
+        results = dispatcher.dispatch()
+
+        self.assertTrue(results[0].success)
+        self.assertEqual(results[0].attempts, 2)
+
+    @mock.patch('random.uniform', return_value=0)
+    def test_dispatch_gives_up_after_max_attempts(self, _):
+        self.client.run_build_trigger.side_effect = exceptions.ResourceExhausted('quota')
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=3)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+
+        results = dispatcher.dispatch()
+
+        self.assertFalse(results[0].success)
+        self.assertEqual(results[0].attempts, 3)
+
+    def test_dispatch_does_not_retry_other_errors(self):
+        self.client.run_build_trigger.side_effect = exceptions.PermissionDenied('denied')
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=3)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+
+        results = dispatcher.dispatch()
+
+        self.assertFalse(results[0].success)
+        self.assertEqual(results[0].attempts, 1)
+
+    def test_dispatch_defers_requests_after_deadline(self):
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=3)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+
+        results = dispatcher.dispatch(Deadline(0))
+
+        self.assertTrue(results[0].deferred)
+        self.assertFalse(results[0].success)
+        self.client.run_build_trigger.assert_not_called()
+
+    def test_dispatch_defers_retries_past_deadline(self):
+        self.client.run_build_trigger.side_effect = exceptions.ResourceExhausted('quota')
+        dispatcher = BuildTriggerDispatcher(self.client, self.engine, 'trigger', rate=100, burst=10, max_attempts=5,
+                                            initial_backoff=30)
+        dispatcher.submit(TriggerRequest('store1', 'zone1', 'main'))
+
+        start = time.monotonic()
+        results = dispatcher.dispatch(Deadline(10))
+
+        self.assertTrue(results[0].deferred)
+        self.assertEqual(results[0].attempts, 1)
+        self.assertLess(time.monotonic() - start, 5)
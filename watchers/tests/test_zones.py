@@ -0,0 +1,201 @@
+import tempfile
+import unittest
+from unittest import mock
+from google.api_core import exceptions
+from google.cloud.gdchardwaremanagement_v1alpha import Zone
+from src.engine import AsyncEngine
+from src.state_store import LocalFileStateStore
+from src.zones import ZoneIndex, ZoneNameCache
+
+def create_zone(project, location, store_id, globally_unique_id, state=Zone.State.ACTIVE):
+    return Zone(
+        name=f'projects/{project}/locations/{location}/zones/{store_id}',
+        globally_unique_id=globally_unique_id,
+        state=state
+    )
+
+class TestZoneIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.MagicMock()
+        zones = {
+            'projects/p1/locations/us-east4': [
+                create_zone('p1', 'us-east4', 'store1', 'zone1'),
+                create_zone('p1', 'us-east4', 'store2', 'zone2')],
+            'projects/p2/locations/us-west1': [
+                create_zone('p2', 'us-west1', 'store3', 'zone3')],
+        }
+
+        def list_zones(request):
+            if request.parent not in zones:
+                raise exceptions.InternalServerError('boom')
+            return iter(zones[request.parent])
+
+        self.client.list_zones.side_effect = list_zones
+
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+
+    def test_load_lists_each_location_once(self):
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p1', 'us-east4'), ('p2', 'us-west1'), ('p1', 'us-east4')])
+        index.load([('p1', 'us-east4')])
+
+        self.assertEqual(self.client.list_zones.call_count, 2)
+        self.assertEqual(index.get_zone('projects/p1/locations/us-east4/zones/store2').globally_unique_id, 'zone2')
+        self.assertEqual(index.get_zone('projects/p2/locations/us-west1/zones/store3').globally_unique_id, 'zone3')
+        self.client.get_zone.assert_not_called()
+
+    def test_missing_zone_in_indexed_location_raises_not_found(self):
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p1', 'us-east4')])
+
+        with self.assertRaises(exceptions.NotFound):
+            index.get_zone('projects/p1/locations/us-east4/zones/store9')
+        self.client.get_zone.assert_not_called()
+
+    def test_zones_are_indexed_under_the_listed_project(self):
+        self.client.list_zones.side_effect = lambda request: iter([create_zone('123456', 'us-east4', 'store1', 'zone1')])
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p1', 'us-east4')])
+
+        self.assertEqual(index.get_zone('projects/p1/locations/us-east4/zones/store1').globally_unique_id, 'zone1')
+        self.client.get_zone.assert_not_called()
+
+    def test_get_zone_lists_location_on_first_lookup(self):
+        index = ZoneIndex(self.client, self.engine)
+
+        self.assertEqual(index.get_zone('projects/p1/locations/us-east4/zones/store1').globally_unique_id, 'zone1')
+        self.assertEqual(index.get_zone('projects/p1/locations/us-east4/zones/store2').globally_unique_id, 'zone2')
+        self.assertEqual(self.client.list_zones.call_count, 1)
+
+    def test_failed_location_falls_back_to_get_zone(self):
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p3', 'us-central1')])
+
+        fallback_zone = create_zone('p3', 'us-central1', 'store4', 'zone4')
+        self.client.get_zone.return_value = fallback_zone
+
+        self.assertEqual(index.get_zone('projects/p3/locations/us-central1/zones/store4'), fallback_zone)
+        self.client.get_zone.assert_called_once_with(name='projects/p3/locations/us-central1/zones/store4')
+
+    def test_failed_location_keeps_listing_error(self):
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p1', 'us-east4'), ('p3', 'us-central1')])
+
+        self.assertEqual(list(index.location_errors), [('p3', 'us-central1')])
+        self.assertIsInstance(index.location_errors[('p3', 'us-central1')], exceptions.InternalServerError)
+
+    def test_zone_lookups_are_memoized(self):
+        index = ZoneIndex(self.client, self.engine)
+        index.load([('p3', 'us-central1')])
+
+        self.client.get_zone.return_value = create_zone('p3', 'us-central1', 'store4', 'zone4')
+
+        index.get_zone('projects/p3/locations/us-central1/zones/store4')
+        index.get_zone('projects/p3/locations/us-central1/zones/store4')
+        index.get_zone('projects/p1/locations/us-east4/zones/store1')
+        index.get_zone('projects/p1/locations/us-east4/zones/store1')
+        index.get_zone_name('projects/p1/locations/us-east4/zones/store2')
+
+        self.client.get_zone.assert_called_once()
+        self.assertEqual(self.client.list_zones.call_count, 2)
+        self.assertEqual(index.misses, 2)
+        self.assertEqual(index.hits, 3)
+
+
+class TestZoneNameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalFileStateStore(self.tmp_dir.name)
+        self.now = 1000.0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def clock(self):
+        return self.now
+
+    def test_entries_survive_across_instances(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        cache.put('projects/p1/locations/us-east4/zones/store1', 'zone1')
+        cache.save()
+
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        self.assertEqual(cache.get('projects/p1/locations/us-east4/zones/store1'), 'zone1')
+
+    def test_expired_entries_are_ignored_and_evicted(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        cache.put('projects/p1/locations/us-east4/zones/store1', 'zone1')
+        cache.save()
+
+        self.now += 61
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        self.assertIsNone(cache.get('projects/p1/locations/us-east4/zones/store1'))
+
+        cache.save()
+        self.assertEqual(self.store.read(ZoneNameCache.KEY), {'entries': {}})
+
+    def test_concurrent_saves_keep_both_updates(self):
+        first = ZoneNameCache(self.store, 60, self.clock)
+        second = ZoneNameCache(self.store, 60, self.clock)
+        first.get('projects/p1/locations/us-east4/zones/store1')
+        second.get('projects/p1/locations/us-east4/zones/store2')
+
+        first.put('projects/p1/locations/us-east4/zones/store1', 'zone1')
+        second.put('projects/p1/locations/us-east4/zones/store2', 'zone2')
+        first.save()
+        second.save()
+
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        self.assertEqual(cache.get('projects/p1/locations/us-east4/zones/store1'), 'zone1')
+        self.assertEqual(cache.get('projects/p1/locations/us-east4/zones/store2'), 'zone2')
+
+    def test_save_merges_again_after_a_conflicting_write(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        cache.put('projects/p1/locations/us-east4/zones/store1', 'zone1')
+
+        write_if_generation = self.store.write_if_generation
+
+        def conflicting_write(key, value, generation):
+            if not self.store.read(key):
+                self.store.write(key, {'entries': {'projects/p1/locations/us-east4/zones/store2': ['zone2', self.now]}})
+            return write_if_generation(key, value, generation)
+
+        with mock.patch.object(self.store, 'write_if_generation', side_effect=conflicting_write) as mock_write:
+            cache.save()
+
+        self.assertEqual(mock_write.call_count, 2)
+        self.assertEqual(set(self.store.read(ZoneNameCache.KEY)['entries']),
+                         {'projects/p1/locations/us-east4/zones/store1', 'projects/p1/locations/us-east4/zones/store2'})
+
+    def test_unassigned_zone_names_are_not_cached(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        cache.put('projects/p1/locations/us-east4/zones/store1', '')
+
+        self.assertIsNone(cache.get('projects/p1/locations/us-east4/zones/store1'))
+
+    def test_zone_index_resolves_cached_names_without_api_calls(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+        cache.put('projects/p1/locations/us-east4/zones/store1', 'zone1')
+
+        client = mock.MagicMock()
+        index = ZoneIndex(client, self.engine, name_cache=cache)
+
+        self.assertTrue(index.has_cached_zone_name('projects/p1/locations/us-east4/zones/store1'))
+        self.assertEqual(index.get_zone_name('projects/p1/locations/us-east4/zones/store1'), 'zone1')
+        client.list_zones.assert_not_called()
+        client.get_zone.assert_not_called()
+
+    def test_zone_index_caches_resolved_names(self):
+        cache = ZoneNameCache(self.store, 60, self.clock)
+
+        client = mock.MagicMock()
+        client.list_zones.return_value = iter([create_zone('p1', 'us-east4', 'store1', 'zone1')])
+        index = ZoneIndex(client, self.engine, name_cache=cache)
+
+        self.assertEqual(index.get_zone_name('projects/p1/locations/us-east4/zones/store1'), 'zone1')
+        self.assertEqual(cache.get('projects/p1/locations/us-east4/zones/store1'), 'zone1')